@@ -1,14 +1,27 @@
 from fastapi import APIRouter, HTTPException, Depends, UploadFile, File
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import Optional, List
+from typing import AsyncIterator, Optional, List
+from datetime import datetime
+import base64
+import codecs
 import csv
-import io
+import json
 import secrets
 
-from models import APIKeyCreate, APIKeyImport, APIKeyRecord, APIKeyStats, ModelPricing, ModelPricingCreate, AccessToken, AccessTokenCreate
+from models import APIKeyCreate, APIKeyImport, APIKeyRecord, APIKeyStats, ModelPricing, ModelPricingCreate, AccessToken, AccessTokenCreate, AccessTokenLimits
 from config import get_settings
+from cluster import cluster
 from key_manager import key_manager
-from database import db
+from database import db, KEY_SORT_COLUMNS
+from pricing import pricing_index
+from profiler import profiler
+from proxy import api_proxy
+from response_cache import response_cache
+from token_cache import token_cache
+from token_limits import token_limiter
+from tracing import tracer
+from upstream import upstream_client
+from usage_sync import usage_syncer
 
 router = APIRouter(prefix="/admin", tags=["Admin"])
 security = HTTPBearer()
@@ -25,38 +38,133 @@ async def verify_admin_key(credentials: HTTPAuthorizationCredentials = Depends(s
     return credentials.credentials
 
 
+def _encode_cursor(record: APIKeyRecord, sort: str) -> str:
+    """把一页最后一行编码为游标：(排序列的值, id)"""
+    value = getattr(record, sort)
+    if isinstance(value, datetime):
+        value = str(value)
+    raw = json.dumps([value, record.id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+# 游标中排序列的值允许的类型
+_CURSOR_TYPES = {
+    "created_at": (str,),
+    "id": (int,),
+    "balance": (int, float),
+    "used_amount": (int, float),
+    "request_count": (int,)
+}
+
+
+def _decode_cursor(cursor: str, sort: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, key_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # 值会直接绑定到 SQL 参数，类型必须与排序列一致
+    if (isinstance(value, bool) or not isinstance(value, _CURSOR_TYPES[sort])
+            or isinstance(key_id, bool) or not isinstance(key_id, int)):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, key_id
+
+
 @router.get("/keys")
 async def list_keys(
     status: Optional[str] = None,
     page: int = 1,
     page_size: int = 50,
+    min_balance: Optional[float] = None,
+    max_balance: Optional[float] = None,
+    sort: str = "created_at",
+    order: str = "desc",
+    cursor: Optional[str] = None,
     _: str = Depends(verify_admin_key)
 ):
-    """获取所有 API Keys（分页）"""
-    all_keys = await key_manager.get_all_keys(status)
-    total = len(all_keys)
+    """
+    获取 API Keys（分页）
+    支持按页码跳转；传入上一页返回的 next_cursor 时按游标翻页，不随页数增加而变慢
+    """
+    if sort not in KEY_SORT_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of: {', '.join(KEY_SORT_COLUMNS)}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be asc or desc")
+    page = max(page, 1)
+    page_size = min(max(page_size, 1), 1000)
+
+    # 多取一行判断是否还有下一页
+    keys = await db.list_keys_page(
+        status=status,
+        min_balance=min_balance,
+        max_balance=max_balance,
+        sort=sort,
+        descending=order == "desc",
+        limit=page_size + 1,
+        offset=(page - 1) * page_size,
+        after=_decode_cursor(cursor, sort) if cursor else None
+    )
+    next_cursor = None
+    if len(keys) > page_size:
+        keys = keys[:page_size]
+        next_cursor = _encode_cursor(keys[-1], sort)
+
+    total = await db.count_keys(status, min_balance, max_balance)
     total_pages = (total + page_size - 1) // page_size
-    
-    start = (page - 1) * page_size
-    end = start + page_size
-    keys = all_keys[start:end]
-    
+
     return {
         "keys": keys,
         "total": total,
         "page": page,
         "page_size": page_size,
-        "total_pages": total_pages
+        "total_pages": total_pages,
+        "next_cursor": next_cursor
     }
 
 
+@router.get("/keys/pool")
+async def get_key_pool_stats(_: str = Depends(verify_admin_key)):
+    """获取内存 Key 池状态（选择策略、进行中请求数）"""
+    return await key_manager.get_pool_stats()
+
+
+@router.get("/keys/breakers")
+async def get_key_breakers(_: str = Depends(verify_admin_key)):
+    """获取当前进程中各 Key 的熔断状态"""
+    return key_manager.breakers.get_stats()
+
+
+@router.delete("/keys/{key_id}/breaker")
+async def reset_key_breaker(
+    key_id: int,
+    _: str = Depends(verify_admin_key)
+):
+    """重置 Key 的熔断状态，立即恢复参与选择"""
+    return {"success": key_manager.breakers.reset(key_id)}
+
+
+@router.get("/keys/rate-limits")
+async def get_key_rate_limits(_: str = Depends(verify_admin_key)):
+    """获取当前进程学习到的各 Key 请求限额和限流冷却状态"""
+    return key_manager.rate_limits.get_stats()
+
+
+@router.delete("/keys/{key_id}/rate-limit")
+async def reset_key_rate_limit(
+    key_id: int,
+    _: str = Depends(verify_admin_key)
+):
+    """清除 Key 的限流冷却和学习到的限额"""
+    return {"success": key_manager.rate_limits.reset(key_id)}
+
+
 @router.post("/keys", response_model=dict)
 async def add_key(
     key_data: APIKeyCreate,
     _: str = Depends(verify_admin_key)
 ):
     """添加单个 API Key"""
-    record = await db.add_key(key_data.key, key_data.balance)
+    record = await key_manager.add_key(key_data.key, key_data.balance)
     if record:
         return {"success": True, "key": record}
     return {"success": False, "message": "Key already exists"}
@@ -85,13 +193,43 @@ async def import_keys_csv(
     if not file.filename.endswith(".csv"):
         raise HTTPException(status_code=400, detail="File must be a CSV")
     
-    content = await file.read()
-    text = content.decode("utf-8")
-    
-    keys = []
-    reader = csv.reader(io.StringIO(text))
-    
-    for row in reader:
+    return await key_manager.import_keys(_iter_csv_keys(file))
+
+
+@router.post("/keys/import/text", response_model=dict)
+async def import_keys_text(
+    file: UploadFile = File(...),
+    default_balance: float = 0.24,
+    _: str = Depends(verify_admin_key)
+):
+    """
+    从纯文本文件导入 API Keys (每行一个 key)
+    """
+    return await key_manager.import_keys(_iter_text_keys(file, default_balance))
+
+
+async def _iter_upload_lines(file: UploadFile, chunk_size: int = 64 * 1024) -> AsyncIterator[str]:
+    """按块读取上传文件并逐行返回，不把整个文件读入内存"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    while True:
+        chunk = await file.read(chunk_size)
+        text = decoder.decode(chunk, final=not chunk)
+        if text:
+            lines = (pending + text).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        if not chunk:
+            break
+    if pending:
+        yield pending
+
+
+async def _iter_csv_keys(file: UploadFile) -> AsyncIterator[tuple]:
+    """流式解析 CSV: key,balance (balance 可选，默认为 0.24)"""
+    async for line in _iter_upload_lines(file):
+        row = next(csv.reader([line]), None)
         if not row or row[0].startswith("#"):
             continue
         
@@ -107,33 +245,41 @@ async def import_keys_csv(
             except ValueError:
                 pass
         
-        keys.append((key, balance))
-    
-    result = await key_manager.import_keys(keys)
-    return result
+        yield key, balance
 
 
-@router.post("/keys/import/text", response_model=dict)
-async def import_keys_text(
-    file: UploadFile = File(...),
-    default_balance: float = 0.24,
-    _: str = Depends(verify_admin_key)
-):
-    """
-    从纯文本文件导入 API Keys (每行一个 key)
-    """
-    content = await file.read()
-    text = content.decode("utf-8")
-    
-    keys = []
-    for line in text.strip().split("\n"):
+async def _iter_text_keys(file: UploadFile, default_balance: float) -> AsyncIterator[tuple]:
+    """流式解析纯文本（每行一个 key）"""
+    async for line in _iter_upload_lines(file):
         # 去除所有空格
         key = line.strip().replace(" ", "").replace("\t", "")
         if key and key.startswith("sk-") and not key.startswith("#"):
-            keys.append((key, default_balance))
-    
-    result = await key_manager.import_keys(keys)
-    return result
+            yield key, default_balance
+
+
+@router.post("/keys/{key_id}/sync")
+async def sync_key(
+    key_id: int,
+    _: str = Depends(verify_admin_key)
+):
+    """同步单个 Key 的远程余额"""
+    result = await usage_syncer.sync_key(key_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Key not found")
+    return {"success": result.valid and result.error is None, "result": result}
+
+
+@router.post("/sync")
+async def sync_all_keys(_: str = Depends(verify_admin_key)):
+    """在后台同步所有 Keys 的远程余额"""
+    started = usage_syncer.trigger(force=True)
+    return {"started": started, **usage_syncer.get_status()}
+
+
+@router.get("/sync")
+async def get_sync_status(_: str = Depends(verify_admin_key)):
+    """获取余额同步状态"""
+    return usage_syncer.get_status()
 
 
 @router.delete("/keys/{key_id}")
@@ -142,7 +288,7 @@ async def delete_key(
     _: str = Depends(verify_admin_key)
 ):
     """删除指定的 API Key"""
-    success = await db.delete_key(key_id)
+    success = await key_manager.delete_key(key_id)
     if success:
         return {"success": True}
     raise HTTPException(status_code=404, detail="Key not found")
@@ -156,7 +302,7 @@ async def delete_invalid_keys(_: str = Depends(verify_admin_key)):
     for key in all_keys:
         # 检查是否包含空格或不以 sk- 开头
         if ' ' in key.key or '\t' in key.key or not key.key.startswith('sk-'):
-            await db.delete_key(key.id)
+            await key_manager.delete_key(key.id)
             deleted += 1
     return {"deleted": deleted}
 
@@ -167,6 +313,62 @@ async def get_stats(_: str = Depends(verify_admin_key)):
     return await key_manager.get_stats()
 
 
+@router.get("/upstream/pool")
+async def get_upstream_pool_stats(_: str = Depends(verify_admin_key)):
+    """获取上游连接池使用情况"""
+    return upstream_client.get_stats()
+
+
+@router.get("/cache")
+async def get_response_cache_stats(_: str = Depends(verify_admin_key)):
+    """获取响应缓存命中率及容量"""
+    return response_cache.get_stats()
+
+
+@router.delete("/cache")
+async def clear_response_cache(_: str = Depends(verify_admin_key)):
+    """清空响应缓存"""
+    response_cache.clear()
+    return {"success": True}
+
+
+@router.get("/tracing")
+async def get_tracing_stats(_: str = Depends(verify_admin_key)):
+    """获取请求追踪的导出统计"""
+    return tracer.get_stats()
+
+
+@router.get("/profiler")
+async def get_profiler(_: str = Depends(verify_admin_key)):
+    """获取采样分析器状态及最近的慢请求剖析结果"""
+    return {**profiler.get_status(), "results": list(profiler.profiles)}
+
+
+@router.put("/profiler")
+async def set_profiler(
+    enabled: bool,
+    top_n: Optional[int] = None,
+    interval: Optional[float] = None,
+    _: str = Depends(verify_admin_key)
+):
+    """开启/关闭采样分析器（top_n 为每分钟剖析的最慢请求数，interval 为采样间隔秒数）"""
+    if top_n is not None:
+        top_n = min(max(top_n, 1), 100)
+    if interval is not None:
+        interval = min(max(interval, 0.001), 1.0)
+    if enabled:
+        profiler.enable(top_n, interval)
+    else:
+        profiler.disable()
+    return profiler.get_status()
+
+
+@router.get("/cluster")
+async def get_cluster_status(_: str = Depends(verify_admin_key)):
+    """获取当前 worker 的多进程协调状态"""
+    return cluster.get_stats()
+
+
 @router.get("/pricing", response_model=List[ModelPricing])
 async def list_pricing(_: str = Depends(verify_admin_key)):
     """获取所有模型定价配置"""
@@ -180,6 +382,8 @@ async def add_pricing(
 ):
     """添加模型定价"""
     result = await db.add_pricing(data.model_pattern, data.price_per_request, data.description)
+    await pricing_index.load()
+    await cluster.notify("pricing")
     if result:
         return {"success": True, "pricing": result}
     return {"success": False, "message": "Pattern already exists"}
@@ -193,6 +397,8 @@ async def update_pricing(
 ):
     """更新模型定价"""
     success = await db.update_pricing(pricing_id, data.price_per_request, data.description)
+    await pricing_index.load()
+    await cluster.notify("pricing")
     if success:
         return {"success": True}
     raise HTTPException(status_code=404, detail="Pricing not found")
@@ -205,6 +411,8 @@ async def delete_pricing(
 ):
     """删除模型定价"""
     success = await db.delete_pricing(pricing_id)
+    await pricing_index.load()
+    await cluster.notify("pricing")
     if success:
         return {"success": True}
     raise HTTPException(status_code=404, detail="Pricing not found")
@@ -216,7 +424,7 @@ async def check_model_price(
     _: str = Depends(verify_admin_key)
 ):
     """查询指定模型的价格"""
-    price = await db.get_model_price(model)
+    price = await key_manager.get_model_price(model)
     return {"model": model, "price": price}
 
 
@@ -282,14 +490,29 @@ async def list_tokens(_: str = Depends(verify_admin_key)):
     return await db.get_all_access_tokens()
 
 
+def _check_limits(limits: AccessTokenLimits):
+    if limits.rps_limit < 0 or limits.concurrency_limit < 0 or limits.tpm_limit < 0:
+        raise HTTPException(status_code=400, detail="Limits must be >= 0 (0 means unlimited)")
+
+
+@router.get("/tokens/limits")
+async def get_token_limits(_: str = Depends(verify_admin_key)):
+    """获取当前进程中各访问令牌的限流状态"""
+    return token_limiter.get_stats()
+
+
 @router.post("/tokens", response_model=AccessToken)
 async def create_token(
     data: AccessTokenCreate,
     _: str = Depends(verify_admin_key)
 ):
-    """创建新的对外访问令牌"""
+    """创建新的对外访问令牌（可同时设置限流）"""
+    _check_limits(data)
     token = "sk-ex-" + secrets.token_urlsafe(32)
-    return await db.create_access_token(data.name, token)
+    access_token = await db.create_access_token(data.name, token, data.coalesce, data)
+    token_cache.put(access_token)
+    await cluster.notify("tokens")
+    return access_token
 
 
 @router.put("/tokens/{token_id}/toggle")
@@ -300,11 +523,50 @@ async def toggle_token(
 ):
     """启用/禁用访问令牌"""
     success = await db.toggle_access_token(token_id, enabled)
+    token_cache.invalidate(token_id)
+    await cluster.notify("tokens")
+    if success:
+        return {"success": True}
+    raise HTTPException(status_code=404, detail="Token not found")
+
+
+@router.put("/tokens/{token_id}/coalesce")
+async def set_token_coalesce(
+    token_id: int,
+    enabled: bool,
+    _: str = Depends(verify_admin_key)
+):
+    """开启/关闭令牌的相同请求合并"""
+    success = await db.set_token_coalesce(token_id, enabled)
+    token_cache.invalidate(token_id)
+    await cluster.notify("tokens")
     if success:
         return {"success": True}
     raise HTTPException(status_code=404, detail="Token not found")
 
 
+@router.put("/tokens/{token_id}/limits")
+async def set_token_limits(
+    token_id: int,
+    limits: AccessTokenLimits,
+    _: str = Depends(verify_admin_key)
+):
+    """设置令牌的每秒请求数、并发请求数和每分钟 token 数限制（0 表示不限制）"""
+    _check_limits(limits)
+    success = await db.set_token_limits(token_id, limits)
+    token_cache.invalidate(token_id)
+    await cluster.notify("tokens")
+    if success:
+        return {"success": True}
+    raise HTTPException(status_code=404, detail="Token not found")
+
+
+@router.get("/coalesce")
+async def get_coalesce_stats(_: str = Depends(verify_admin_key)):
+    """获取相同请求合并的统计"""
+    return api_proxy.get_coalesce_stats()
+
+
 @router.delete("/tokens/{token_id}")
 async def delete_token(
     token_id: int,
@@ -312,6 +574,9 @@ async def delete_token(
 ):
     """删除访问令牌"""
     success = await db.delete_access_token(token_id)
+    token_cache.invalidate(token_id)
+    token_limiter.remove(token_id)
+    await cluster.notify("tokens")
     if success:
         return {"success": True}
     raise HTTPException(status_code=404, detail="Token not found")
@@ -0,0 +1,338 @@
+"""
+压测 main:app，输出 JSON 结果便于跟踪性能回归
+
+    # 启动模拟上游和服务（临时数据库），压测后自动关闭
+    python bench/load.py --spawn --requests 5000 --concurrency 64 --stream-ratio 0.3 --latency 0.02
+
+    # 压测已运行的服务（--pid 为服务进程号，用于统计 CPU）
+    python bench/load.py --url http://127.0.0.1:8000 --token sk-ex-... --duration 30 --pid 12345
+
+结果包括 RPS、延迟 p50/p90/p99、流式响应的首字节时间（TTFB）、按状态码统计的错误、
+服务进程（含子进程）每个请求消耗的 CPU 时间，写入 --output（默认 bench/results/<时间>.json）
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+
+from seed import seed
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+
+def percentiles(values: List[float]) -> Optional[dict]:
+    """毫秒为单位的延迟分布"""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(p: float) -> float:
+        return round(values[min(int(len(values) * p), len(values) - 1)] * 1000, 3)
+
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * 1000, 3),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": round(values[-1] * 1000, 3)
+    }
+
+
+def _process_tree(pid: int) -> List[int]:
+    """pid 及其所有子孙进程（读取 /proc，只支持 Linux）"""
+    children: Dict[int, List[int]] = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                # 进程名可能含空格，从最后一个 ) 之后解析
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(name))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def cpu_seconds(pid: Optional[int]) -> Optional[float]:
+    """进程树累计的 user + system CPU 时间，无法读取时返回 None"""
+    if pid is None or not os.path.isdir("/proc"):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0
+    for member in _process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / ticks
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_body(model: str, prompt_bytes: int, stream: bool) -> bytes:
+    content = "x" * prompt_bytes
+    return json.dumps({
+        "model": model,
+        "messages": [{"role": "user", "content": content}],
+        "stream": stream
+    }).encode()
+
+
+class LoadResult:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.stream_latencies: List[float] = []
+        self.ttfb: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.bytes = 0
+
+    def record(self, status: str, latency: float, stream: bool, ttfb: Optional[float], size: int):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += size
+        if status != "200":
+            return
+        (self.stream_latencies if stream else self.latencies).append(latency)
+        if ttfb is not None:
+            self.ttfb.append(ttfb)
+
+
+async def send(client: httpx.AsyncClient, url: str, headers: dict, body: bytes, stream: bool, result: Optional[LoadResult]):
+    started = time.perf_counter()
+    ttfb = None
+    size = 0
+    try:
+        async with client.stream("POST", url, headers=headers, content=body) as response:
+            async for chunk in response.aiter_raw():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                size += len(chunk)
+            status = str(response.status_code)
+            # 流式接口出错时状态码仍为 200，错误在 SSE 数据中
+            if stream and status == "200" and b'"error"' in chunk[:200]:
+                status = "stream_error"
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    if result is not None:
+        result.record(status, time.perf_counter() - started, stream, ttfb if stream else None, size)
+
+
+async def run_load(args, base_url: str, token: str, server_pid: Optional[int]) -> dict:
+    url = f"{base_url.rstrip('/')}/v1/chat/completions"
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    bodies = {
+        False: make_body(args.model, args.prompt_bytes, False),
+        True: make_body(args.model, args.prompt_bytes, True)
+    }
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(120.0)) as client:
+        for _ in range(args.warmup):
+            await send(client, url, headers, bodies[False], False, None)
+
+        result = LoadResult()
+        remaining = args.requests
+        deadline = time.perf_counter() + args.duration if args.duration else None
+
+        async def worker():
+            nonlocal remaining
+            while True:
+                if deadline is not None:
+                    if time.perf_counter() >= deadline:
+                        return
+                else:
+                    if remaining <= 0:
+                        return
+                    remaining -= 1
+                stream = random.random() < args.stream_ratio
+                await send(client, url, headers, bodies[stream], stream, result)
+
+        cpu_before = cpu_seconds(server_pid)
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        cpu_after = cpu_seconds(server_pid)
+
+    total = sum(result.statuses.values())
+    ok = result.statuses.get("200", 0)
+    cpu = None if cpu_before is None or cpu_after is None else cpu_after - cpu_before
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "config": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "token")
+        },
+        "duration": round(elapsed, 3),
+        "requests": total,
+        "ok": ok,
+        "rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "ok_rps": round(ok / elapsed, 2) if elapsed else 0.0,
+        "statuses": result.statuses,
+        "bytes_received": result.bytes,
+        "latency_ms": percentiles(result.latencies + result.stream_latencies),
+        "non_stream_latency_ms": percentiles(result.latencies),
+        "stream_latency_ms": percentiles(result.stream_latencies),
+        "stream_ttfb_ms": percentiles(result.ttfb),
+        "server_cpu_seconds": None if cpu is None else round(cpu, 3),
+        "cpu_ms_per_request": None if cpu is None or not total else round(cpu / total * 1000, 4)
+    }
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready in {timeout}s")
+
+
+def stop(process: Optional[subprocess.Popen]):
+    if process is not None and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def spawn_and_run(args) -> dict:
+    """启动模拟上游和服务（临时数据库），压测后关闭"""
+    mock, server = None, None
+    with tempfile.TemporaryDirectory(prefix="api-exchange-bench-") as tmp:
+        db_path = os.path.join(tmp, "keys.db")
+        seeded = asyncio.run(seed(db_path, args.keys, 1000000.0, 1, prices=(f"{args.model}=0.001",)))
+        try:
+            mock = subprocess.Popen([
+                sys.executable, os.path.join(BENCH_DIR, "mock_upstream.py"),
+                "--port", str(args.mock_port),
+                "--latency", str(args.latency),
+                "--stream-tokens", str(args.stream_tokens),
+                "--token-rate", str(args.token_rate),
+                "--error-rate", str(args.error_rate),
+                "--quota-rate", str(args.quota_rate),
+                "--rate-limit-rate", str(args.rate_limit_rate),
+                "--models", args.model
+            ])
+            mock_url = f"http://127.0.0.1:{args.mock_port}"
+            wait_ready(f"{mock_url}/stats", mock)
+
+            env = {
+                **os.environ,
+                "API_EXCHANGE_DATABASE_PATH": db_path,
+                "API_EXCHANGE_UPSTREAM_BASE_URL": f"{mock_url}/v1",
+                "API_EXCHANGE_USAGE_CHECK_URL": mock_url,
+                "API_EXCHANGE_AUTO_SYNC_USAGE": "false",
+                "API_EXCHANGE_TRACE_EXPORT_PATH": os.path.join(tmp, "traces.jsonl")
+            }
+            if args.workers > 1:
+                env["API_EXCHANGE_WORKER_MODE"] = "multi"
+            for item in args.env:
+                name, _, value = item.partition("=")
+                env[name if name.startswith("API_EXCHANGE_") else f"API_EXCHANGE_{name}"] = value
+
+            server = subprocess.Popen([
+                sys.executable, "-m", "uvicorn", "main:app",
+                "--port", str(args.port),
+                "--workers", str(args.workers),
+                "--log-level", "warning",
+                "--no-access-log"
+            ], cwd=ROOT, env=env)
+            base_url = f"http://127.0.0.1:{args.port}"
+            wait_ready(f"{base_url}/health", server)
+
+            result = asyncio.run(run_load(args, base_url, seeded["tokens"][0], server.pid))
+            result["upstream_calls"] = httpx.get(f"{mock_url}/stats").json()
+            result["prices"] = seeded["prices"]
+            return result
+        finally:
+            stop(server)
+            stop(mock)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for main:app")
+    target = parser.add_argument_group("target")
+    target.add_argument("--url", default="http://127.0.0.1:8000", help="已运行的服务地址")
+    target.add_argument("--token", default="sk-api-exchange-admin", help="访问令牌或管理密钥")
+    target.add_argument("--pid", type=int, help="服务进程号（统计 CPU）")
+    target.add_argument("--spawn", action="store_true", help="启动模拟上游和服务后压测")
+    target.add_argument("--port", type=int, default=8100, help="--spawn 时服务端口")
+    target.add_argument("--workers", type=int, default=1, help="--spawn 时 uvicorn worker 数（>1 时使用多进程模式）")
+    target.add_argument("--keys", type=int, default=1000, help="--spawn 时生成的 Key 数")
+    target.add_argument("--env", action="append", default=[], help="--spawn 时传给服务的配置 NAME=VALUE，可重复")
+
+    load = parser.add_argument_group("load")
+    load.add_argument("--requests", type=int, default=2000, help="请求总数")
+    load.add_argument("--duration", type=float, default=0.0, help="压测时长（秒），设置后忽略 --requests")
+    load.add_argument("--concurrency", type=int, default=32)
+    load.add_argument("--warmup", type=int, default=50, help="不计入结果的预热请求数")
+    load.add_argument("--stream-ratio", type=float, default=0.0, help="流式请求比例")
+    load.add_argument("--model", default="gpt-4o-mini")
+    load.add_argument("--prompt-bytes", type=int, default=256, help="每个请求的消息长度")
+
+    mock = parser.add_argument_group("mock upstream (--spawn)")
+    mock.add_argument("--mock-port", type=int, default=9999)
+    mock.add_argument("--latency", type=float, default=0.0)
+    mock.add_argument("--stream-tokens", type=int, default=20)
+    mock.add_argument("--token-rate", type=float, default=0.0)
+    mock.add_argument("--error-rate", type=float, default=0.0)
+    mock.add_argument("--quota-rate", type=float, default=0.0)
+    mock.add_argument("--rate-limit-rate", type=float, default=0.0)
+
+    parser.add_argument("--output", help="结果文件，默认 bench/results/<时间>.json")
+    args = parser.parse_args()
+
+    if args.spawn:
+        result = spawn_and_run(args)
+    else:
+        result = asyncio.run(run_load(args, args.url, args.token, args.pid))
+
+    output = args.output or os.path.join(BENCH_DIR, "results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+
+    latency = result["latency_ms"] or {}
+    ttfb = result["stream_ttfb_ms"] or {}
+    print(
+        f"{result['requests']} requests in {result['duration']}s: {result['rps']} rps, "
+        f"p50 {latency.get('p50')} ms, p99 {latency.get('p99')} ms, "
+        f"stream ttfb p50 {ttfb.get('p50')} ms, cpu/request {result['cpu_ms_per_request']} ms, "
+        f"statuses {result['statuses']}"
+    )
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+本地模拟的 OpenAI 兼容上游，用于压测
+
+    python bench/mock_upstream.py --port 9999 --latency 0.05 --stream-tokens 50 --token-rate 200
+
+- 非流式请求等待 --latency 秒后返回
+- 流式请求等待 --latency 秒后按 --token-rate（每秒 token 数）发送 --stream-tokens 个 token
+- Key 中包含 invalid 时返回 401，包含 quota 时返回额度耗尽的 429
+- 按比例随机注入错误：--error-rate（500）、--quota-rate（额度耗尽 429）、--rate-limit-rate（带 Retry-After 的 429）
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+app = FastAPI()
+
+options = argparse.Namespace(
+    latency=0.0,
+    stream_tokens=20,
+    token_rate=0.0,
+    error_rate=0.0,
+    quota_rate=0.0,
+    rate_limit_rate=0.0,
+    models="gpt-4o-mini,gpt-4o"
+)
+calls = {"chat": 0, "stream": 0, "errors": 0}
+
+
+def _error(status: int, message: str, code: str, headers: dict = None) -> JSONResponse:
+    calls["errors"] += 1
+    return JSONResponse(
+        {"error": {"message": message, "type": code, "code": code}},
+        status_code=status,
+        headers=headers
+    )
+
+
+def _injected_error(auth: str):
+    if "invalid" in auth:
+        return _error(401, "Invalid API key provided", "invalid_api_key")
+    if "quota" in auth:
+        return _error(429, "You exceeded your current quota", "insufficient_quota")
+    roll = random.random()
+    if roll < options.error_rate:
+        return _error(500, "The server had an error while processing your request", "server_error")
+    roll -= options.error_rate
+    if roll < options.quota_rate:
+        return _error(429, "You exceeded your current quota", "insufficient_quota")
+    roll -= options.quota_rate
+    if roll < options.rate_limit_rate:
+        return _error(429, "Rate limit reached for requests", "rate_limit_exceeded", {"Retry-After": "1"})
+    return None
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = json.loads(await request.body())
+    error = _injected_error(request.headers.get("authorization", ""))
+    if error is not None:
+        return error
+
+    if options.latency:
+        await asyncio.sleep(options.latency)
+
+    model = body.get("model", "")
+    created = int(time.time())
+    completion_id = f"chatcmpl-{random.getrandbits(64):016x}"
+    prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4 + 1
+
+    if body.get("stream"):
+        calls["stream"] += 1
+
+        async def generate():
+            interval = 1.0 / options.token_rate if options.token_rate else 0.0
+            for i in range(options.stream_tokens):
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": f"tok{i} "}, "finish_reason": None}]
+                }
+                yield f"data: {json.dumps(chunk)}\n\n".encode()
+                if interval:
+                    await asyncio.sleep(interval)
+            final = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": options.stream_tokens,
+                    "total_tokens": prompt_tokens + options.stream_tokens
+                }
+            }
+            yield f"data: {json.dumps(final)}\n\n".encode()
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    calls["chat"] += 1
+    content = " ".join(f"tok{i}" for i in range(options.stream_tokens))
+    return Response(
+        content=json.dumps({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": options.stream_tokens,
+                "total_tokens": prompt_tokens + options.stream_tokens
+            }
+        }),
+        media_type="application/json"
+    )
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {
+        "object": "list",
+        "data": [{"id": name, "object": "model", "owned_by": "mock"} for name in options.models.split(",")]
+    }
+
+
+@app.get("/dashboard/billing/subscription")
+async def billing_subscription(request: Request):
+    if "invalid" in request.headers.get("authorization", ""):
+        return _error(401, "Invalid API key provided", "invalid_api_key")
+    return {"hard_limit_usd": 1000000.0}
+
+
+@app.get("/dashboard/billing/usage")
+async def billing_usage():
+    return {"total_usage": 0.0}
+
+
+@app.get("/stats")
+async def stats():
+    return calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--latency", type=float, default=0.0, help="响应前的延迟（秒）")
+    parser.add_argument("--stream-tokens", type=int, default=20, help="每个响应的 token 数")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="流式响应每秒 token 数，0 表示不限速")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的比例")
+    parser.add_argument("--quota-rate", type=float, default=0.0, help="返回额度耗尽 429 的比例")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="返回限流 429 的比例")
+    parser.add_argument("--models", default=options.models, help="/v1/models 返回的模型（逗号分隔）")
+    args = parser.parse_args()
+    for name in vars(options):
+        setattr(options, name, getattr(args, name))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
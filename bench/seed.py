@@ -0,0 +1,108 @@
+"""
+为压测生成 Key、访问令牌和定价
+
+    python bench/seed.py --db keys.db --keys 1000 --balance 1000 --tokens 1 --price "gpt-4o*=0.01"
+
+Key 格式为 sk-bench-000001，--invalid / --quota 额外生成会被模拟上游拒绝的 Key。
+--price 规则排在已有规则（包括默认的 * 规则）之前，写入后按定价索引核对实际生效的价格。
+以 JSON 输出生成的访问令牌
+"""
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def seed(
+    db_path: str,
+    keys: int,
+    balance: float,
+    tokens: int = 1,
+    invalid: int = 0,
+    quota: int = 0,
+    prices: tuple = ()
+) -> dict:
+    """写入 db_path，返回 {"keys": 插入的 Key 数, "tokens": [访问令牌], "prices": {模型: 生效价格}}"""
+    os.environ["API_EXCHANGE_DATABASE_PATH"] = db_path
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    from database import Database
+    from pricing import PricingIndex
+
+    db = Database()
+    await db.connect()
+    try:
+        rows = [(f"sk-bench-{i:06d}", balance) for i in range(1, keys + 1)]
+        rows += [(f"sk-bench-invalid-{i:06d}", balance) for i in range(1, invalid + 1)]
+        rows += [(f"sk-bench-quota-{i:06d}", balance) for i in range(1, quota + 1)]
+        inserted = 0
+        for start in range(0, len(rows), 1000):
+            inserted += await db.add_keys_batch(rows[start:start + 1000])
+
+        rules = []
+        for item in prices:
+            pattern, _, price = item.partition("=")
+            rules.append((pattern, float(price)))
+        effective = {}
+        if rules:
+            effective = await _apply_prices(db, rules, PricingIndex())
+
+        created = []
+        for i in range(tokens):
+            token = "sk-ex-" + secrets.token_urlsafe(32)
+            await db.create_access_token(f"bench-{i + 1}", token)
+            created.append(token)
+    finally:
+        await db.disconnect()
+    return {"keys": inserted, "tokens": created, "prices": effective}
+
+
+async def _apply_prices(db, rules: list, index) -> dict:
+    """
+    定价按 id 顺序匹配（先匹配的优先），新规则直接追加会被默认的 * 规则挡住，
+    因此先删除已有规则，写入压测规则后再按原顺序写回（同名规则以压测的为准）
+    """
+    existing = await db.get_all_pricing()
+    patterns = {pattern for pattern, _ in rules}
+    for rule in existing:
+        await db.delete_pricing(rule.id)
+    for pattern, price in rules:
+        await db.add_pricing(pattern, price, "bench")
+    for rule in existing:
+        if rule.model_pattern not in patterns:
+            await db.add_pricing(rule.model_pattern, rule.price_per_request, rule.description)
+
+    # 按服务实际使用的定价索引核对：每条规则取一个匹配它的模型名查价格
+    index.build([(p.model_pattern, p.price_per_request) for p in await db.get_all_pricing()])
+    effective = {}
+    for pattern, price in rules:
+        # 含 [...] 的规则不容易构造匹配的模型名，不核对
+        if "[" in pattern:
+            continue
+        model = pattern.replace("*", "").replace("?", "x")
+        effective[model] = index.get_price(model)
+        if effective[model] != price:
+            raise RuntimeError(f"price rule {pattern}={price} is shadowed: {model} costs {effective[model]}")
+    return effective
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed keys.db for benchmarks")
+    parser.add_argument("--db", default="keys.db", help="数据库路径")
+    parser.add_argument("--keys", type=int, default=1000, help="可用 Key 数")
+    parser.add_argument("--balance", type=float, default=1000.0, help="每个 Key 的余额")
+    parser.add_argument("--tokens", type=int, default=1, help="生成的访问令牌数")
+    parser.add_argument("--invalid", type=int, default=0, help="模拟上游返回 401 的 Key 数")
+    parser.add_argument("--quota", type=int, default=0, help="模拟上游返回额度耗尽的 Key 数")
+    parser.add_argument("--price", action="append", default=[], help="模型定价 pattern=price，可重复")
+    args = parser.parse_args()
+    result = asyncio.run(seed(args.db, args.keys, args.balance, args.tokens, args.invalid, args.quota, tuple(args.price)))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import time
+from typing import Dict, List
+
+from config import get_settings
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class _Breaker:
+    __slots__ = ("state", "failures", "opened_at", "open_until", "cooldown", "trial_started", "last_error")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.open_until = 0.0
+        self.cooldown = 0.0
+        self.trial_started = 0.0
+        self.last_error = ""
+
+
+class KeyBreakers:
+    """
+    每个 Key 的熔断器（进程内）
+    - closed:    正常参与选择；连续 breaker_failure_threshold 次临时故障后打开
+    - open:      冷却 breaker_cooldown 秒内不参与选择
+    - half_open: 冷却结束后放行一个试探请求，成功则关闭，失败则重新打开并把冷却时间加倍（不超过 breaker_max_cooldown）
+    只保存最近失败过的 Key（成功后删除），其余 Key 检查时只是一次字典查询
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._breakers: Dict[int, _Breaker] = {}
+        self.opened = 0
+
+    def blocked(self, key_id: int) -> bool:
+        """Key 是否暂时不能被选择（不改变状态）"""
+        breaker = self._breakers.get(key_id)
+        if breaker is None or breaker.state == CLOSED:
+            return False
+        now = time.monotonic()
+        if breaker.state == OPEN:
+            return now < breaker.open_until
+        # 半开状态只放行一个试探请求，试探请求超过冷却时间仍未返回结果时再放行一个
+        return now - breaker.trial_started < max(breaker.cooldown, 1.0)
+
+    def blocked_ids(self) -> List[int]:
+        return [key_id for key_id in self._breakers if self.blocked(key_id)]
+
+    def on_selected(self, key_id: int):
+        """Key 被选中：冷却结束的 Key 进入半开状态，本次请求作为试探"""
+        breaker = self._breakers.get(key_id)
+        if breaker is not None and breaker.state != CLOSED and not self.blocked(key_id):
+            breaker.state = HALF_OPEN
+            breaker.trial_started = time.monotonic()
+
+    def record_success(self, key_id: int):
+        if key_id in self._breakers:
+            del self._breakers[key_id]
+
+    def record_failure(self, key_id: int, error: str = ""):
+        """记录一次临时故障，连续失败达到阈值或半开试探失败时打开"""
+        breaker = self._breakers.get(key_id)
+        if breaker is None:
+            breaker = self._breakers[key_id] = _Breaker()
+        breaker.failures += 1
+        breaker.last_error = error[:200]
+        if breaker.state == HALF_OPEN:
+            cooldown = max(breaker.cooldown * 2, self.settings.breaker_cooldown)
+            self._open(breaker, min(cooldown, self.settings.breaker_max_cooldown))
+        elif breaker.state == CLOSED and breaker.failures >= self.settings.breaker_failure_threshold:
+            self._open(breaker, self.settings.breaker_cooldown)
+
+    def _open(self, breaker: _Breaker, cooldown: float):
+        now = time.monotonic()
+        if breaker.state != OPEN:
+            self.opened += 1
+        breaker.state = OPEN
+        breaker.opened_at = now
+        breaker.cooldown = max(cooldown, 1.0)
+        breaker.open_until = max(breaker.open_until, now + cooldown)
+
+    def reset(self, key_id: int) -> bool:
+        return self._breakers.pop(key_id, None) is not None
+
+    def remove(self, key_id: int):
+        self._breakers.pop(key_id, None)
+
+    def get_state(self, key_id: int) -> str:
+        breaker = self._breakers.get(key_id)
+        if breaker is None:
+            return CLOSED
+        if breaker.state == OPEN and time.monotonic() >= breaker.open_until:
+            return HALF_OPEN
+        return breaker.state
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        keys = [
+            {
+                "key_id": key_id,
+                "state": self.get_state(key_id),
+                "failures": breaker.failures,
+                "retry_in": round(max(breaker.open_until - now, 0.0), 3),
+                "last_error": breaker.last_error
+            }
+            for key_id, breaker in self._breakers.items()
+        ]
+        return {
+            "open": sum(1 for k in keys if k["state"] == OPEN),
+            "half_open": sum(1 for k in keys if k["state"] == HALF_OPEN),
+            "tracked": len(keys),
+            "opened_total": self.opened,
+            "keys": keys
+        }
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import secrets
+from typing import Dict, Optional
+
+from config import get_settings
+from database import db
+from pricing import pricing_index
+from token_cache import token_cache
+
+
+class Cluster:
+    """
+    多进程部署（worker_mode=multi）时的进程间协调
+    - 管理操作修改定价或访问令牌后递增数据库中的版本号（notify），
+      各进程每 worker_sync_interval 秒检查一次，发现变化后重新加载本进程的缓存
+    - 只需一个进程执行的后台任务通过数据库租约选出执行者（try_lead）
+    单进程模式下不做任何事
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.worker_id = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self._versions: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.reloads = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.worker_mode == "multi"
+
+    async def start(self):
+        """启动版本号轮询（由 main.lifespan 调用）"""
+        if self.enabled and self._task is None:
+            self._versions = await db.get_versions()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def notify(self, name: str):
+        """通知其他进程 name 对应的数据已修改（本进程的缓存由调用方自行更新）"""
+        if not self.enabled:
+            return
+        await db.bump_version(name)
+        self._versions[name] = self._versions.get(name, 0) + 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.settings.worker_sync_interval)
+            try:
+                await self._poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+
+    async def _poll(self):
+        versions = await db.get_versions()
+        for name, version in versions.items():
+            if self._versions.get(name) != version:
+                await self._reload(name)
+                self._versions[name] = version
+
+    async def _reload(self, name: str):
+        self.reloads += 1
+        if name == "pricing":
+            await pricing_index.load()
+        elif name == "tokens":
+            token_cache.clear()
+
+    async def try_lead(self, name: str, ttl: float) -> bool:
+        """获取或续期后台任务 name 的租约，单进程模式下总是返回 True"""
+        if not self.enabled:
+            return True
+        return await db.try_acquire_lock(name, self.worker_id, ttl)
+
+    def get_stats(self) -> dict:
+        return {
+            "mode": self.settings.worker_mode,
+            "worker_id": self.worker_id,
+            "versions": dict(self._versions),
+            "reloads": self.reloads
+        }
+
+
+cluster = Cluster()
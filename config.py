@@ -18,15 +18,132 @@ class Settings(BaseSettings):
     
     # 数据库配置
     database_path: str = "keys.db"
+    db_journal_mode: str = "WAL"
+    db_synchronous: str = "NORMAL"
+    # 页缓存大小（负数表示 KiB）
+    db_cache_size: int = -65536
+    db_mmap_size: int = 268435456
+    db_busy_timeout: int = 5000
+    # 只读连接池大小（查询使用，写操作走唯一的写连接）
+    db_read_pool_size: int = 4
     
-    # 请求超时（秒）
+    # 批量导入时每个事务写入的 Key 数
+    import_batch_size: int = 1000
+    
+    # 请求超时（秒，上游读取超时）
     request_timeout: float = 120.0
     
+    # 上游连接池配置
+    upstream_max_connections: int = 200
+    upstream_max_keepalive_connections: int = 50
+    upstream_keepalive_expiry: float = 30.0
+    upstream_connect_timeout: float = 10.0
+    # 启用 HTTP/2（需要 pip install httpx[http2]）
+    upstream_http2: bool = False
+    
+    # 扣费/使用计数写回模式：batch（批量写回）或 sync（每次立即写入）
+    write_behind_mode: str = "batch"
+    # 批量写回的刷新间隔（秒）及崩溃时最多丢失的记账上限
+    write_behind_interval: float = 1.0
+    write_behind_max_pending: int = 500
+    write_behind_max_amount: float = 10.0
+    
+    # 访问令牌验证缓存
+    token_cache_ttl: float = 60.0
+    token_cache_negative_ttl: float = 5.0
+    token_cache_max_size: int = 10000
+    
+    # 模型价格查询缓存的最大模型数
+    pricing_cache_size: int = 1024
+    
+    # Key 选择策略：round_robin / least_inflight / p2c
+    key_selection_strategy: str = "round_robin"
+    # 单个 Key 的最大并发请求数（0 表示不限制）
+    key_max_concurrency: int = 0
+    
+    # 余额预留超时（秒），超时未结算的预留会被释放
+    reservation_timeout: float = 600.0
+    
+    # 熔断：Key 连续临时故障（5xx、超时）达到次数后暂停选择，冷却时间（秒）在半开试探失败时加倍
+    breaker_failure_threshold: int = 3
+    breaker_cooldown: float = 30.0
+    breaker_max_cooldown: float = 600.0
+    
+    # Key 请求限额：从上游限额响应头和 429 中学习，令牌用完或冷却中的 Key 暂停选择
+    key_rate_limit_enabled: bool = True
+    # 限额的时间窗口（秒），上游按每分钟请求数限制时为 60
+    key_rate_limit_window: float = 60.0
+    # 429 没有 Retry-After 时的冷却时间（秒）
+    key_rate_limit_cooldown: float = 30.0
+    # 从 429 估算的限额有效期（秒），过期后重新学习
+    key_rate_limit_ttl: float = 600.0
+    # 没有可用 Key 但有 Key 即将恢复时，最多等待的秒数
+    key_rate_limit_max_wait: float = 1.0
+    
+    # 响应缓存：缓存 temperature=0 的非流式响应，命中时不请求上游、不扣费
+    response_cache_enabled: bool = False
+    response_cache_ttl: float = 300.0
+    # 内存层最大字节数
+    response_cache_max_bytes: int = 67108864
+    # 磁盘层目录（留空不启用，多个 worker 可共享）及最大字节数
+    response_cache_dir: str = ""
+    response_cache_disk_max_bytes: int = 536870912
+    
+    # /v1/models 缓存时间（秒），过期后 models_cache_stale 秒内先返回旧列表并在后台刷新
+    models_cache_ttl: float = 300.0
+    models_cache_stale: float = 3600.0
+    
+    # 相同请求合并：相同的并发非流式请求只请求一次上游（需要在访问令牌上开启）
+    coalesce_enabled: bool = False
+    # 等待第一个请求结果的最长时间（秒），超时后自行请求
+    coalesce_max_wait: float = 30.0
+    # 使用管理密钥的请求是否合并
+    coalesce_admin_key: bool = False
+    
+    # 透传模式：不用 pydantic 解析完整请求体，只扫描顶层的 model / stream，原始字节直接转发上游
+    passthrough_enabled: bool = False
+    # 非流式响应边收边转发给客户端，不在内存中保留完整响应（不适用于缓存、对冲和合并的请求）
+    upstream_stream_through: bool = False
+    
+    # 是否开放 /metrics（Prometheus 指标，需要管理员密钥）
+    metrics_enabled: bool = False
+    
+    # 请求追踪：记录每个请求的各阶段 span，以 OTLP/JSON 格式导出
+    tracing_enabled: bool = False
+    # 导出比例；慢于 trace_slow_threshold 秒的请求总是导出
+    trace_sample_rate: float = 0.01
+    trace_slow_threshold: float = 1.0
+    # 导出到文件（每行一个 OTLP/JSON 批次），设置 trace_export_url 时改为发送到 OTLP/HTTP 收集器
+    trace_export_path: str = "traces.jsonl"
+    trace_export_url: str = ""
+    # 采样分析器：启动时是否开启（运行时可通过 /admin/profiler 开关）、每分钟剖析最慢的请求数、采样间隔（秒）
+    profiler_enabled: bool = False
+    profiler_top_n: int = 5
+    profiler_interval: float = 0.01
+    
+    # 运行模式：single（单进程，Key 池在内存中）或 multi（uvicorn --workers N，Key 在数据库中原子预留）
+    worker_mode: str = "single"
+    # 多进程模式下检查其他进程管理操作（定价、访问令牌修改）的间隔（秒）
+    worker_sync_interval: float = 1.0
+    
+    # 对冲请求：主请求超过延迟仍未返回时用另一个 Key 发送副本，只对成功的一方扣费
+    hedge_enabled: bool = False
+    # 启用对冲的模型（逗号分隔的通配符）
+    hedge_models: str = "*"
+    # 对冲延迟（秒），0 表示使用观测到的 p95 响应时间
+    hedge_delay: float = 0.0
+    hedge_min_delay: float = 0.5
+    # 对冲请求占比上限
+    hedge_max_ratio: float = 0.1
+    
     # 是否启用自动用量同步
     auto_sync_usage: bool = True
     
     # 用量同步间隔（秒）
     sync_interval: int = 300
+    # 余额查询并发数及每批写入的 Key 数
+    sync_concurrency: int = 8
+    sync_batch_size: int = 200
     
     class Config:
         env_file = ".env"
@@ -1,104 +1,305 @@
+import asyncio
+import functools
+import inspect
+import json
+import os
+import time
+import urllib.parse
 import aiosqlite
-import fnmatch
-from typing import List, Optional
+from typing import List, Optional, Sequence, Tuple
 from datetime import datetime
 from contextlib import asynccontextmanager
 
-from models import APIKeyRecord, KeyStatus, APIKeyStats, ModelPricing, AccessToken
+from models import APIKeyRecord, KeyStatus, APIKeyStats, ModelPricing, AccessToken, AccessTokenLimits
 from config import get_settings
+from metrics import metrics
+from tracing import tracer
+
+# 管理后台 Key 列表可排序的列（均为非空列，配合 id 组成唯一的游标）
+KEY_SORT_COLUMNS = ("created_at", "id", "balance", "used_amount", "request_count")
 
 
 class Database:
+    """
+    SQLite 存储层
+    - 启用 WAL，读写互不阻塞
+    - 所有写操作通过唯一的写连接，按到达顺序排队执行（get_connection）
+    - 查询使用只读连接池（read_connection），管理后台的统计查询不会阻塞请求路径上的写入
+    """
+    
     def __init__(self, db_path: str = None):
-        self.db_path = db_path or get_settings().database_path
+        self.settings = get_settings()
+        self.db_path = db_path or self.settings.database_path
         self._connection: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: List[aiosqlite.Connection] = []
+        self._reader_queue: Optional[asyncio.Queue] = None
+    
+    @property
+    def _in_memory(self) -> bool:
+        return self.db_path == ":memory:" or self.db_path.startswith("file::memory:")
+    
+    async def _apply_pragmas(self, conn: aiosqlite.Connection):
+        await conn.execute(f"PRAGMA busy_timeout = {int(self.settings.db_busy_timeout)}")
+        await conn.execute(f"PRAGMA cache_size = {int(self.settings.db_cache_size)}")
+        await conn.execute(f"PRAGMA mmap_size = {int(self.settings.db_mmap_size)}")
     
     async def connect(self):
-        """建立数据库连接"""
+        """建立写连接、初始化表并创建只读连接池"""
         self._connection = await aiosqlite.connect(self.db_path)
         self._connection.row_factory = aiosqlite.Row
+        await self._apply_pragmas(self._connection)
+        if not self._in_memory:
+            await self._connection.execute(f"PRAGMA journal_mode = {self.settings.db_journal_mode}")
+        await self._connection.execute(f"PRAGMA synchronous = {self.settings.db_synchronous}")
         await self._init_tables()
+        
+        self._reader_queue = asyncio.Queue()
+        if not self._in_memory:
+            uri = f"file:{urllib.parse.quote(os.path.abspath(self.db_path))}?mode=ro"
+            for _ in range(self.settings.db_read_pool_size):
+                reader = await aiosqlite.connect(uri, uri=True)
+                reader.row_factory = aiosqlite.Row
+                await self._apply_pragmas(reader)
+                await reader.execute("PRAGMA query_only = 1")
+                self._readers.append(reader)
+                self._reader_queue.put_nowait(reader)
     
     async def disconnect(self):
-        """关闭数据库连接"""
+        """关闭所有数据库连接"""
+        for reader in self._readers:
+            await reader.close()
+        self._readers = []
+        self._reader_queue = None
         if self._connection:
             await self._connection.close()
             self._connection = None
     
     @asynccontextmanager
     async def get_connection(self):
-        """获取数据库连接的上下文管理器"""
+        """获取写连接（写操作排队串行执行，每个事务独占写连接）"""
+        if not self._connection:
+            await self.connect()
+        started = time.perf_counter()
+        async with self._write_lock:
+            metrics.db_lock_wait_seconds.observe(time.perf_counter() - started)
+            yield self._connection
+    
+    @asynccontextmanager
+    async def read_connection(self):
+        """从只读连接池获取连接，没有只读连接时（如内存数据库）使用写连接"""
         if not self._connection:
             await self.connect()
-        yield self._connection
+        if not self._readers:
+            async with self.get_connection() as conn:
+                yield conn
+            return
+        reader = await self._reader_queue.get()
+        try:
+            yield reader
+        finally:
+            self._reader_queue.put_nowait(reader)
     
     async def _init_tables(self):
-        """初始化数据库表"""
-        async with self.get_connection() as conn:
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS api_keys (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    key TEXT UNIQUE NOT NULL,
-                    balance REAL DEFAULT 0.24,
-                    initial_balance REAL DEFAULT 0.24,
-                    used_amount REAL DEFAULT 0,
-                    request_count INTEGER DEFAULT 0,
-                    status TEXT DEFAULT 'active',
-                    last_used TIMESTAMP,
-                    last_synced TIMESTAMP,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_status ON api_keys(status)
-            """)
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_balance ON api_keys(balance)
-            """)
-            
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS model_pricing (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    model_pattern TEXT UNIQUE NOT NULL,
-                    price_per_request REAL DEFAULT 0.08,
-                    description TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            cursor = await conn.execute("SELECT COUNT(*) FROM model_pricing")
-            count = (await cursor.fetchone())[0]
-            if count == 0:
-                default_pricing = [
-                    ("gemini-3-pro-*", 0.08, "Gemini 3 Pro 系列"),
-                    ("gemini-3-flash-*", 0.05, "Gemini 3 Flash 系列"),
-                    ("gemini-2.5-pro-*", 0.07, "Gemini 2.5 Pro 系列"),
-                    ("gemini-2.5-flash-*", 0.04, "Gemini 2.5 Flash 系列"),
-                    ("claude-opus-*", 0.12, "Claude Opus 系列"),
-                    ("claude-sonnet-*", 0.08, "Claude Sonnet 系列"),
-                    ("GPT-5*", 0.10, "GPT-5 系列"),
-                    ("DeepSeek-R1*", 0.06, "DeepSeek R1 推理模型"),
-                    ("DeepSeek-V*", 0.05, "DeepSeek V 系列"),
-                    ("*", 0.08, "默认价格（其他模型）"),
-                ]
-                await conn.executemany(
-                    "INSERT INTO model_pricing (model_pattern, price_per_request, description) VALUES (?, ?, ?)",
-                    default_pricing
-                )
-            
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS access_tokens (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    token TEXT UNIQUE NOT NULL,
-                    enabled INTEGER DEFAULT 1,
-                    request_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_used TIMESTAMP
-                )
-            """)
-            
-            await conn.commit()
+        """初始化数据库表（多进程同时启动时由 BEGIN IMMEDIATE 串行化）"""
+        conn = self._connection
+        await conn.execute("BEGIN IMMEDIATE")
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS api_keys (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT UNIQUE NOT NULL,
+                balance REAL DEFAULT 0.24,
+                initial_balance REAL DEFAULT 0.24,
+                used_amount REAL DEFAULT 0,
+                request_count INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'active',
+                last_used TIMESTAMP,
+                last_synced TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_status ON api_keys(status)
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_balance ON api_keys(balance)
+        """)
+        # 管理后台分页：按创建时间排序，可带状态过滤
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_created_at ON api_keys(created_at)
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_status_created ON api_keys(status, created_at)
+        """)
+
+        # 多进程模式下的 Key 预留：reserved/inflight 为未结算的预留合计，
+        # key_leases 记录每个预留，超时未结算的由任意进程回收
+        await self._ensure_columns(conn, "api_keys", {
+            "reserved": "REAL NOT NULL DEFAULT 0",
+            "inflight": "INTEGER NOT NULL DEFAULT 0",
+            "last_claimed": "REAL"
+        })
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_status_claimed ON api_keys(status, last_claimed)
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS key_leases (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key_id INTEGER NOT NULL,
+                amount REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_lease_expires ON key_leases(expires_at)
+        """)
+        # 各进程内存缓存的版本号，管理操作修改数据后递增，其他进程轮询发现变化后重新加载
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        # 只需一个进程执行的后台任务（如定时余额同步）的租约
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS worker_locks (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+
+        # Key 统计汇总表（单行），由触发器在增删改时增量维护，统计查询不再扫描全表
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS key_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total_keys INTEGER NOT NULL DEFAULT 0,
+                active_keys INTEGER NOT NULL DEFAULT 0,
+                exhausted_keys INTEGER NOT NULL DEFAULT 0,
+                invalid_keys INTEGER NOT NULL DEFAULT 0,
+                total_balance REAL NOT NULL DEFAULT 0,
+                total_used REAL NOT NULL DEFAULT 0,
+                total_requests INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        await conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_key_stats_insert AFTER INSERT ON api_keys
+            BEGIN
+                UPDATE key_stats SET
+                    total_keys = total_keys + 1,
+                    active_keys = active_keys + (NEW.status IS 'active'),
+                    exhausted_keys = exhausted_keys + (NEW.status IS 'exhausted'),
+                    invalid_keys = invalid_keys + (NEW.status IS 'invalid'),
+                    total_balance = total_balance + IFNULL(NEW.balance, 0),
+                    total_used = total_used + IFNULL(NEW.used_amount, 0),
+                    total_requests = total_requests + IFNULL(NEW.request_count, 0)
+                WHERE id = 1;
+            END
+        """)
+        await conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_key_stats_delete AFTER DELETE ON api_keys
+            BEGIN
+                UPDATE key_stats SET
+                    total_keys = total_keys - 1,
+                    active_keys = active_keys - (OLD.status IS 'active'),
+                    exhausted_keys = exhausted_keys - (OLD.status IS 'exhausted'),
+                    invalid_keys = invalid_keys - (OLD.status IS 'invalid'),
+                    total_balance = total_balance - IFNULL(OLD.balance, 0),
+                    total_used = total_used - IFNULL(OLD.used_amount, 0),
+                    total_requests = total_requests - IFNULL(OLD.request_count, 0)
+                WHERE id = 1;
+            END
+        """)
+        await conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_key_stats_update
+            AFTER UPDATE OF status, balance, used_amount, request_count ON api_keys
+            BEGIN
+                UPDATE key_stats SET
+                    active_keys = active_keys + (NEW.status IS 'active') - (OLD.status IS 'active'),
+                    exhausted_keys = exhausted_keys + (NEW.status IS 'exhausted') - (OLD.status IS 'exhausted'),
+                    invalid_keys = invalid_keys + (NEW.status IS 'invalid') - (OLD.status IS 'invalid'),
+                    total_balance = total_balance + IFNULL(NEW.balance, 0) - IFNULL(OLD.balance, 0),
+                    total_used = total_used + IFNULL(NEW.used_amount, 0) - IFNULL(OLD.used_amount, 0),
+                    total_requests = total_requests + IFNULL(NEW.request_count, 0) - IFNULL(OLD.request_count, 0)
+                WHERE id = 1;
+            END
+        """)
+        # 启动时全量重算一次，消除浮点累计误差，并兼容升级前的数据库
+        await conn.execute("""
+            INSERT OR REPLACE INTO key_stats
+                (id, total_keys, active_keys, exhausted_keys, invalid_keys, total_balance, total_used, total_requests)
+            SELECT
+                1,
+                COUNT(*),
+                IFNULL(SUM(status = 'active'), 0),
+                IFNULL(SUM(status = 'exhausted'), 0),
+                IFNULL(SUM(status = 'invalid'), 0),
+                IFNULL(SUM(balance), 0),
+                IFNULL(SUM(used_amount), 0),
+                IFNULL(SUM(request_count), 0)
+            FROM api_keys
+        """)
+        
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS model_pricing (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                model_pattern TEXT UNIQUE NOT NULL,
+                price_per_request REAL DEFAULT 0.08,
+                description TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        cursor = await conn.execute("SELECT COUNT(*) FROM model_pricing")
+        count = (await cursor.fetchone())[0]
+        if count == 0:
+            default_pricing = [
+                ("gemini-3-pro-*", 0.08, "Gemini 3 Pro 系列"),
+                ("gemini-3-flash-*", 0.05, "Gemini 3 Flash 系列"),
+                ("gemini-2.5-pro-*", 0.07, "Gemini 2.5 Pro 系列"),
+                ("gemini-2.5-flash-*", 0.04, "Gemini 2.5 Flash 系列"),
+                ("claude-opus-*", 0.12, "Claude Opus 系列"),
+                ("claude-sonnet-*", 0.08, "Claude Sonnet 系列"),
+                ("GPT-5*", 0.10, "GPT-5 系列"),
+                ("DeepSeek-R1*", 0.06, "DeepSeek R1 推理模型"),
+                ("DeepSeek-V*", 0.05, "DeepSeek V 系列"),
+                ("*", 0.08, "默认价格（其他模型）"),
+            ]
+            await conn.executemany(
+                "INSERT INTO model_pricing (model_pattern, price_per_request, description) VALUES (?, ?, ?)",
+                default_pricing
+            )
+        
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS access_tokens (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                token TEXT UNIQUE NOT NULL,
+                enabled INTEGER DEFAULT 1,
+                request_count INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used TIMESTAMP
+            )
+        """)
+        # 按令牌开启的相同请求合并
+        await self._ensure_columns(conn, "access_tokens", {
+            "coalesce": "INTEGER NOT NULL DEFAULT 0",
+            # 按令牌限流（0 表示不限制）
+            "rps_limit": "REAL NOT NULL DEFAULT 0",
+            "concurrency_limit": "INTEGER NOT NULL DEFAULT 0",
+            "tpm_limit": "INTEGER NOT NULL DEFAULT 0"
+        })
+        
+        await conn.commit()
+    
+    @staticmethod
+    async def _ensure_columns(conn: aiosqlite.Connection, table: str, columns: dict):
+        """为旧数据库补充新增的列"""
+        cursor = await conn.execute(f"PRAGMA table_info({table})")
+        existing = {row["name"] for row in await cursor.fetchall()}
+        for name, definition in columns.items():
+            if name not in existing:
+                await conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
     
     async def add_key(self, key: str, balance: float = 0.24) -> Optional[APIKeyRecord]:
         """添加新的 API Key"""
@@ -112,32 +313,55 @@ class Database:
                     (key, balance, balance)
                 )
                 await conn.commit()
-                return await self.get_key_by_id(cursor.lastrowid)
+                # 在写连接上读回新记录：没有只读连接时 read_connection 会等待当前持有的写锁
+                cursor = await conn.execute(
+                    "SELECT * FROM api_keys WHERE id = ?",
+                    (cursor.lastrowid,)
+                )
+                row = await cursor.fetchone()
+                return self._row_to_record(row) if row else None
             except aiosqlite.IntegrityError:
                 return None
     
     async def add_keys_batch(self, keys: List[tuple]) -> int:
-        """批量添加 API Key，返回成功添加的数量"""
+        """
+        批量添加 API Key（单个事务，已存在的 Key 会被忽略）
+        keys: [(key, balance), ...]，返回实际插入的数量
+        """
         async with self.get_connection() as conn:
-            added = 0
-            for key, balance in keys:
-                try:
-                    await conn.execute(
-                        """
-                        INSERT OR IGNORE INTO api_keys (key, balance, initial_balance)
-                        VALUES (?, ?, ?)
-                        """,
-                        (key, balance, balance)
-                    )
-                    added += conn.total_changes
-                except Exception:
-                    pass
-            await conn.commit()
-            return added
+            try:
+                cursor = await conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO api_keys (key, balance, initial_balance)
+                    VALUES (?1, ?2, ?2)
+                    """,
+                    keys
+                )
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+            return cursor.rowcount
+    
+    async def get_max_key_id(self) -> int:
+        """获取当前最大的 Key ID"""
+        async with self.read_connection() as conn:
+            cursor = await conn.execute("SELECT COALESCE(MAX(id), 0) FROM api_keys")
+            return (await cursor.fetchone())[0]
+    
+    async def get_keys_after_id(self, key_id: int) -> List[APIKeyRecord]:
+        """获取 ID 大于 key_id 的 Key（用于导入后加载新 Key）"""
+        async with self.read_connection() as conn:
+            cursor = await conn.execute(
+                "SELECT * FROM api_keys WHERE id > ? ORDER BY id",
+                (key_id,)
+            )
+            rows = await cursor.fetchall()
+            return [self._row_to_record(row) for row in rows]
     
     async def get_key_by_id(self, key_id: int) -> Optional[APIKeyRecord]:
         """根据 ID 获取 Key"""
-        async with self.get_connection() as conn:
+        async with self.read_connection() as conn:
             cursor = await conn.execute(
                 "SELECT * FROM api_keys WHERE id = ?",
                 (key_id,)
@@ -147,7 +371,7 @@ class Database:
     
     async def get_key_by_value(self, key: str) -> Optional[APIKeyRecord]:
         """根据 Key 值获取记录"""
-        async with self.get_connection() as conn:
+        async with self.read_connection() as conn:
             cursor = await conn.execute(
                 "SELECT * FROM api_keys WHERE key = ?",
                 (key,)
@@ -157,7 +381,7 @@ class Database:
     
     async def get_available_key(self, min_balance: float = 0.01) -> Optional[APIKeyRecord]:
         """获取一个可用的 Key（状态为 active 且余额足够）"""
-        async with self.get_connection() as conn:
+        async with self.read_connection() as conn:
             cursor = await conn.execute(
                 """
                 SELECT * FROM api_keys 
@@ -170,9 +394,22 @@ class Database:
             row = await cursor.fetchone()
             return self._row_to_record(row) if row else None
     
+    async def get_active_keys(self) -> List[APIKeyRecord]:
+        """获取所有 active 状态的 Key（按 last_used 升序，用于加载内存 Key 池）"""
+        async with self.read_connection() as conn:
+            cursor = await conn.execute(
+                """
+                SELECT * FROM api_keys
+                WHERE status = 'active' AND balance >= 0.01
+                ORDER BY last_used ASC NULLS FIRST, id ASC
+                """
+            )
+            rows = await cursor.fetchall()
+            return [self._row_to_record(row) for row in rows]
+    
     async def get_all_keys(self, status: Optional[str] = None) -> List[APIKeyRecord]:
         """获取所有 Key"""
-        async with self.get_connection() as conn:
+        async with self.read_connection() as conn:
             if status:
                 cursor = await conn.execute(
                     "SELECT * FROM api_keys WHERE status = ? ORDER BY created_at DESC",
@@ -185,6 +422,91 @@ class Database:
             rows = await cursor.fetchall()
             return [self._row_to_record(row) for row in rows]
     
+    @staticmethod
+    def _key_filters(
+        status: Optional[str],
+        min_balance: Optional[float],
+        max_balance: Optional[float]
+    ) -> Tuple[List[str], list]:
+        conditions, params = [], []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if min_balance is not None:
+            conditions.append("balance >= ?")
+            params.append(min_balance)
+        if max_balance is not None:
+            conditions.append("balance <= ?")
+            params.append(max_balance)
+        return conditions, params
+
+    async def list_keys_page(
+        self,
+        status: Optional[str] = None,
+        min_balance: Optional[float] = None,
+        max_balance: Optional[float] = None,
+        sort: str = "created_at",
+        descending: bool = True,
+        limit: int = 50,
+        offset: int = 0,
+        after: Optional[tuple] = None
+    ) -> List[APIKeyRecord]:
+        """
+        分页查询 Key
+        after 为上一页最后一行的 (排序列的值, id)，给出时使用游标分页并忽略 offset
+        """
+        if sort not in KEY_SORT_COLUMNS:
+            raise ValueError(f"Unsupported sort column: {sort}")
+        conditions, params = self._key_filters(status, min_balance, max_balance)
+        direction = "DESC" if descending else "ASC"
+        if sort == "id":
+            order_by = f"id {direction}"
+            if after is not None:
+                conditions.append("id < ?" if descending else "id > ?")
+                params.append(after[1])
+        else:
+            order_by = f"{sort} {direction}, id {direction}"
+            if after is not None:
+                conditions.append(f"({sort}, id) < (?, ?)" if descending else f"({sort}, id) > (?, ?)")
+                params.extend(after)
+
+        sql = "SELECT * FROM api_keys"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {order_by} LIMIT ?"
+        params.append(limit)
+        if after is None and offset > 0:
+            sql += " OFFSET ?"
+            params.append(offset)
+
+        async with self.read_connection() as conn:
+            cursor = await conn.execute(sql, params)
+            rows = await cursor.fetchall()
+            return [self._row_to_record(row) for row in rows]
+
+    async def count_keys(
+        self,
+        status: Optional[str] = None,
+        min_balance: Optional[float] = None,
+        max_balance: Optional[float] = None
+    ) -> int:
+        """统计符合条件的 Key 数量（只有状态过滤时直接读汇总表，否则只扫描索引）"""
+        if min_balance is None and max_balance is None and status in (None, "", "active", "exhausted", "invalid"):
+            stats = await self.get_stats()
+            return {
+                "active": stats.active_keys,
+                "exhausted": stats.exhausted_keys,
+                "invalid": stats.invalid_keys
+            }.get(status, stats.total_keys)
+        conditions, params = self._key_filters(status, min_balance, max_balance)
+        sql = "SELECT COUNT(*) FROM api_keys"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        async with self.read_connection() as conn:
+            cursor = await conn.execute(sql, params)
+            row = await cursor.fetchone()
+            return row[0]
+
     async def deduct_balance(self, key_id: int, amount: float):
         """扣除余额"""
         async with self.get_connection() as conn:
@@ -202,6 +524,219 @@ class Database:
             )
             await conn.commit()
     
+    async def apply_usage_batch(self, key_usage: List[tuple], token_usage: List[tuple]):
+        """
+        在单个事务中批量写入扣费和令牌使用计数
+        key_usage: [(amount, request_count, last_used, key_id), ...]
+        token_usage: [(request_count, last_used, token_id), ...]
+        """
+        async with self.get_connection() as conn:
+            if key_usage:
+                await conn.executemany(
+                    """
+                    UPDATE api_keys 
+                    SET balance = balance - ?1,
+                        used_amount = used_amount + ?1,
+                        request_count = request_count + ?2,
+                        last_used = ?3,
+                        status = CASE WHEN balance - ?1 < 0.01 THEN 'exhausted' ELSE status END
+                    WHERE id = ?4
+                    """,
+                    key_usage
+                )
+            if token_usage:
+                await conn.executemany(
+                    "UPDATE access_tokens SET request_count = request_count + ?, last_used = ? WHERE id = ?",
+                    token_usage
+                )
+            await conn.commit()
+    
+    async def claim_key(
+        self,
+        amount: float,
+        exclude: Optional[int] = None,
+        max_concurrency: int = 0,
+        least_inflight: bool = False,
+        lease_timeout: float = 600,
+        blocked: Sequence[int] = ()
+    ) -> Optional[Tuple[int, APIKeyRecord]]:
+        """
+        在单条 UPDATE ... RETURNING 中选出可用余额足够的 Key 并预留 amount（多进程安全）
+        blocked 为当前进程中熔断或限流冷却的 Key，不参与选择
+        返回 (lease_id, Key)，没有可用 Key 时返回 None
+        """
+        conditions = ["status = 'active'", "balance - reserved >= ?"]
+        params: list = [max(amount, 0.01)]
+        if exclude is not None:
+            conditions.append("id != ?")
+            params.append(exclude)
+        if blocked:
+            # 作为一个 JSON 数组参数传入，限流风暴时 Key 数量不受 SQLite 参数个数上限影响
+            conditions.append("id NOT IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(list(blocked)))
+        if max_concurrency > 0:
+            conditions.append("inflight < ?")
+            params.append(max_concurrency)
+        order_by = "inflight, last_claimed, id" if least_inflight else "last_claimed, id"
+        now = time.time()
+
+        async with self.get_connection() as conn:
+            cursor = await conn.execute(
+                f"""
+                UPDATE api_keys
+                SET reserved = reserved + ?, inflight = inflight + 1, last_claimed = ?
+                WHERE id = (
+                    SELECT id FROM api_keys
+                    WHERE {" AND ".join(conditions)}
+                    ORDER BY {order_by}
+                    LIMIT 1
+                )
+                RETURNING *
+                """,
+                [amount, now] + params
+            )
+            row = await cursor.fetchone()
+            if row is None:
+                await conn.commit()
+                return None
+            cursor = await conn.execute(
+                "INSERT INTO key_leases (key_id, amount, expires_at) VALUES (?, ?, ?)",
+                (row["id"], amount, now + lease_timeout)
+            )
+            lease_id = cursor.lastrowid
+            await conn.commit()
+            return lease_id, self._row_to_record(row)
+    
+    async def settle_lease(self, lease_id: int, key_id: int, amount: float):
+        """结算预留并扣除余额（预留已被超时回收时仍然扣费）"""
+        async with self.get_connection() as conn:
+            cursor = await conn.execute(
+                "DELETE FROM key_leases WHERE id = ? RETURNING amount",
+                (lease_id,)
+            )
+            lease = await cursor.fetchone()
+            held = lease["amount"] if lease else 0.0
+            await conn.execute(
+                """
+                UPDATE api_keys
+                SET balance = balance - ?,
+                    used_amount = used_amount + ?,
+                    request_count = request_count + 1,
+                    last_used = ?,
+                    reserved = MAX(reserved - ?, 0),
+                    inflight = MAX(inflight - ?, 0),
+                    status = CASE WHEN balance - ? < 0.01 THEN 'exhausted' ELSE status END
+                WHERE id = ?
+                """,
+                (amount, amount, datetime.now(), held, 1 if lease else 0, amount, key_id)
+            )
+            await conn.commit()
+    
+    async def release_lease(self, lease_id: int):
+        """释放预留，不扣费"""
+        async with self.get_connection() as conn:
+            cursor = await conn.execute(
+                "DELETE FROM key_leases WHERE id = ? RETURNING key_id, amount",
+                (lease_id,)
+            )
+            lease = await cursor.fetchone()
+            if lease:
+                await conn.execute(
+                    """
+                    UPDATE api_keys
+                    SET reserved = MAX(reserved - ?, 0), inflight = MAX(inflight - 1, 0)
+                    WHERE id = ?
+                    """,
+                    (lease["amount"], lease["key_id"])
+                )
+            await conn.commit()
+    
+    async def expire_leases(self) -> int:
+        """回收已超时的预留（持有预留的进程崩溃或请求异常中断时的兜底）"""
+        async with self.get_connection() as conn:
+            cursor = await conn.execute(
+                "DELETE FROM key_leases WHERE expires_at < ? RETURNING key_id, amount",
+                (time.time(),)
+            )
+            expired = await cursor.fetchall()
+            held: dict = {}
+            for lease in expired:
+                entry = held.setdefault(lease["key_id"], [0.0, 0])
+                entry[0] += lease["amount"]
+                entry[1] += 1
+            if held:
+                await conn.executemany(
+                    """
+                    UPDATE api_keys
+                    SET reserved = MAX(reserved - ?, 0), inflight = MAX(inflight - ?, 0)
+                    WHERE id = ?
+                    """,
+                    [(amount, count, key_id) for key_id, (amount, count) in held.items()]
+                )
+            await conn.commit()
+            return len(expired)
+    
+    async def clear_leases(self):
+        """清空所有预留（单进程模式启动时调用，此时不存在其他持有预留的进程）"""
+        async with self.get_connection() as conn:
+            await conn.execute("DELETE FROM key_leases")
+            await conn.execute(
+                "UPDATE api_keys SET reserved = 0, inflight = 0 WHERE reserved != 0 OR inflight != 0"
+            )
+            await conn.commit()
+    
+    async def get_lease_stats(self) -> dict:
+        """数据库中的预留状态"""
+        async with self.read_connection() as conn:
+            cursor = await conn.execute("""
+                SELECT
+                    COUNT(*) AS reservations,
+                    COUNT(DISTINCT key_id) AS busy_keys,
+                    IFNULL(SUM(amount), 0) AS reserved_amount
+                FROM key_leases
+            """)
+            row = await cursor.fetchone()
+            return {
+                "reservations": row["reservations"],
+                "busy_keys": row["busy_keys"],
+                "reserved_amount": round(row["reserved_amount"], 4)
+            }
+    
+    async def bump_version(self, name: str):
+        """递增缓存版本号，通知其他进程重新加载"""
+        async with self.get_connection() as conn:
+            await conn.execute(
+                """
+                INSERT INTO cache_versions (name, version) VALUES (?, 1)
+                ON CONFLICT(name) DO UPDATE SET version = version + 1
+                """,
+                (name,)
+            )
+            await conn.commit()
+    
+    async def get_versions(self) -> dict:
+        """获取所有缓存版本号"""
+        async with self.read_connection() as conn:
+            cursor = await conn.execute("SELECT name, version FROM cache_versions")
+            return {row["name"]: row["version"] for row in await cursor.fetchall()}
+    
+    async def try_acquire_lock(self, name: str, owner: str, ttl: float) -> bool:
+        """获取或续期后台任务租约，租约被其他未过期的进程持有时返回 False"""
+        now = time.time()
+        async with self.get_connection() as conn:
+            cursor = await conn.execute(
+                """
+                INSERT INTO worker_locks (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE worker_locks.owner = excluded.owner OR worker_locks.expires_at < ?
+                RETURNING owner
+                """,
+                (name, owner, now + ttl, now)
+            )
+            acquired = await cursor.fetchone() is not None
+            await conn.commit()
+            return acquired
+    
     async def update_key_status(self, key_id: int, status: KeyStatus):
         """更新 Key 状态"""
         async with self.get_connection() as conn:
@@ -225,29 +760,96 @@ class Database:
             )
             await conn.commit()
     
-    async def get_stats(self) -> APIKeyStats:
-        """获取统计信息"""
+    async def get_keys_due_for_sync(self, stale_before: Optional[datetime] = None) -> List[tuple]:
+        """
+        获取需要同步余额的 Key：从未同步、同步已过期或同步后被使用过的 Key
+        stale_before 为 None 时返回所有非 invalid 的 Key
+        优先级：从未同步 > 同步后被使用过 > 最久未同步
+        返回 [(id, key), ...]
+        """
+        async with self.read_connection() as conn:
+            if stale_before is None:
+                condition = "status != 'invalid'"
+                params = ()
+            else:
+                condition = """
+                    status != 'invalid' AND (
+                        last_synced IS NULL
+                        OR last_synced < ?
+                        OR (last_used IS NOT NULL AND last_used > last_synced)
+                    )
+                """
+                params = (stale_before,)
+            cursor = await conn.execute(
+                f"""
+                SELECT id, key FROM api_keys
+                WHERE {condition}
+                ORDER BY last_synced IS NOT NULL,
+                         COALESCE(last_used > last_synced, 0) DESC,
+                         last_synced ASC,
+                         id ASC
+                """,
+                params
+            )
+            rows = await cursor.fetchall()
+            return [(row["id"], row["key"]) for row in rows]
+    
+    async def apply_sync_results(self, balances: List[tuple], invalid: List[tuple], attempted: List[tuple]):
+        """
+        在单个事务中批量写入余额同步结果
+        balances: [(balance, last_synced, key_id), ...]
+        invalid: [(last_synced, key_id), ...]
+        attempted: [(last_synced, key_id), ...]  查询失败的 Key 只更新同步时间
+        """
         async with self.get_connection() as conn:
-            cursor = await conn.execute("""
-                SELECT 
-                    COUNT(*) as total_keys,
-                    SUM(CASE WHEN status = 'active' THEN 1 ELSE 0 END) as active_keys,
-                    SUM(CASE WHEN status = 'exhausted' THEN 1 ELSE 0 END) as exhausted_keys,
-                    SUM(CASE WHEN status = 'invalid' THEN 1 ELSE 0 END) as invalid_keys,
-                    SUM(balance) as total_balance,
-                    SUM(used_amount) as total_used,
-                    SUM(request_count) as total_requests
-                FROM api_keys
-            """)
+            if balances:
+                await conn.executemany(
+                    """
+                    UPDATE api_keys 
+                    SET balance = ?1, last_synced = ?2,
+                        status = CASE WHEN ?1 >= 0.01 THEN 'active' ELSE 'exhausted' END
+                    WHERE id = ?3
+                    """,
+                    balances
+                )
+            if invalid:
+                await conn.executemany(
+                    "UPDATE api_keys SET status = 'invalid', last_synced = ? WHERE id = ?",
+                    invalid
+                )
+            if attempted:
+                await conn.executemany(
+                    "UPDATE api_keys SET last_synced = ? WHERE id = ?",
+                    attempted
+                )
+            await conn.commit()
+    
+    async def get_keys_by_ids(self, key_ids: List[int]) -> List[APIKeyRecord]:
+        """批量获取 Key"""
+        if not key_ids:
+            return []
+        async with self.read_connection() as conn:
+            placeholders = ",".join("?" * len(key_ids))
+            cursor = await conn.execute(
+                f"SELECT * FROM api_keys WHERE id IN ({placeholders})",
+                tuple(key_ids)
+            )
+            rows = await cursor.fetchall()
+            return [self._row_to_record(row) for row in rows]
+    
+    async def get_stats(self) -> APIKeyStats:
+        """获取统计信息（读取触发器维护的汇总表）"""
+        async with self.read_connection() as conn:
+            cursor = await conn.execute("SELECT * FROM key_stats WHERE id = 1")
             row = await cursor.fetchone()
             return APIKeyStats(
-                total_keys=row["total_keys"] or 0,
-                active_keys=row["active_keys"] or 0,
-                exhausted_keys=row["exhausted_keys"] or 0,
-                invalid_keys=row["invalid_keys"] or 0,
-                total_balance=round(row["total_balance"] or 0, 4),
-                total_used=round(row["total_used"] or 0, 4),
-                total_requests=row["total_requests"] or 0
+                total_keys=row["total_keys"],
+                active_keys=row["active_keys"],
+                exhausted_keys=row["exhausted_keys"],
+                invalid_keys=row["invalid_keys"],
+                total_balance=round(row["total_balance"], 4),
+                total_used=round(row["total_used"], 4),
+                total_requests=row["total_requests"]
             )
     
     async def delete_key(self, key_id: int) -> bool:
@@ -260,24 +862,9 @@ class Database:
             await conn.commit()
             return cursor.rowcount > 0
     
-    async def get_model_price(self, model: str) -> float:
-        """获取模型价格（支持通配符匹配）"""
-        async with self.get_connection() as conn:
-            cursor = await conn.execute(
-                "SELECT model_pattern, price_per_request FROM model_pricing ORDER BY id"
-            )
-            rows = await cursor.fetchall()
-            
-            for row in rows:
-                pattern = row["model_pattern"]
-                if fnmatch.fnmatch(model.lower(), pattern.lower()):
-                    return row["price_per_request"]
-            
-            return 0.08
-    
     async def get_all_pricing(self) -> List[ModelPricing]:
         """获取所有模型定价"""
-        async with self.get_connection() as conn:
+        async with self.read_connection() as conn:
             cursor = await conn.execute(
                 "SELECT * FROM model_pricing ORDER BY id"
             )
@@ -331,12 +918,20 @@ class Database:
             await conn.commit()
             return cursor.rowcount > 0
     
-    async def create_access_token(self, name: str, token: str) -> AccessToken:
+    async def create_access_token(
+        self,
+        name: str,
+        token: str,
+        coalesce: bool = False,
+        limits: Optional[AccessTokenLimits] = None
+    ) -> AccessToken:
         """创建访问令牌"""
+        limits = limits or AccessTokenLimits()
         async with self.get_connection() as conn:
             cursor = await conn.execute(
-                "INSERT INTO access_tokens (name, token) VALUES (?, ?)",
-                (name, token)
+                """INSERT INTO access_tokens (name, token, coalesce, rps_limit, concurrency_limit, tpm_limit)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (name, token, 1 if coalesce else 0, limits.rps_limit, limits.concurrency_limit, limits.tpm_limit)
             )
             await conn.commit()
             return AccessToken(
@@ -344,52 +939,32 @@ class Database:
                 name=name,
                 token=token,
                 enabled=True,
-                request_count=0
+                request_count=0,
+                coalesce=coalesce,
+                rps_limit=limits.rps_limit,
+                concurrency_limit=limits.concurrency_limit,
+                tpm_limit=limits.tpm_limit
             )
     
     async def get_all_access_tokens(self) -> List[AccessToken]:
         """获取所有访问令牌"""
-        async with self.get_connection() as conn:
+        async with self.read_connection() as conn:
             cursor = await conn.execute(
                 "SELECT * FROM access_tokens ORDER BY created_at DESC"
             )
             rows = await cursor.fetchall()
-            return [
-                AccessToken(
-                    id=row["id"],
-                    name=row["name"],
-                    token=row["token"],
-                    enabled=bool(row["enabled"]),
-                    request_count=row["request_count"],
-                    created_at=datetime.fromisoformat(row["created_at"]) if row["created_at"] else datetime.now(),
-                    last_used=datetime.fromisoformat(row["last_used"]) if row["last_used"] else None
-                )
-                for row in rows
-            ]
+            return [self._row_to_access_token(row) for row in rows]
     
     async def verify_access_token(self, token: str) -> Optional[AccessToken]:
-        """验证访问令牌是否有效"""
-        async with self.get_connection() as conn:
+        """验证访问令牌是否有效（使用计数由 write_behind 批量写入）"""
+        async with self.read_connection() as conn:
             cursor = await conn.execute(
                 "SELECT * FROM access_tokens WHERE token = ? AND enabled = 1",
                 (token,)
             )
             row = await cursor.fetchone()
             if row:
-                await conn.execute(
-                    "UPDATE access_tokens SET request_count = request_count + 1, last_used = ? WHERE id = ?",
-                    (datetime.now(), row["id"])
-                )
-                await conn.commit()
-                return AccessToken(
-                    id=row["id"],
-                    name=row["name"],
-                    token=row["token"],
-                    enabled=bool(row["enabled"]),
-                    request_count=row["request_count"],
-                    created_at=datetime.fromisoformat(row["created_at"]) if row["created_at"] else datetime.now(),
-                    last_used=datetime.fromisoformat(row["last_used"]) if row["last_used"] else None
-                )
+                return self._row_to_access_token(row)
             return None
     
     async def toggle_access_token(self, token_id: int, enabled: bool) -> bool:
@@ -402,6 +977,26 @@ class Database:
             await conn.commit()
             return cursor.rowcount > 0
     
+    async def set_token_coalesce(self, token_id: int, enabled: bool) -> bool:
+        """开启/关闭令牌的相同请求合并"""
+        async with self.get_connection() as conn:
+            cursor = await conn.execute(
+                "UPDATE access_tokens SET coalesce = ? WHERE id = ?",
+                (1 if enabled else 0, token_id)
+            )
+            await conn.commit()
+            return cursor.rowcount > 0
+    
+    async def set_token_limits(self, token_id: int, limits: AccessTokenLimits) -> bool:
+        """设置访问令牌的限流"""
+        async with self.get_connection() as conn:
+            cursor = await conn.execute(
+                "UPDATE access_tokens SET rps_limit = ?, concurrency_limit = ?, tpm_limit = ? WHERE id = ?",
+                (limits.rps_limit, limits.concurrency_limit, limits.tpm_limit, token_id)
+            )
+            await conn.commit()
+            return cursor.rowcount > 0
+    
     async def delete_access_token(self, token_id: int) -> bool:
         """删除访问令牌"""
         async with self.get_connection() as conn:
@@ -412,6 +1007,23 @@ class Database:
             await conn.commit()
             return cursor.rowcount > 0
     
+    @staticmethod
+    def _row_to_access_token(row) -> AccessToken:
+        """将数据库行转换为 AccessToken"""
+        return AccessToken(
+            id=row["id"],
+            name=row["name"],
+            token=row["token"],
+            enabled=bool(row["enabled"]),
+            request_count=row["request_count"],
+            created_at=datetime.fromisoformat(row["created_at"]) if row["created_at"] else datetime.now(),
+            last_used=datetime.fromisoformat(row["last_used"]) if row["last_used"] else None,
+            coalesce=bool(row["coalesce"]),
+            rps_limit=row["rps_limit"],
+            concurrency_limit=row["concurrency_limit"],
+            tpm_limit=row["tpm_limit"]
+        )
+    
     def _row_to_record(self, row) -> APIKeyRecord:
         """将数据库行转换为 APIKeyRecord"""
         return APIKeyRecord(
@@ -428,4 +1040,23 @@ class Database:
         )
 
 
+def _timed(name: str, method):
+    span_name = f"db.{name}"
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with tracer.span(span_name):
+                return await method(*args, **kwargs)
+        finally:
+            metrics.db_query_seconds.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+# 为所有公开的数据库操作记录耗时（包括等待写连接的时间），请求被追踪时同时记录 span
+for _name, _method in list(vars(Database).items()):
+    if not _name.startswith("_") and _name not in ("connect", "disconnect") and inspect.iscoroutinefunction(_method):
+        setattr(Database, _name, _timed(_name, _method))
+
+
 db = Database()
@@ -0,0 +1,81 @@
+import fnmatch
+from collections import deque
+from typing import Dict, Optional
+
+from config import get_settings
+
+
+class HedgePolicy:
+    """
+    对冲请求策略
+    主请求超过延迟阈值（默认为观测到的 p95 响应时间）仍未返回时，用另一个 Key 发送副本请求；
+    对冲次数受预算限制：每个符合条件的请求积累 hedge_max_ratio 个额度，每次对冲消耗 1 个
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._latencies: deque = deque(maxlen=500)
+        self._p95: Optional[float] = None
+        self._samples_since_update = 0
+        self._budget = 0.0
+        self._model_cache: Dict[str, bool] = {}
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def enabled_for(self, model: str) -> bool:
+        """判断模型是否启用对冲（hedge_models 为逗号分隔的通配符列表）"""
+        if not self.settings.hedge_enabled:
+            return False
+        enabled = self._model_cache.get(model)
+        if enabled is None:
+            lowered = model.lower()
+            enabled = any(
+                fnmatch.fnmatch(lowered, pattern.strip().lower())
+                for pattern in self.settings.hedge_models.split(",")
+                if pattern.strip()
+            )
+            if len(self._model_cache) >= 1024:
+                self._model_cache.clear()
+            self._model_cache[model] = enabled
+        return enabled
+
+    def record_latency(self, seconds: float):
+        """记录一次成功请求的响应时间"""
+        self._latencies.append(seconds)
+        self._samples_since_update += 1
+        if self._p95 is None or self._samples_since_update >= 50:
+            ordered = sorted(self._latencies)
+            self._p95 = ordered[max(int(len(ordered) * 0.95) - 1, 0)]
+            self._samples_since_update = 0
+
+    def delay(self) -> float:
+        """发送对冲请求前的等待时间"""
+        if self.settings.hedge_delay > 0:
+            return self.settings.hedge_delay
+        if self._p95 is None or len(self._latencies) < 20:
+            return self.settings.hedge_min_delay
+        return max(self._p95, self.settings.hedge_min_delay)
+
+    def request_started(self):
+        """每个符合条件的请求积累对冲额度"""
+        self._budget = min(self._budget + self.settings.hedge_max_ratio, 10.0)
+
+    def try_acquire(self) -> bool:
+        """消耗一个对冲额度，额度不足时不对冲"""
+        if self._budget < 1.0:
+            return False
+        self._budget -= 1.0
+        self.hedged += 1
+        return True
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": self.settings.hedge_enabled,
+            "delay": round(self.delay(), 4),
+            "p95": round(self._p95, 4) if self._p95 is not None else None,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins
+        }
+
+
+hedge_policy = HedgePolicy()
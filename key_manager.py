@@ -1,8 +1,17 @@
 import asyncio
-from typing import Optional, Tuple
+import time
+from typing import AsyncIterable, AsyncIterator, Iterable, List, Mapping, Optional, Tuple, Union
 
 from models import APIKeyRecord, KeyStatus
+from circuit_breaker import KeyBreakers
 from database import db
+from key_pool import KeyPool, Reservation
+from metrics import metrics
+from pricing import pricing_index
+from rate_limit import KeyRateLimits
+from tracing import tracer
+from upstream_errors import ErrorKind, UpstreamError, classify
+from write_behind import write_behind
 from config import get_settings
 
 
@@ -11,111 +20,275 @@ class KeyManager:
         self.settings = get_settings()
         self._lock = asyncio.Lock()
         self._current_key: Optional[APIKeyRecord] = None
+        self._last_expire_check = 0.0
+        self.pool = KeyPool(
+            strategy=self.settings.key_selection_strategy,
+            max_concurrency=self.settings.key_max_concurrency
+        )
+        self.breakers = KeyBreakers()
+        self.rate_limits = KeyRateLimits()
+        self.pool.blocked = self._blocked
     
-    async def get_key(self, min_balance: float = 0.01) -> Optional[APIKeyRecord]:
-        """获取一个可用的 API Key"""
+    def _blocked(self, key_id: int) -> bool:
+        """熔断中或限流冷却中的 Key 暂时不参与选择"""
+        return self.breakers.blocked(key_id) or self.rate_limits.blocked(key_id)
+    
+    def _on_selected(self, key_id: int):
+        self.breakers.on_selected(key_id)
+        self.rate_limits.on_selected(key_id)
+    
+    @property
+    def shared(self) -> bool:
+        """
+        多进程模式（worker_mode=multi）：不使用内存 Key 池，
+        Key 的选择、预留和结算都在数据库中原子完成，多个 worker 不会超额使用同一个 Key
+        """
+        return self.settings.worker_mode == "multi"
+    
+    async def load_pool(self):
+        """从数据库加载 active Key 到内存 Key 池"""
+        if self.shared:
+            return
         async with self._lock:
-            key = await db.get_available_key(min_balance)
-            if key:
-                self._current_key = key
-            return key
+            # 单进程模式下不存在其他持有预留的进程，清理之前遗留的数据库预留
+            await db.clear_leases()
+            self.pool.load(await db.get_active_keys())
+    
+    async def reserve_key(self, price: float = 0.0, exclude: Optional[int] = None) -> Optional[Reservation]:
+        """
+        从内存 Key 池中选择可用余额足够的 Key 并预留 price（不查询数据库）
+        多进程模式下在数据库中原子地选择并预留
+        请求成功后调用 settle，失败后调用 release
+        """
+        if self.shared:
+            return await self._claim_key(price, exclude)
+        if not self.pool.loaded:
+            await self.load_pool()
+        self._expire_reservations()
+        reservation = self.pool.reserve(price, exclude)
+        if reservation:
+            self._current_key = reservation.key
+            self._on_selected(reservation.key.id)
+        return reservation
+    
+    async def _claim_key(self, price: float, exclude: Optional[int]) -> Optional[Reservation]:
+        now = time.monotonic()
+        if now - self._last_expire_check >= 5.0:
+            self._last_expire_check = now
+            await db.expire_leases()
+        claimed = await db.claim_key(
+            price,
+            exclude,
+            max_concurrency=self.pool.max_concurrency,
+            least_inflight=self.pool.strategy != "round_robin",
+            lease_timeout=self.settings.reservation_timeout,
+            blocked=self.breakers.blocked_ids() + self.rate_limits.blocked_ids()
+        )
+        if claimed is None:
+            return None
+        lease_id, record = claimed
+        self._current_key = record
+        self._on_selected(record.id)
+        return Reservation(record, price, lease_id)
+    
+    def _expire_reservations(self):
+        """定期释放超时未结算的预留（请求异常中断时的兜底）"""
+        now = time.monotonic()
+        if now - self._last_expire_check >= 5.0:
+            self._last_expire_check = now
+            self.pool.expire(self.settings.reservation_timeout)
+    
+    async def settle(self, reservation: Reservation, headers: Optional[Mapping[str, str]] = None):
+        """
+        请求成功，结算预留：内存余额立即扣除，数据库由写回缓冲批量写入
+        多进程模式下直接在数据库中结算，其他进程立即可见
+        headers 为上游响应头，用于学习 Key 的请求限额
+        """
+        self.breakers.record_success(reservation.key.id)
+        self.rate_limits.observe(reservation.key.id, headers)
+        with tracer.span("settle") as span:
+            span.set("key_id", reservation.key.id)
+            span.set("amount", reservation.amount)
+            if self.shared:
+                reservation.active = False
+                await db.settle_lease(reservation.id, reservation.key.id, reservation.amount)
+                return
+            self.pool.settle(reservation)
+            await write_behind.record_deduction(reservation.key.id, reservation.amount)
+    
+    async def release(self, reservation: Reservation):
+        """请求失败或放弃，释放预留，不扣费（重复调用无影响）"""
+        if self.shared:
+            if reservation.active:
+                reservation.active = False
+                await db.release_lease(reservation.id)
+            return
+        self.pool.release(reservation)
+    
+    async def get_pool_stats(self) -> dict:
+        """Key 池状态，多进程模式下为数据库中的预留状态"""
+        if self.shared:
+            return {
+                "mode": "multi",
+                "strategy": self.pool.strategy,
+                "max_concurrency": self.pool.max_concurrency,
+                **await db.get_lease_stats()
+            }
+        return {"mode": "single", **self.pool.get_stats()}
     
-    async def deduct_balance(self, key_id: int, amount: float):
-        """扣除 Key 余额"""
-        await db.deduct_balance(key_id, amount)
+    async def refresh_key(self, key_id: int):
+        """从数据库重新读取 Key 并同步到 Key 池"""
+        if self.shared:
+            return
+        record = await db.get_key_by_id(key_id)
+        if record:
+            self.pool.upsert(record)
+        else:
+            self.pool.remove(key_id)
+    
+    async def add_key(self, key: str, balance: float = 0.24) -> Optional[APIKeyRecord]:
+        """添加单个 Key 并加入 Key 池"""
+        record = await db.add_key(key, balance)
+        if record and not self.shared:
+            self.pool.upsert(record)
+        return record
+    
+    async def delete_key(self, key_id: int) -> bool:
+        """删除 Key 并移出 Key 池"""
+        self.pool.remove(key_id)
+        self.breakers.remove(key_id)
+        self.rate_limits.remove(key_id)
+        return await db.delete_key(key_id)
+    
+    async def sync_key_balance(self, key_id: int, balance: float):
+        """写入远程查询的余额并同步到 Key 池"""
+        await write_behind.flush()
+        await db.sync_key_balance(key_id, balance)
+        await self.refresh_key(key_id)
     
     async def mark_key_exhausted(self, key_id: int):
         """标记 Key 已耗尽"""
+        self.pool.remove(key_id)
+        self.breakers.remove(key_id)
+        self.rate_limits.remove(key_id)
         await db.update_key_status(key_id, KeyStatus.EXHAUSTED)
     
     async def mark_key_invalid(self, key_id: int):
         """标记 Key 无效"""
+        self.pool.remove(key_id)
+        self.breakers.remove(key_id)
+        self.rate_limits.remove(key_id)
         await db.update_key_status(key_id, KeyStatus.INVALID)
     
     async def get_model_price(self, model: str) -> float:
-        """获取模型价格"""
-        return await db.get_model_price(model)
+        """获取模型价格（查询内存中的定价索引）"""
+        with tracer.span("get_model_price") as span:
+            if not pricing_index.loaded:
+                await pricing_index.load()
+            price = pricing_index.get_price(model)
+            span.set("model", model)
+            span.set("price", price)
+            return price
     
-    async def get_key_with_retry(self, model: str, max_retries: int = 3) -> Tuple[Optional[APIKeyRecord], float, int]:
+    async def get_key_with_retry(self, model: str, max_retries: int = 3) -> Tuple[Optional[Reservation], float, int]:
         """
-        获取可用 Key，根据模型价格判断余额是否足够
-        返回 (key, price, retry_count)
+        获取可用 Key 并预留模型价格，可用余额不足的 Key 不会被选中
+        返回 (reservation, price, retry_count)
         """
+        started = time.perf_counter()
         price = await self.get_model_price(model)
-        retries = 0
-        
-        while retries < max_retries:
-            key = await self.get_key(min_balance=price)
-            if key:
-                return key, price, retries
-            retries += 1
-            await asyncio.sleep(0.1)
-        
-        return None, price, retries
+        with tracer.span("get_key_with_retry") as span:
+            retries = 0
+            
+            while retries < max_retries:
+                reservation = await self.reserve_key(price)
+                if reservation:
+                    metrics.key_acquire_seconds.observe(time.perf_counter() - started, "ok")
+                    span.set("key_id", reservation.key.id)
+                    span.set("retries", retries)
+                    return reservation, price, retries
+                retries += 1
+                metrics.key_acquire_retries.inc()
+                # 限流的 Key 很快恢复时等到它恢复，而不是直接失败
+                wait = self.rate_limits.next_ready_in()
+                if wait is None or wait > self.settings.key_rate_limit_max_wait:
+                    wait = 0.1
+                await asyncio.sleep(max(wait, 0.1))
+            
+            metrics.key_acquire_seconds.observe(time.perf_counter() - started, "none")
+            span.set("retries", retries)
+            span.fail("No available key")
+            return None, price, retries
     
-    async def handle_request_error(self, key_id: int, error_message: str) -> bool:
+    async def handle_request_error(
+        self,
+        key_id: int,
+        status_code: int,
+        body: Union[str, bytes] = b"",
+        headers: Optional[Mapping[str, str]] = None
+    ) -> UpstreamError:
         """
-        处理请求错误，判断是否需要切换 Key
-        返回 True 表示应该重试，False 表示不需要重试
+        按状态码和结构化错误对上游错误分类并处理：
+        - Key 无效 / 额度用完：标记 invalid / exhausted，移出 Key 池
+        - 限流：Key 按 Retry-After 冷却，并学习该 Key 的请求限额（见 KeyRateLimits）
+        - 上游临时故障：计入熔断器，连续失败后暂停选择
+        - 请求本身的错误：不影响 Key
+        返回分类结果，retryable 为 True 时应换一个 Key 重试
         """
-        error_lower = error_message.lower()
-        
-        exhausted_indicators = [
-            "quota",
-            "limit",
-            "exceeded",
-            "exhausted",
-            "no remaining",
-            "insufficient",
-            "rate limit",
-            "用完",
-            "余额",
-            "次数"
-        ]
-        
-        invalid_indicators = [
-            "invalid",
-            "unauthorized",
-            "authentication",
-            "invalid api key",
-            "invalid_api_key",
-            "无效"
-        ]
-        
-        for indicator in exhausted_indicators:
-            if indicator in error_lower:
-                await self.mark_key_exhausted(key_id)
-                return True
-        
-        for indicator in invalid_indicators:
-            if indicator in error_lower:
-                await self.mark_key_invalid(key_id)
-                return True
-        
-        return False
+        error = classify(status_code, body, headers)
+        metrics.upstream_errors.inc(error.kind.value)
+        if error.kind == ErrorKind.INVALID_KEY:
+            await self.mark_key_invalid(key_id)
+        elif error.kind == ErrorKind.QUOTA:
+            await self.mark_key_exhausted(key_id)
+        elif error.kind == ErrorKind.RATE_LIMITED:
+            self.rate_limits.on_rate_limited(key_id, error.retry_after, headers)
+        elif error.kind == ErrorKind.SERVER_ERROR:
+            self.breakers.record_failure(key_id, f"HTTP {status_code}: {error.message}")
+        return error
+    
+    def record_transport_error(self, key_id: int, error: Exception):
+        """连接失败或超时，计入熔断器"""
+        metrics.upstream_errors.inc(ErrorKind.SERVER_ERROR.value)
+        self.breakers.record_failure(key_id, str(error) or type(error).__name__)
     
-    async def import_keys(self, keys: list) -> dict:
+    async def import_keys(self, keys: Union[Iterable[tuple], AsyncIterable[tuple]]) -> dict:
         """
-        批量导入 Keys
-        keys: [(key_string, balance), ...]
+        批量导入 Keys，每 import_batch_size 个 Key 一个事务（INSERT OR IGNORE）
+        keys: [(key_string, balance), ...] 或异步迭代器（流式解析上传文件）
+        导入完成后新 Key 加入内存 Key 池
         """
         result = {
-            "total": len(keys),
+            "total": 0,
             "added": 0,
             "duplicates": 0,
             "errors": 0
         }
+        last_id = await db.get_max_key_id()
+        batch: List[tuple] = []
         
-        for key_str, balance in keys:
+        async def flush():
             try:
-                record = await db.add_key(key_str, balance)
-                if record:
-                    result["added"] += 1
-                else:
-                    result["duplicates"] += 1
+                added = await db.add_keys_batch(batch)
+                result["added"] += added
+                result["duplicates"] += len(batch) - added
             except Exception:
-                result["errors"] += 1
+                result["errors"] += len(batch)
+            batch.clear()
         
+        if not hasattr(keys, "__aiter__"):
+            keys = _aiter(keys)
+        async for item in keys:
+            batch.append(item)
+            result["total"] += 1
+            if len(batch) >= self.settings.import_batch_size:
+                await flush()
+        if batch:
+            await flush()
+        
+        if result["added"] and not self.shared:
+            for record in await db.get_keys_after_id(last_id):
+                self.pool.upsert(record)
         return result
     
     async def get_stats(self):
@@ -127,4 +300,9 @@ class KeyManager:
         return await db.get_all_keys(status)
 
 
+async def _aiter(items: Iterable[tuple]) -> AsyncIterator[tuple]:
+    for item in items:
+        yield item
+
+
 key_manager = KeyManager()
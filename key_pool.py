@@ -0,0 +1,268 @@
+import itertools
+import random
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+
+from models import APIKeyRecord, KeyStatus
+
+STRATEGIES = ("round_robin", "least_inflight", "p2c")
+
+_reservation_ids = itertools.count(1)
+
+
+class Reservation:
+    """一次请求对 Key 余额的预留，请求成功后结算（settle），失败或超时释放（release）"""
+
+    __slots__ = ("id", "key", "amount", "created_at", "active")
+
+    def __init__(self, key: APIKeyRecord, amount: float, reservation_id: Optional[int] = None):
+        # 多进程模式下 id 为数据库中的租约 id
+        self.id = reservation_id if reservation_id is not None else next(_reservation_ids)
+        self.key = key
+        self.amount = amount
+        self.created_at = time.monotonic()
+        self.active = True
+
+
+class KeyPool:
+    """
+    内存中的可用 Key 池，只保存 active 状态的 Key，选 Key 不访问数据库
+    记录每个 Key 正在进行的请求数，支持三种选择策略：
+      - round_robin:    按轮换顺序选择最久未被选中的 Key
+      - least_inflight: 选择进行中请求最少的 Key（相同时按轮换顺序）
+      - p2c:            随机抽取两个 Key，选择进行中请求较少的一个
+    max_concurrency > 0 时，进行中请求数达到上限的 Key 不会被选中
+
+    选中 Key 时会同时预留本次请求的价格，可用余额 = 余额 - 已预留金额，
+    因此并发请求不会超额使用同一个 Key
+    """
+
+    def __init__(self, strategy: str = "round_robin", max_concurrency: int = 0):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown key selection strategy: {strategy}")
+        self.strategy = strategy
+        self.max_concurrency = max_concurrency
+        self._keys: Dict[int, APIKeyRecord] = {}
+        # 轮换顺序，最久未被选中的在前
+        self._order: "OrderedDict[int, None]" = OrderedDict()
+        # 进行中请求数 -> 该负载下的 Key（按轮换顺序）
+        self._by_load: Dict[int, "OrderedDict[int, None]"] = {}
+        self._inflight: Dict[int, int] = {}
+        # 预留账本：key_id -> 已预留金额，reservation_id -> Reservation
+        self._reserved: Dict[int, float] = {}
+        self._reservations: Dict[int, Reservation] = {}
+        # 用于 p2c 随机抽样
+        self._ids: List[int] = []
+        self._pos: Dict[int, int] = {}
+        # 返回 True 的 Key 暂时不参与选择（熔断中）
+        self.blocked: Optional[Callable[[int], bool]] = None
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key_id: int) -> bool:
+        return key_id in self._keys
+
+    def load(self, records: Iterable[APIKeyRecord]):
+        """用数据库中的 active Key 重建 Key 池（records 需按 last_used 升序）"""
+        self._keys.clear()
+        self._order.clear()
+        self._by_load.clear()
+        self._ids.clear()
+        self._pos.clear()
+        for record in records:
+            if record.status == KeyStatus.ACTIVE.value:
+                self._add(record)
+        self.loaded = True
+
+    def get(self, key_id: int) -> Optional[APIKeyRecord]:
+        return self._keys.get(key_id)
+
+    def _add(self, record: APIKeyRecord, first: bool = False):
+        key_id = record.id
+        self._keys[key_id] = record
+        self._order[key_id] = None
+        load = self._inflight.get(key_id, 0)
+        bucket = self._by_load.setdefault(load, OrderedDict())
+        bucket[key_id] = None
+        if first:
+            self._order.move_to_end(key_id, last=False)
+            bucket.move_to_end(key_id, last=False)
+        self._pos[key_id] = len(self._ids)
+        self._ids.append(key_id)
+
+    def upsert(self, record: APIKeyRecord):
+        """新增或刷新 Key，非 active 状态的 Key 会被移出"""
+        if record.status != KeyStatus.ACTIVE.value or record.balance < 0.01:
+            self.remove(record.id)
+            return
+        if record.id in self._keys:
+            self._keys[record.id] = record
+        else:
+            self._add(record, first=record.last_used is None)
+
+    def remove(self, key_id: int):
+        if self._keys.pop(key_id, None) is None:
+            return
+        self._order.pop(key_id, None)
+        self._bucket_remove(key_id, self._inflight.get(key_id, 0))
+        index = self._pos.pop(key_id)
+        last = self._ids.pop()
+        if last != key_id:
+            self._ids[index] = last
+            self._pos[last] = index
+
+    def _bucket_remove(self, key_id: int, load: int):
+        bucket = self._by_load.get(load)
+        if bucket is not None:
+            bucket.pop(key_id, None)
+            if not bucket:
+                del self._by_load[load]
+
+    def _set_load(self, key_id: int, load: int):
+        """调整 Key 的进行中请求数，并移动到对应负载分组的队尾"""
+        old = self._inflight.get(key_id, 0)
+        if load > 0:
+            self._inflight[key_id] = load
+        else:
+            self._inflight.pop(key_id, None)
+        if key_id in self._keys:
+            self._bucket_remove(key_id, old)
+            self._by_load.setdefault(load, OrderedDict())[key_id] = None
+
+    def available_balance(self, key_id: int) -> float:
+        """扣除已预留金额后的可用余额"""
+        record = self._keys.get(key_id)
+        if not record:
+            return 0.0
+        return record.balance - self._reserved.get(key_id, 0.0)
+
+    def _eligible(self, record: APIKeyRecord, min_balance: float, exclude: Optional[int]) -> bool:
+        if record.id == exclude:
+            return False
+        if record.balance - self._reserved.get(record.id, 0.0) < min_balance:
+            return False
+        if self.max_concurrency > 0 and self._inflight.get(record.id, 0) >= self.max_concurrency:
+            return False
+        if self.blocked is not None and self.blocked(record.id):
+            return False
+        return True
+
+    def reserve(self, amount: float, exclude: Optional[int] = None) -> Optional[Reservation]:
+        """
+        按选择策略选出可用余额足够的 Key 并预留 amount
+        返回的预留需要调用 settle 或 release
+        """
+        min_balance = max(amount, 0.01)
+        if self.strategy == "p2c":
+            record = self._pick_p2c(min_balance, exclude)
+        elif self.strategy == "least_inflight":
+            record = self._pick_least_inflight(min_balance, exclude)
+        else:
+            record = self._pick_round_robin(min_balance, exclude)
+        if record is None:
+            return None
+
+        self._order.move_to_end(record.id)
+        self._set_load(record.id, self._inflight.get(record.id, 0) + 1)
+        self._reserved[record.id] = self._reserved.get(record.id, 0.0) + amount
+        reservation = Reservation(record, amount)
+        self._reservations[reservation.id] = reservation
+        return reservation
+
+    def _close(self, reservation: Reservation) -> bool:
+        """结束预留，返回 False 表示预留已结束（如已超时释放）"""
+        if not reservation.active:
+            return False
+        reservation.active = False
+        self._reservations.pop(reservation.id, None)
+        key_id = reservation.key.id
+        reserved = self._reserved.get(key_id, 0.0) - reservation.amount
+        if reserved > 1e-9:
+            self._reserved[key_id] = reserved
+        else:
+            self._reserved.pop(key_id, None)
+        load = self._inflight.get(key_id, 0)
+        if load > 0:
+            self._set_load(key_id, load - 1)
+        return True
+
+    def settle(self, reservation: Reservation):
+        """请求成功：释放预留并从余额中扣除（预留已超时的也照常扣费）"""
+        self._close(reservation)
+        self.deduct(reservation.key.id, reservation.amount)
+
+    def release(self, reservation: Reservation):
+        """请求失败或超时：释放预留，不扣费"""
+        self._close(reservation)
+
+    def expire(self, timeout: float) -> int:
+        """释放超过 timeout 秒仍未结算的预留，返回释放数量"""
+        deadline = time.monotonic() - timeout
+        expired = [r for r in self._reservations.values() if r.created_at < deadline]
+        for reservation in expired:
+            self._close(reservation)
+        return len(expired)
+
+    def _pick_round_robin(self, min_balance: float, exclude: Optional[int]) -> Optional[APIKeyRecord]:
+        for key_id in self._order:
+            record = self._keys[key_id]
+            if self._eligible(record, min_balance, exclude):
+                return record
+        return None
+
+    def _pick_least_inflight(self, min_balance: float, exclude: Optional[int]) -> Optional[APIKeyRecord]:
+        for load in sorted(self._by_load):
+            if self.max_concurrency > 0 and load >= self.max_concurrency:
+                break
+            for key_id in self._by_load[load]:
+                record = self._keys[key_id]
+                if self._eligible(record, min_balance, exclude):
+                    return record
+        return None
+
+    def _pick_p2c(self, min_balance: float, exclude: Optional[int]) -> Optional[APIKeyRecord]:
+        candidates = []
+        for _ in range(8):
+            if not self._ids:
+                break
+            record = self._keys[self._ids[random.randrange(len(self._ids))]]
+            if self._eligible(record, min_balance, exclude) and all(c.id != record.id for c in candidates):
+                candidates.append(record)
+                if len(candidates) == 2:
+                    break
+        if not candidates:
+            # 随机抽样未命中时退化为全量查找
+            return self._pick_least_inflight(min_balance, exclude)
+        return min(candidates, key=lambda r: self._inflight.get(r.id, 0))
+
+    def in_flight(self, key_id: int) -> int:
+        return self._inflight.get(key_id, 0)
+
+    def deduct(self, key_id: int, amount: float):
+        """同步内存中的扣费结果，余额不足时移出 Key 池"""
+        record = self._keys.get(key_id)
+        if not record:
+            return
+        record.balance -= amount
+        record.used_amount += amount
+        record.request_count += 1
+        record.last_used = datetime.now()
+        if record.balance < 0.01:
+            self.remove(key_id)
+
+    def get_stats(self) -> dict:
+        """Key 池状态"""
+        return {
+            "strategy": self.strategy,
+            "max_concurrency": self.max_concurrency,
+            "keys": len(self._keys),
+            "in_flight": sum(self._inflight.values()),
+            "busy_keys": len(self._inflight),
+            "max_key_in_flight": max(self._inflight.values(), default=0),
+            "reservations": len(self._reservations),
+            "reserved_amount": round(sum(self._reserved.values()), 4)
+        }
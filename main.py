@@ -1,50 +1,116 @@
 import os
+import time
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from typing import Optional
 
 from config import get_settings
+from cluster import cluster
 from database import db
 from models import ChatCompletionRequest
+from passthrough import ChatRequest, RawChatRequest
+from key_manager import key_manager
+from metrics import metrics
+from pricing import pricing_index
+from profiler import profiler
 from proxy import api_proxy
+from response_cache import response_cache
+from token_cache import token_cache
+from token_limits import TokenLimitExceeded, TokenLimitMiddleware, token_limiter
+from tracing import TracingMiddleware, tracer
+from upstream import upstream_client
+from usage_sync import usage_syncer
+from write_behind import write_behind
 import admin
 
 settings = get_settings()
 security = HTTPBearer(auto_error=False)
 
+metrics.gauge("api_exchange_upstream_in_flight", "In-flight upstream requests", lambda: upstream_client.get_stats()["in_flight_requests"])
+metrics.gauge("api_exchange_key_pool_keys", "Keys in the in-memory key pool", lambda: len(key_manager.pool))
+metrics.gauge("api_exchange_key_pool_reserved_amount", "Balance reserved by in-flight requests", lambda: key_manager.pool.get_stats()["reserved_amount"])
+metrics.gauge("api_exchange_key_breakers_open", "Keys temporarily removed from rotation by their circuit breaker", lambda: len(key_manager.breakers.blocked_ids()))
+metrics.gauge("api_exchange_key_rate_limited", "Keys cooling down or out of learned request budget", lambda: len(key_manager.rate_limits.blocked_ids()))
+metrics.gauge("api_exchange_key_rate_limited_total", "Upstream 429 rate-limit responses", lambda: key_manager.rate_limits.rate_limited, "counter")
+metrics.gauge("api_exchange_write_behind_pending", "Buffered deductions not yet written", lambda: write_behind.get_stats()["pending_ops"])
+metrics.gauge("api_exchange_token_cache_hits_total", "Access token cache hits", lambda: token_cache.hits, "counter")
+metrics.gauge("api_exchange_token_cache_misses_total", "Access token cache misses", lambda: token_cache.misses, "counter")
+metrics.gauge("api_exchange_response_cache_bytes", "Bytes held by the in-memory response cache", lambda: response_cache.get_stats()["bytes"])
+metrics.gauge("api_exchange_response_cache_hits_total", "Response cache hits (memory and disk)", lambda: response_cache.hits + response_cache.disk_hits, "counter")
+metrics.gauge("api_exchange_response_cache_misses_total", "Response cache misses", lambda: response_cache.misses, "counter")
 
-async def verify_api_key(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)):
-    """验证 API Key（支持管理密钥或对外访问令牌）"""
-    if not credentials:
-        raise HTTPException(
-            status_code=401,
-            detail="Missing API key. Use Authorization: Bearer <your-key>"
-        )
-    
-    token = credentials.credentials
-    
-    if token == settings.admin_key:
-        return token
-    
-    access_token = await db.verify_access_token(token)
-    if access_token:
-        return token
-    
-    raise HTTPException(
-        status_code=401,
-        detail="Invalid API key"
-    )
+
+async def verify_api_key(
+    request: Request,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)
+):
+    """验证 API Key（支持管理密钥或对外访问令牌），访问令牌保存在 request.state.access_token"""
+    started = time.perf_counter()
+    result = "invalid"
+    with tracer.span("auth") as span:
+        try:
+            if not credentials:
+                raise HTTPException(
+                    status_code=401,
+                    detail="Missing API key. Use Authorization: Bearer <your-key>"
+                )
+
+            token = credentials.credentials
+
+            request.state.access_token = None
+            if token == settings.admin_key:
+                result = "admin"
+                return token
+
+            access_token = await token_cache.verify(token)
+            if access_token:
+                try:
+                    request.state.token_limit = token_limiter.acquire(access_token)
+                except TokenLimitExceeded as e:
+                    result = "limited"
+                    raise HTTPException(
+                        status_code=429,
+                        detail=str(e),
+                        headers={"Retry-After": e.retry_after_header}
+                    )
+                request.state.access_token = access_token
+                await write_behind.record_token_use(access_token.id)
+                result = "token"
+                return token
+
+            raise HTTPException(
+                status_code=401,
+                detail="Invalid API key"
+            )
+        finally:
+            metrics.auth_seconds.observe(time.perf_counter() - started, result)
+            span.set("result", result)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     await db.connect()
+    await key_manager.load_pool()
+    await pricing_index.load()
+    await write_behind.start()
+    await upstream_client.start()
+    await usage_syncer.start()
+    await cluster.start()
+    await tracer.start_exporter()
+    if settings.profiler_enabled:
+        profiler.enable()
     yield
+    profiler.disable()
+    await tracer.stop_exporter()
+    await cluster.stop()
+    await usage_syncer.stop()
+    await upstream_client.close()
+    await write_behind.stop()
     await db.disconnect()
 
 
@@ -63,6 +129,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 请求完成（流式响应发送完）后释放访问令牌的并发名额
+app.add_middleware(TokenLimitMiddleware)
+
+# 在最外层，使流式响应结束时才结束 trace；未开启追踪和采样分析器时直接透传
+app.add_middleware(TracingMiddleware)
+
 app.include_router(admin.router)
 
 STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
@@ -107,23 +179,60 @@ async def api_status():
     }
 
 
+@app.get("/metrics")
+async def prometheus_metrics(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)):
+    """Prometheus 指标（包含按 Key 的错误统计，需要管理员密钥）"""
+    if not settings.metrics_enabled:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not credentials or credentials.credentials != settings.admin_key:
+        raise HTTPException(status_code=401, detail="Invalid admin key")
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/health")
 async def health():
     """健康检查"""
     return {"status": "healthy"}
 
 
-@app.post("/v1/chat/completions")
-async def chat_completions(
-    request: ChatCompletionRequest,
-    _: str = Depends(verify_api_key)
-):
-    """
-    OpenAI 兼容的 Chat Completions 接口
-    
-    模型名称会直接透传给上游 API
-    """
-    return await api_proxy.chat_completions(request)
+async def _chat_completions(request: ChatRequest, http_request: Request):
+    access_token = http_request.state.access_token
+    return await api_proxy.chat_completions(
+        request,
+        cache_control=http_request.headers.get("cache-control"),
+        coalesce=access_token.coalesce if access_token else settings.coalesce_admin_key
+    )
+
+
+if settings.passthrough_enabled:
+    @app.post("/v1/chat/completions")
+    async def chat_completions(
+        http_request: Request,
+        _: str = Depends(verify_api_key)
+    ):
+        """
+        OpenAI 兼容的 Chat Completions 接口（透传模式）
+        
+        只扫描请求体顶层的 model / stream 等字段，原始请求体直接转发给上游 API
+        """
+        try:
+            request = RawChatRequest(await http_request.body())
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid request body: {e}")
+        return await _chat_completions(request, http_request)
+else:
+    @app.post("/v1/chat/completions")
+    async def chat_completions(
+        request: ChatCompletionRequest,
+        http_request: Request,
+        _: str = Depends(verify_api_key)
+    ):
+        """
+        OpenAI 兼容的 Chat Completions 接口
+        
+        模型名称会直接透传给上游 API
+        """
+        return await _chat_completions(request, http_request)
 
 
 @app.get("/v1/models")
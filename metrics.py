@@ -0,0 +1,198 @@
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence
+
+# 标签组合数上限，超出后的新组合合并为 "other"，防止按模型名/Key 统计时无限增长
+MAX_SERIES = 1000
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: tuple, series: dict) -> tuple:
+        if labels in series or len(series) < MAX_SERIES:
+            return labels
+        return ("other",) * len(labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """单调递增计数器（只在事件循环线程中更新，无需加锁）"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        key = self._key(labels, self._values)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """直方图，每个标签组合保存各桶计数、总和与次数"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # 标签 -> [各桶计数（非累计，最后一个为 +Inf）, 总和, 次数]
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels, self._series)
+        entry = self._series.get(key)
+        if entry is None:
+            entry = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_str} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """抓取时通过回调读取的当前值（kind="counter" 用于其他模块已有的累计计数）"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float], kind: str = "gauge"):
+        super().__init__(name, documentation)
+        self.callback = callback
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        try:
+            value = float(self.callback())
+        except Exception:
+            return []
+        return self.header() + [f"{self.name} {_format_value(value)}"]
+
+
+class Metrics:
+    """
+    进程内的 Prometheus 指标，由 /metrics 以文本格式输出
+    所有更新都发生在事件循环线程中，只做字典和列表的加法，不加锁
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+        self.auth_seconds = self.histogram(
+            "api_exchange_auth_seconds", "Time spent verifying the caller's API key", ["result"])
+        self.key_acquire_seconds = self.histogram(
+            "api_exchange_key_acquire_seconds", "Time to select and reserve an upstream key", ["result"])
+        self.key_acquire_retries = self.counter(
+            "api_exchange_key_acquire_retries_total", "Key acquisition attempts that found no available key")
+        self.db_query_seconds = self.histogram(
+            "api_exchange_db_query_seconds", "SQLite operation latency", ["op"])
+        self.db_lock_wait_seconds = self.histogram(
+            "api_exchange_db_write_lock_wait_seconds", "Time spent waiting for the SQLite write connection")
+        self.upstream_connect_seconds = self.histogram(
+            "api_exchange_upstream_connect_seconds", "Upstream TCP/TLS connect time for new connections", ["kind"])
+        self.upstream_ttfb_seconds = self.histogram(
+            "api_exchange_upstream_ttfb_seconds", "Time from sending a request to receiving upstream response headers", ["kind"])
+        self.upstream_request_seconds = self.histogram(
+            "api_exchange_upstream_request_seconds", "Total upstream request latency", ["kind"])
+        self.upstream_requests = self.counter(
+            "api_exchange_upstream_requests_total", "Upstream responses by model and status", ["model", "status"])
+        self.upstream_tokens = self.counter(
+            "api_exchange_upstream_tokens_total", "Tokens reported in upstream usage by model", ["model", "kind"])
+        self.upstream_errors = self.counter(
+            "api_exchange_upstream_errors_total", "Classified upstream errors", ["kind"])
+        self.key_errors = self.counter(
+            "api_exchange_key_errors_total", "Upstream error responses by key id", ["key_id", "status"])
+        self.stream_seconds = self.histogram(
+            "api_exchange_stream_duration_seconds", "Duration of streamed responses")
+        self.stream_bytes = self.histogram(
+            "api_exchange_stream_bytes", "Bytes sent per streamed response", buckets=SIZE_BUCKETS)
+        self.token_limited = self.counter(
+            "api_exchange_token_limited_total", "Requests rejected by per-access-token limits", ["reason"])
+        self.failovers = self.counter(
+            "api_exchange_failovers_total", "Requests retried on another key after an upstream error", ["mode"])
+        self.hedges = self.counter(
+            "api_exchange_hedged_requests_total", "Hedged upstream requests by winner", ["winner"])
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, callback: Callable[[], float], kind: str = "gauge") -> Gauge:
+        metric = Gauge(name, documentation, callback, kind)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -108,8 +108,22 @@ class AccessToken(BaseModel):
     request_count: int = 0
     created_at: datetime = Field(default_factory=datetime.now)
     last_used: Optional[datetime] = None
+    # 相同的并发请求合并为一次上游请求
+    coalesce: bool = False
+    # 限流（0 表示不限制）：每秒请求数、并发请求数、每分钟 token 数
+    rps_limit: float = 0.0
+    concurrency_limit: int = 0
+    tpm_limit: int = 0
 
 
-class AccessTokenCreate(BaseModel):
+class AccessTokenLimits(BaseModel):
+    """访问令牌的限流设置（0 表示不限制）"""
+    rps_limit: float = 0.0
+    concurrency_limit: int = 0
+    tpm_limit: int = 0
+
+
+class AccessTokenCreate(AccessTokenLimits):
     """创建访问令牌"""
     name: str
+    coalesce: bool = False
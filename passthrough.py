@@ -0,0 +1,205 @@
+import json
+import re
+from typing import Dict, Optional, Tuple, Union
+
+from models import ChatCompletionRequest
+
+_WHITESPACE = b" \t\r\n"
+# 嵌套值中需要关注的字符：字符串开始和括号
+_STRUCTURAL = re.compile(rb'["\[\]{}]')
+_SCALAR_END = re.compile(rb'[,}\]\s]')
+
+
+def _skip_ws(body: bytes, pos: int) -> int:
+    n = len(body)
+    while pos < n and body[pos] in _WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _string_end(body: bytes, pos: int) -> int:
+    """pos 为字符串的开始引号，返回结束引号之后的位置（用 find 跳过字符串内容，不逐字节解析）"""
+    while True:
+        end = body.find(b'"', pos + 1)
+        if end < 0:
+            raise ValueError("unterminated string")
+        backslash = end - 1
+        while body[backslash] == 0x5C:
+            backslash -= 1
+        # 前面有偶数个反斜杠时引号未被转义
+        if (end - 1 - backslash) % 2 == 0:
+            return end + 1
+        pos = end
+
+
+def _value_end(body: bytes, pos: int) -> int:
+    """返回从 pos 开始的 JSON 值之后的位置（不解码）"""
+    if pos >= len(body):
+        raise ValueError("unexpected end of body")
+    char = body[pos]
+    if char == 0x22:
+        return _string_end(body, pos)
+    if char in b"{[":
+        depth = 0
+        while True:
+            match = _STRUCTURAL.search(body, pos)
+            if match is None:
+                raise ValueError("unterminated object or array")
+            pos = match.start()
+            if body[pos] == 0x22:
+                pos = _string_end(body, pos)
+                continue
+            depth += 1 if body[pos] in b"{[" else -1
+            pos += 1
+            if depth == 0:
+                return pos
+    match = _SCALAR_END.search(body, pos)
+    end = match.start() if match else len(body)
+    if end == pos:
+        raise ValueError(f"unexpected character at position {pos}")
+    return end
+
+
+def scan_members(body: bytes) -> Dict[bytes, Tuple[int, int, int]]:
+    """
+    扫描 JSON 对象的顶层字段，只定位位置，不解码任何值
+    返回 字段名（已解码转义）-> (字段名开始, 值开始, 值结束)，字段名重复时抛出 ValueError
+    """
+    pos = _skip_ws(body, 0)
+    if pos >= len(body) or body[pos] != 0x7B:
+        raise ValueError("request body must be a JSON object")
+    pos = _skip_ws(body, pos + 1)
+    members: Dict[bytes, Tuple[int, int, int]] = {}
+    if pos < len(body) and body[pos] == 0x7D:
+        return members
+    while True:
+        if pos >= len(body) or body[pos] != 0x22:
+            raise ValueError(f"expected a field name at position {pos}")
+        key_start = pos
+        key_end = _string_end(body, pos)
+        pos = _skip_ws(body, key_end)
+        if pos >= len(body) or body[pos] != 0x3A:
+            raise ValueError(f"expected ':' at position {pos}")
+        value_start = _skip_ws(body, pos + 1)
+        value_end = _value_end(body, value_start)
+        name = body[key_start + 1:key_end - 1]
+        if b"\\" in name:
+            # 字段名中有转义（如 "m\u006fdel"）时按 JSON 解码，与上游解析的字段名一致
+            name = json.loads(body[key_start:key_end]).encode("utf-8")
+        if name in members:
+            # 重复字段在不同解析器中取值不同（计价用的 model 可能与上游实际使用的不同），直接拒绝
+            raise ValueError(f"duplicate field {name.decode('utf-8', errors='replace')!r}")
+        members[name] = (key_start, value_start, value_end)
+        pos = _skip_ws(body, value_end)
+        if pos >= len(body):
+            raise ValueError("unexpected end of body")
+        if body[pos] == 0x7D:
+            return members
+        if body[pos] != 0x2C:
+            raise ValueError(f"expected ',' or '}}' at position {pos}")
+        pos = _skip_ws(body, pos + 1)
+
+
+class RawChatRequest:
+    """
+    透传模式下的 Chat Completions 请求
+    只解析顶层的 model / stream / temperature（messages 只检查是否为数组），
+    原始请求体不经 pydantic 和重新序列化直接转发上游，必要时只修改 stream 字段
+    """
+
+    __slots__ = ("body", "model", "stream", "temperature", "_members")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self._members = scan_members(body)
+
+        model = self._decode(b"model")
+        if not isinstance(model, str) or not model:
+            raise ValueError("'model' must be a non-empty string")
+        self.model: str = model
+
+        messages = self._members.get(b"messages")
+        if messages is None or body[messages[1]] != 0x5B:
+            raise ValueError("'messages' must be an array")
+
+        stream = self._decode(b"stream")
+        if stream is not None and not isinstance(stream, bool):
+            raise ValueError("'stream' must be a boolean")
+        self.stream: bool = bool(stream)
+
+        temperature = self._decode(b"temperature")
+        if temperature is not None and (isinstance(temperature, bool) or not isinstance(temperature, (int, float))):
+            raise ValueError("'temperature' must be a number")
+        self.temperature: Optional[float] = temperature
+
+    def _decode(self, name: bytes):
+        member = self._members.get(name)
+        if member is None:
+            return None
+        try:
+            return json.loads(self.body[member[1]:member[2]])
+        except ValueError:
+            raise ValueError(f"invalid value for '{name.decode()}'")
+
+    def with_stream(self, stream: bool) -> bytes:
+        """发往上游的请求体，stream 与原始请求体不同时才复制并修改"""
+        member = self._members.get(b"stream")
+        value = b"true" if stream else b"false"
+        if member is None:
+            if not stream:
+                # 上游默认不使用流式
+                return self.body
+            brace = self.body.index(b"{")
+            return self.body[:brace + 1] + b'"stream":true,' + self.body[brace + 1:]
+        _, start, end = member
+        if self.body[start:end] == value:
+            return self.body
+        return self.body[:start] + value + self.body[end:]
+
+    def cache_body(self) -> bytes:
+        """
+        去掉 stream / stream_options 后的请求体，用作缓存键（流式与非流式请求共享缓存）
+        字段按原始顺序和原始字节拼接，只忽略字段之间的空白
+        """
+        kept = [
+            self.body[key_start:value_end]
+            for name, (key_start, _, value_end) in self._members.items()
+            if name not in (b"stream", b"stream_options")
+        ]
+        return b"{" + b",".join(kept) + b"}"
+
+
+def extract_usage(body: bytes) -> Optional[dict]:
+    """只解码上游响应顶层的 usage 字段（choices 等内容只扫描不解码）"""
+    try:
+        member = scan_members(body).get(b"usage")
+        if member is None:
+            return None
+        usage = json.loads(body[member[1]:member[2]])
+    except ValueError:
+        return None
+    return usage if isinstance(usage, dict) else None
+
+
+def find_usage(tail: bytes) -> Optional[dict]:
+    """
+    在响应末尾的一段字节中查找最后一个 usage 对象（流式响应的最后一个事件，或被截断的 JSON 响应体末尾）
+    usage 对象不完整时返回 None
+    """
+    pos = tail.rfind(b'"usage"')
+    if pos < 0:
+        return None
+    start = _skip_ws(tail, pos + len(b'"usage"'))
+    if start >= len(tail) or tail[start] != 0x3A:
+        return None
+    start = _skip_ws(tail, start + 1)
+    if start >= len(tail) or tail[start] != 0x7B:
+        return None
+    try:
+        usage = json.loads(tail[start:_value_end(tail, start)])
+    except ValueError:
+        return None
+    return usage if isinstance(usage, dict) else None
+
+
+ChatRequest = Union[ChatCompletionRequest, RawChatRequest]
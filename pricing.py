@@ -0,0 +1,80 @@
+import fnmatch
+import re
+from typing import Dict, List, Optional, Tuple
+
+from config import get_settings
+from database import db
+
+DEFAULT_PRICE = 0.08
+
+
+class PricingIndex:
+    """
+    编译后的模型定价索引
+    按 id 顺序把所有通配符规则合并成一个正则（先匹配的规则优先），
+    不含通配符的规则走精确匹配字典，查询结果按模型名缓存
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._matcher: Optional[re.Pattern] = None
+        self._prices: List[float] = []
+        self._exact: Dict[str, float] = {}
+        self._cache: Dict[str, float] = {}
+        # 每次重建递增，依赖价格的缓存据此判断是否需要更新
+        self.version = 0
+        self.loaded = False
+
+    async def load(self):
+        """从数据库重建索引（启动时及定价修改后调用）"""
+        pricing = await db.get_all_pricing()
+        self.build([(p.model_pattern, p.price_per_request) for p in pricing])
+
+    def build(self, rules: List[Tuple[str, float]]):
+        """rules: [(model_pattern, price), ...]，按匹配优先级排序"""
+        parts = []
+        prices = []
+        for index, (pattern, price) in enumerate(rules):
+            parts.append(f"(?P<p{index}>{fnmatch.translate(pattern.lower())})")
+            prices.append(price)
+
+        self._matcher = re.compile("|".join(parts)) if parts else None
+        self._prices = prices
+
+        # 精确规则的价格也按顺序匹配得出，保证与逐条 fnmatch 的结果一致
+        self._exact = {}
+        for pattern, _ in rules:
+            lowered = pattern.lower()
+            if not any(c in lowered for c in "*?[") and lowered not in self._exact:
+                self._exact[lowered] = self._match(lowered)
+
+        self._cache = {}
+        self.version += 1
+        self.loaded = True
+
+    def _match(self, model: str) -> float:
+        if self._matcher is None:
+            return DEFAULT_PRICE
+        m = self._matcher.match(model)
+        if m is None:
+            return DEFAULT_PRICE
+        return self._prices[int(m.lastgroup[1:])]
+
+    def get_price(self, model: str) -> float:
+        """获取模型价格（支持通配符匹配）"""
+        price = self._cache.get(model)
+        if price is not None:
+            return price
+
+        lowered = model.lower()
+        price = self._exact.get(lowered)
+        if price is None:
+            price = self._match(lowered)
+
+        if len(self._cache) >= self.settings.pricing_cache_size:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[model] = price
+        return price
+
+
+pricing_index = PricingIndex()
@@ -0,0 +1,137 @@
+import heapq
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Deque, List, Optional, Tuple
+
+from config import get_settings
+
+
+class SamplingProfiler:
+    """
+    按需开启的采样分析器，运行时通过 /admin/profiler 开关，无需重启
+    - 后台线程每 profiler_interval 秒采集一次事件循环线程的调用栈（最近 60 秒保存在环形缓冲中）
+    - 每个请求结束时（由 tracing 调用），如果它是当前这一分钟内最慢的 top_n 个之一，且不快于上一分钟第 top_n 慢的请求，
+      就把请求期间采集到的栈合并为折叠栈格式（flamegraph.pl / speedscope 可直接读取）保存下来；
+      后一个条件避免每分钟开头的 top_n 个请求不论快慢都被剖析，请求量不足 top_n 的分钟之后不设门槛
+    所有请求共享一个事件循环线程，因此一个请求的剖析结果包含同一时间段内其他请求的 CPU 工作；
+    事件循环空闲（阻塞在 selector 上）的采样被丢弃
+    """
+
+    MAX_PROFILES = 50
+    MAX_STACKS = 100
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.top_n = self.settings.profiler_top_n
+        self.interval = self.settings.profiler_interval
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        # (monotonic 时间, 折叠栈)
+        self._samples: Deque[Tuple[float, str]] = deque()
+        self._window_minute = 0
+        # 当前这一分钟内最慢的 top_n 个请求的 (耗时, trace_id) 最小堆
+        self._window: List[Tuple[float, str]] = []
+        # 上一分钟第 top_n 慢的请求耗时，慢于它才剖析
+        self._threshold = 0.0
+        self.profiles: Deque[dict] = deque(maxlen=self.MAX_PROFILES)
+        self.sample_count = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._thread is not None
+
+    def enable(self, top_n: Optional[int] = None, interval: Optional[float] = None):
+        """在事件循环线程中调用，开始采样该线程"""
+        if top_n is not None:
+            self.top_n = top_n
+        if interval is not None:
+            self.interval = interval
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        with self._lock:
+            self._samples = deque(maxlen=max(int(60 / self.interval), 1))
+        self._thread = threading.Thread(
+            target=self._sample_loop,
+            args=(threading.get_ident(),),
+            name="sampling-profiler",
+            daemon=True
+        )
+        self._thread.start()
+
+    def disable(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=1.0)
+        self._thread = None
+        with self._lock:
+            self._samples.clear()
+
+    def _sample_loop(self, target: int):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                continue
+            # 事件循环空闲
+            if frame.f_code.co_filename.endswith("selectors.py"):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.reverse()
+            with self._lock:
+                self._samples.append((time.monotonic(), ";".join(stack)))
+            self.sample_count += 1
+
+    def request_finished(self, trace_id: str, name: str, started: float, ended: float, duration: float):
+        """
+        请求结束时调用（started/ended 为 monotonic 时间），只剖析每分钟最慢的 top_n 个请求
+        （在线判断：进入当前分钟的前 top_n 且不快于上一分钟的第 top_n 个，结果是近似的）
+        """
+        if self._thread is None:
+            return
+        minute = int(time.time() // 60)
+        if minute != self._window_minute:
+            full = minute == self._window_minute + 1 and len(self._window) >= self.top_n
+            self._threshold = self._window[0][0] if full and self._window else 0.0
+            self._window_minute = minute
+            self._window = []
+        if len(self._window) < self.top_n:
+            heapq.heappush(self._window, (duration, trace_id))
+        elif self._window and duration > self._window[0][0]:
+            heapq.heapreplace(self._window, (duration, trace_id))
+        else:
+            return
+        if duration < self._threshold:
+            return
+
+        with self._lock:
+            samples = [stack for t, stack in self._samples if started <= t <= ended]
+        counts = Counter(samples)
+        self.profiles.append({
+            "trace_id": trace_id,
+            "name": name,
+            "duration": round(duration, 6),
+            "captured_at": time.time(),
+            "samples": len(samples),
+            "stacks": [{"stack": stack, "count": count} for stack, count in counts.most_common(self.MAX_STACKS)]
+        })
+
+    def get_status(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "top_n": self.top_n,
+            "interval": self.interval,
+            "samples": self.sample_count,
+            "profiles": len(self.profiles)
+        }
+
+
+profiler = SamplingProfiler()
@@ -1,147 +1,513 @@
 import httpx
 import json
 import asyncio
-from typing import AsyncGenerator, Optional
+import time
+from functools import partial
+from typing import AsyncGenerator, Awaitable, Callable, Dict, Optional, Tuple
 from fastapi import HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 
-from models import ChatCompletionRequest, APIKeyRecord
+from models import APIKeyRecord
+from key_pool import Reservation
 from config import get_settings
 from key_manager import key_manager
 from database import db
+from hedging import hedge_policy
+from pricing import pricing_index
+from response_cache import response_cache
+from metrics import metrics
+from passthrough import ChatRequest, RawChatRequest, extract_usage, find_usage
+from token_limits import token_limiter
+from tracing import SPAN_KIND_CLIENT, tracer
+from upstream import RequestTimer, upstream_client
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no"
+}
+
+# 转发给客户端的上游响应头，其余不转发：Content-Length、Content-Encoding 由本服务重新生成，
+# openai-organization / openai-project 和 x-ratelimit-* 会暴露上游账号、所用 Key 及其剩余额度
+FORWARD_HEADERS = frozenset(("content-type", "openai-processing-ms", "x-request-id"))
+
+# 统计流式响应的 usage 时保留的末尾字节数
+USAGE_TAIL_BYTES = 4096
+
+
+class _FlightAborted(Exception):
+    """被合并请求的第一个请求被取消或出现非 HTTP 错误"""
+
+
+class _CleanupStreamingResponse(StreamingResponse):
+    """
+    发送结束后执行 cleanup（释放预留、关闭上游响应）
+    客户端在开始迭代前断开时生成器不会启动，其 finally 不会执行；
+    Starlette 的 background 在发送出错时也会被跳过，因此在 __call__ 外层清理，cleanup 需要可以重复调用
+    """
+
+    def __init__(self, content, cleanup: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(content, **kwargs)
+        self._cleanup = cleanup
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self._cleanup()
 
 
 class APIProxy:
     def __init__(self):
         self.settings = get_settings()
         self.base_url = self.settings.upstream_base_url.rstrip("/")
+        # /v1/models 缓存：上游返回的列表、附带价格后序列化的响应体
+        self._models: Optional[dict] = None
+        self._models_fetched_at = 0.0
+        self._models_body: Optional[bytes] = None
+        self._models_pricing_version = -1
+        self._models_refresh: Optional[asyncio.Task] = None
+        # 相同请求合并：请求哈希 -> 第一个请求的结果
+        self._flights: Dict[str, asyncio.Future] = {}
+        self.coalesce_leaders = 0
+        self.coalesce_followers = 0
+        self.coalesce_timeouts = 0
     
     async def _make_request(
         self,
         key: APIKeyRecord,
-        request: ChatCompletionRequest,
-        stream: bool = False
+        request: ChatRequest,
+        stream: bool = False,
+        read_body: bool = True
     ) -> httpx.Response:
-        """发送请求到上游 API"""
+        """
+        发送请求到上游 API
+        read_body=False 时只读取响应头，成功响应的响应体由调用方读取并关闭（错误响应仍会读完）
+        """
         headers = {
             "Authorization": f"Bearer {key.key}",
             "Content-Type": "application/json"
         }
+        body = self._body(request, stream)
         
+        client = upstream_client.client
+        timer = RequestTimer("chat_stream" if stream else "chat")
+        with upstream_client.track(), tracer.span(f"upstream.{timer.kind}", SPAN_KIND_CLIENT) as span:
+            span.set("key_id", key.id)
+            span.set("model", request.model)
+            try:
+                if stream:
+                    response = await client.post(
+                        f"{self.base_url}/chat/completions",
+                        headers=headers,
+                        timeout=upstream_client.stream_timeout(),
+                        extensions=timer.extensions,
+                        **body
+                    )
+                else:
+                    started = time.monotonic()
+                    upstream_request = client.build_request(
+                        "POST",
+                        f"{self.base_url}/chat/completions",
+                        headers=headers,
+                        extensions=timer.extensions,
+                        **body
+                    )
+                    response = await client.send(upstream_request, stream=not read_body)
+                    if response.status_code != 200:
+                        if not read_body:
+                            await response.aread()
+                    elif read_body:
+                        hedge_policy.record_latency(time.monotonic() - started)
+            except httpx.HTTPError as e:
+                self._record_result(key, request.model, "timeout" if isinstance(e, httpx.TimeoutException) else "error")
+                key_manager.record_transport_error(key.id, e)
+                raise
+            timer.finish()
+            self._record_result(key, request.model, response.status_code)
+            span.set("http.status_code", response.status_code)
+            if response.status_code != 200:
+                span.fail(f"HTTP {response.status_code}")
+            return response
+    
+    @staticmethod
+    def _body(request: ChatRequest, stream: bool) -> dict:
+        """
+        上游请求体（httpx 参数）：透传模式直接使用原始字节，只在需要时修改 stream，
+        否则由 pydantic 模型重新序列化
+        """
+        if isinstance(request, RawChatRequest):
+            return {"content": request.with_stream(stream)}
         payload = request.model_dump(exclude_none=True)
         payload["stream"] = stream
+        return {"json": payload}
+    
+    @staticmethod
+    def _forward_headers(response: httpx.Response) -> Dict[str, str]:
+        return {
+            name: value for name, value in response.headers.items()
+            if name.lower() in FORWARD_HEADERS
+        }
+    
+    def _upstream_response(self, response: httpx.Response, model: str) -> Response:
+        """直接返回上游响应体，不解析再序列化；usage 只扫描顶层字段"""
+        body = response.content
+        usage = extract_usage(body)
+        if usage:
+            for kind in ("prompt_tokens", "completion_tokens"):
+                tokens = usage.get(kind)
+                if isinstance(tokens, int):
+                    metrics.upstream_tokens.inc(model, kind[:-len("_tokens")], amount=tokens)
+            token_limiter.record_usage(usage)
+        return Response(
+            content=body,
+            headers=self._forward_headers(response),
+            media_type=None if "content-type" in response.headers else "application/json"
+        )
+    
+    @staticmethod
+    async def _forward_body(response: httpx.Response) -> AsyncGenerator[bytes, None]:
+        """边收边转发上游响应体，访问令牌有 TPM 限制时从响应体末尾读取 usage"""
+        track_usage = token_limiter.wants_usage()
+        tail = b""
+        try:
+            async for chunk in response.aiter_bytes():
+                if track_usage:
+                    tail = (tail + chunk)[-USAGE_TAIL_BYTES:]
+                yield chunk
+        finally:
+            await response.aclose()
+            if track_usage:
+                token_limiter.record_usage(find_usage(tail))
+    
+    @staticmethod
+    def _clone(response: Response) -> Response:
+        """合并的请求共享同一个上游响应，各自返回独立的 Response（中间件会修改响应头）"""
+        return Response(content=response.body, status_code=response.status_code, headers=dict(response.headers))
+    
+    @staticmethod
+    def _record_result(key: APIKeyRecord, model: str, status):
+        """按模型和 Key 统计上游响应状态"""
+        status = str(status)
+        metrics.upstream_requests.inc(model, status)
+        if status != "200":
+            metrics.key_errors.inc(str(key.id), status)
+    
+    async def _hedged_request(
+        self,
+        reservation: Reservation,
+        request: ChatRequest
+    ) -> Tuple[httpx.Response, Reservation]:
+        """
+        发送请求，主请求超过对冲延迟仍未返回时用另一个 Key 发送副本
+        返回最先成功的响应及其对应的预留，另一个请求会被取消并释放其预留
+        """
+        if not hedge_policy.enabled_for(request.model):
+            return await self._make_request(reservation.key, request, stream=False), reservation
         
-        async with httpx.AsyncClient(timeout=self.settings.request_timeout) as client:
-            if stream:
-                return await client.post(
-                    f"{self.base_url}/chat/completions",
-                    headers=headers,
-                    json=payload,
-                    timeout=None
-                )
-            else:
-                return await client.post(
-                    f"{self.base_url}/chat/completions",
-                    headers=headers,
-                    json=payload
-                )
+        hedge_policy.request_started()
+        primary = asyncio.create_task(self._make_request(reservation.key, request, stream=False))
+        hedge = None
+        hedge_reservation = None
+        winner = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=hedge_policy.delay())
+            if done or not hedge_policy.try_acquire():
+                return await primary, reservation
+            
+            hedge_reservation = await key_manager.reserve_key(reservation.amount, exclude=reservation.key.id)
+            if not hedge_reservation:
+                return await primary, reservation
+            
+            hedge = asyncio.create_task(self._make_request(hedge_reservation.key, request, stream=False))
+            reservations = {primary: reservation, hedge: hedge_reservation}
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    if error is None and task.result().status_code == 200:
+                        winner = task
+                        if task is hedge:
+                            hedge_policy.hedge_wins += 1
+                        metrics.hedges.inc("hedge" if task is hedge else "primary")
+                        return task.result(), reservations[task]
+                    if task is not hedge:
+                        continue
+                    if error is None:
+                        hedge_response = task.result()
+                        await key_manager.handle_request_error(
+                            hedge_reservation.key.id,
+                            hedge_response.status_code,
+                            hedge_response.content,
+                            hedge_response.headers
+                        )
+                    elif not isinstance(error, httpx.HTTPError):
+                        # httpx 的连接错误和超时已在 _make_request 中计入熔断器
+                        key_manager.record_transport_error(hedge_reservation.key.id, error)
+            
+            # 两个请求都失败时按主请求的结果处理
+            metrics.hedges.inc("none")
+            return primary.result(), reservation
+        finally:
+            # 调用方被取消时主请求和对冲请求都不能继续占用 Key
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+            # 只保留返回的预留，由调用方结算或释放
+            if hedge_reservation is not None:
+                await key_manager.release(reservation if winner is hedge else hedge_reservation)
     
     async def _stream_response(
         self,
-        key: APIKeyRecord,
-        request: ChatCompletionRequest,
-        price: float
+        reservation: Reservation,
+        request: ChatRequest
     ) -> AsyncGenerator[bytes, None]:
         """处理流式响应"""
+        key = reservation.key
         headers = {
             "Authorization": f"Bearer {key.key}",
             "Content-Type": "application/json"
         }
-        
-        payload = request.model_dump(exclude_none=True)
-        payload["stream"] = True
+        body = self._body(request, True)
+        timer = RequestTimer("chat_stream")
+        # 异步生成器跨 yield 不能切换当前 span，这里只创建 span 并手动结束
+        span = tracer.start("upstream.chat_stream", SPAN_KIND_CLIENT)
+        span.set("key_id", key.id)
+        span.set("model", request.model)
         
         try:
-            async with httpx.AsyncClient(timeout=None) as client:
-                async with client.stream(
+            with upstream_client.track():
+                async with upstream_client.client.stream(
                     "POST",
                     f"{self.base_url}/chat/completions",
                     headers=headers,
-                    json=payload
+                    timeout=upstream_client.stream_timeout(),
+                    extensions=timer.extensions,
+                    **body
                 ) as response:
+                    self._record_result(key, request.model, response.status_code)
+                    span.set("http.status_code", response.status_code)
                     if response.status_code != 200:
+                        span.fail(f"HTTP {response.status_code}")
                         error_body = await response.aread()
                         error_text = error_body.decode("utf-8")
                         
-                        should_retry = await key_manager.handle_request_error(
-                            key.id, error_text
+                        error = await key_manager.handle_request_error(
+                            key.id, response.status_code, error_body, response.headers
                         )
                         
-                        if should_retry:
-                            new_key, new_price, _ = await key_manager.get_key_with_retry(request.model)
-                            if new_key:
-                                async for chunk in self._stream_response(new_key, request, new_price):
-                                    yield chunk
+                        if error.retryable:
+                            metrics.failovers.inc("stream")
+                            new_reservation, _, _ = await key_manager.get_key_with_retry(request.model)
+                            if new_reservation:
+                                try:
+                                    async for chunk in self._stream_response(new_reservation, request):
+                                        yield chunk
+                                finally:
+                                    # 客户端断开时内层生成器不一定被关闭
+                                    await key_manager.release(new_reservation)
                                 return
                         
                         yield f"data: {json.dumps({'error': error_text})}\n\n".encode()
                         return
                     
-                    await key_manager.deduct_balance(key.id, price)
+                    await key_manager.settle(reservation, response.headers)
                     
-                    async for chunk in response.aiter_bytes():
-                        yield chunk
+                    started = time.perf_counter()
+                    sent = 0
+                    # 访问令牌有 TPM 限制时从最后的事件中读取 usage（需要客户端设置 stream_options.include_usage）
+                    track_usage = token_limiter.wants_usage()
+                    tail = b""
+                    try:
+                        async for chunk in response.aiter_bytes():
+                            sent += len(chunk)
+                            if track_usage:
+                                tail = (tail + chunk)[-USAGE_TAIL_BYTES:]
+                            yield chunk
+                        if track_usage:
+                            token_limiter.record_usage(find_usage(tail))
+                    finally:
+                        metrics.stream_seconds.observe(time.perf_counter() - started)
+                        metrics.stream_bytes.observe(sent)
+                        span.set("bytes", sent)
+                        timer.finish()
                         
-        except httpx.TimeoutException:
+        except httpx.TimeoutException as e:
+            self._record_result(key, request.model, "timeout")
+            key_manager.record_transport_error(key.id, e)
+            span.fail("Request timeout")
             yield f"data: {json.dumps({'error': 'Request timeout'})}\n\n".encode()
         except Exception as e:
+            if isinstance(e, httpx.HTTPError):
+                key_manager.record_transport_error(key.id, e)
+            span.fail(f"{type(e).__name__}: {e}")
             yield f"data: {json.dumps({'error': str(e)})}\n\n".encode()
+        finally:
+            span.end()
+            await key_manager.release(reservation)
+    
+    @staticmethod
+    def _charge_usage(body: bytes):
+        """没有请求上游的响应（缓存命中、合并等待）同样按响应中的 usage 计入访问令牌的 TPM"""
+        if token_limiter.wants_usage():
+            token_limiter.record_usage(extract_usage(body))
+    
+    def _cached_response(self, body: bytes, stream: bool):
+        """返回缓存的响应，流式请求重放为 SSE"""
+        self._charge_usage(body)
+        if stream:
+            return StreamingResponse(
+                response_cache.replay_stream(body),
+                media_type="text/event-stream",
+                headers={**SSE_HEADERS, "X-Cache": "HIT"}
+            )
+        return Response(content=body, media_type="application/json", headers={"X-Cache": "HIT"})
     
     async def chat_completions(
         self,
-        request: ChatCompletionRequest,
-        max_retries: int = 3
+        request: ChatRequest,
+        max_retries: int = 3,
+        cache_control: Optional[str] = None,
+        coalesce: bool = False
+    ):
+        """
+        处理 Chat Completions 请求
+        cache_control 为客户端的 Cache-Control 头：no-cache 跳过缓存查询，no-store 不写入缓存
+        coalesce 为 True 时合并相同的并发非流式请求
+        """
+        cache_key = None
+        if response_cache.cacheable(request):
+            cache_key = response_cache.make_key(request)
+            directives = (cache_control or "").lower()
+            if "no-cache" in directives:
+                response_cache.record_bypass()
+            else:
+                cached = await response_cache.get(cache_key)
+                if cached is not None:
+                    return self._cached_response(cached, request.stream)
+            if "no-store" in directives:
+                cache_key = None
+        
+        if coalesce and not request.stream and self.settings.coalesce_enabled:
+            return await self._coalesced(request, max_retries, cache_key)
+        return await self._complete(request, max_retries, cache_key)
+    
+    async def _coalesced(self, request: ChatRequest, max_retries: int, cache_key: Optional[str]):
+        """
+        合并相同的并发请求：第一个请求发往上游，其余请求等待并共享其结果（只扣一次费）
+        等待超过 coalesce_max_wait 秒或第一个请求被中断时，自行发送请求
+        """
+        flight_key = cache_key or response_cache.make_key(request)
+        leader = self._flights.get(flight_key)
+        if leader is not None:
+            self.coalesce_followers += 1
+            try:
+                response = await asyncio.wait_for(asyncio.shield(leader), self.settings.coalesce_max_wait)
+                self._charge_usage(response.body)
+                return self._clone(response)
+            except asyncio.TimeoutError:
+                self.coalesce_timeouts += 1
+            except _FlightAborted:
+                pass
+            return await self._complete(request, max_retries, cache_key)
+        
+        future = asyncio.get_running_loop().create_future()
+        # 没有等待者时也标记异常已读取，避免 asyncio 打印警告
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._flights[flight_key] = future
+        self.coalesce_leaders += 1
+        try:
+            result = await self._complete(request, max_retries, cache_key, buffered=True)
+        except HTTPException as e:
+            future.set_exception(e)
+            raise
+        except BaseException:
+            future.set_exception(_FlightAborted())
+            raise
+        else:
+            future.set_result(result)
+            return self._clone(result)
+        finally:
+            self._flights.pop(flight_key, None)
+    
+    def get_coalesce_stats(self) -> dict:
+        return {
+            "enabled": self.settings.coalesce_enabled,
+            "in_flight": len(self._flights),
+            "leaders": self.coalesce_leaders,
+            "followers": self.coalesce_followers,
+            "timeouts": self.coalesce_timeouts
+        }
+    
+    async def _complete(
+        self,
+        request: ChatRequest,
+        max_retries: int,
+        cache_key: Optional[str],
+        buffered: bool = False
     ):
-        """处理 Chat Completions 请求"""
-        key, price, _ = await key_manager.get_key_with_retry(request.model, max_retries)
+        """
+        选择 Key 并请求上游，成功时直接返回上游响应体
+        开启 upstream_stream_through 时，不需要缓存、对冲和合并（buffered=False）的非流式请求
+        边收边转发响应体，不在内存中保留完整响应
+        """
+        reservation, price, _ = await key_manager.get_key_with_retry(request.model, max_retries)
         
-        if not key:
+        if not reservation:
             raise HTTPException(
                 status_code=503,
                 detail=f"No available API keys with sufficient balance (need ${price:.2f}). Please add more keys."
             )
         
         if request.stream:
-            return StreamingResponse(
-                self._stream_response(key, request, price),
+            return _CleanupStreamingResponse(
+                self._stream_response(reservation, request),
+                partial(key_manager.release, reservation),
                 media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "X-Accel-Buffering": "no"
-                }
+                headers=SSE_HEADERS
             )
         
+        stream_through = (
+            self.settings.upstream_stream_through
+            and not buffered
+            and cache_key is None
+            and not hedge_policy.enabled_for(request.model)
+        )
         retries = 0
-        current_key = key
-        current_price = price
+        current = reservation
         
         while retries < max_retries:
+            attempt = current
             try:
-                response = await self._make_request(current_key, request, stream=False)
+                if stream_through:
+                    response = await self._make_request(current.key, request, read_body=False)
+                else:
+                    response, attempt = await self._hedged_request(current, request)
                 
                 if response.status_code == 200:
-                    await key_manager.deduct_balance(current_key.id, current_price)
-                    return response.json()
+                    await key_manager.settle(attempt, response.headers)
+                    if stream_through:
+                        return _CleanupStreamingResponse(
+                            self._forward_body(response),
+                            response.aclose,
+                            headers=self._forward_headers(response),
+                            media_type=None if "content-type" in response.headers else "application/json"
+                        )
+                    if cache_key:
+                        await response_cache.put(cache_key, response.content)
+                    return self._upstream_response(response, request.model)
                 
                 error_text = response.text
-                should_retry = await key_manager.handle_request_error(
-                    current_key.id, error_text
+                error = await key_manager.handle_request_error(
+                    attempt.key.id, response.status_code, response.content, response.headers
                 )
                 
-                if should_retry:
-                    current_key, current_price, _ = await key_manager.get_key_with_retry(request.model)
-                    if not current_key:
+                if error.retryable:
+                    metrics.failovers.inc("non_stream")
+                    current, _, _ = await key_manager.get_key_with_retry(request.model)
+                    if not current:
                         raise HTTPException(
                             status_code=503,
                             detail="All API keys exhausted"
@@ -166,17 +532,57 @@ class APIProxy:
                     status_code=500,
                     detail=f"Internal error: {str(e)}"
                 )
+            finally:
+                # 已结算的预留不会重复释放
+                await key_manager.release(attempt)
         
+        await key_manager.release(current)
         raise HTTPException(
             status_code=503,
             detail="Max retries exceeded"
         )
     
     async def list_models(self):
-        """获取可用模型列表"""
-        key = await key_manager.get_key()
+        """
+        获取可用模型列表（附带每个模型的价格）
+        上游列表缓存 models_cache_ttl 秒，过期后 models_cache_stale 秒内先返回旧列表并在后台刷新，
+        同一时间只有一个刷新请求
+        """
+        age = time.monotonic() - self._models_fetched_at
+        ttl = self.settings.models_cache_ttl
+        if self._models is None or age >= ttl + self.settings.models_cache_stale:
+            # 没有可用的缓存，等待刷新（并发请求共享同一个刷新）
+            fallback = await asyncio.shield(self._models_refresh_task())
+            if self._models is None:
+                return fallback
+        elif age >= ttl:
+            self._models_refresh_task()
         
-        if not key:
+        if not pricing_index.loaded:
+            await pricing_index.load()
+        if self._models_body is None or self._models_pricing_version != pricing_index.version:
+            data = [
+                {**model, "price_per_request": pricing_index.get_price(model["id"])}
+                if isinstance(model, dict) and isinstance(model.get("id"), str) else model
+                for model in self._models.get("data") or []
+            ]
+            self._models_body = json.dumps({**self._models, "data": data}, ensure_ascii=False).encode()
+            self._models_pricing_version = pricing_index.version
+        return Response(content=self._models_body, media_type="application/json")
+    
+    def _models_refresh_task(self) -> asyncio.Task:
+        if self._models_refresh is None or self._models_refresh.done():
+            self._models_refresh = asyncio.create_task(self._fetch_models())
+        return self._models_refresh
+    
+    async def _fetch_models(self) -> dict:
+        """
+        从上游获取模型列表，成功时更新缓存
+        失败时保留旧缓存，返回默认列表供没有缓存时使用
+        """
+        reservation = await key_manager.reserve_key()
+        
+        if not reservation:
             return {
                 "object": "list",
                 "data": []
@@ -184,18 +590,26 @@ class APIProxy:
         
         try:
             headers = {
-                "Authorization": f"Bearer {key.key}",
+                "Authorization": f"Bearer {reservation.key.key}",
                 "Content-Type": "application/json"
             }
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(
+            timer = RequestTimer("models")
+            with upstream_client.track():
+                response = await upstream_client.client.get(
                     f"{self.base_url}/models",
-                    headers=headers
+                    headers=headers,
+                    timeout=30.0,
+                    extensions=timer.extensions
                 )
+                timer.finish()
                 
                 if response.status_code == 200:
-                    return response.json()
+                    models = response.json()
+                    self._models = models
+                    self._models_body = None
+                    self._models_fetched_at = time.monotonic()
+                    return models
                 
                 return {
                     "object": "list",
@@ -213,6 +627,8 @@ class APIProxy:
                 "object": "list",
                 "data": []
             }
+        finally:
+            await key_manager.release(reservation)
 
 
 api_proxy = APIProxy()
@@ -0,0 +1,260 @@
+import time
+from typing import Dict, List, Mapping, Optional
+
+from config import get_settings
+from upstream_errors import parse_request_limit, parse_retry_after
+
+
+class TokenBucket:
+    """令牌桶：容量 capacity，每秒补充 rate 个令牌"""
+
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float, tokens: Optional[float] = None):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity if tokens is None else tokens
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def available(self, now: Optional[float] = None) -> float:
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens
+
+    def try_take(self, amount: float = 1.0, now: Optional[float] = None) -> bool:
+        """令牌足够时取出并返回 True"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def take(self, amount: float, now: Optional[float] = None):
+        """直接扣除令牌（可以扣成负数，用于事后才知道数量的扣除）"""
+        self._refill(time.monotonic() if now is None else now)
+        self.tokens -= amount
+
+    def wait_time(self, amount: float = 1.0, now: Optional[float] = None) -> float:
+        """还需要等待多少秒才有 amount 个令牌"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= amount:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (amount - self.tokens) / self.rate
+
+
+class _KeyLimit:
+    __slots__ = ("bucket", "from_headers", "learned_at", "cooldown_until", "limited")
+
+    def __init__(self):
+        self.bucket: Optional[TokenBucket] = None
+        self.from_headers = False
+        self.learned_at = 0.0
+        self.cooldown_until = 0.0
+        self.limited = 0
+
+
+class KeyRateLimits:
+    """
+    每个 Key 的请求速率限制（进程内），从上游响应中学习，不需要配置
+    - 响应头带 x-ratelimit-limit-requests / -remaining-requests 且剩余次数不多（低于限额的 1/5）时，
+      按该限额建立令牌桶（容量为限额，每 key_rate_limit_window 秒补满），并用 remaining 校正剩余令牌，
+      remaining 为 0 时冷却到 x-ratelimit-reset-requests
+    - 收到 429 时，Key 按 Retry-After / x-ratelimit-reset-*（没有时为 key_rate_limit_cooldown）冷却，
+      没有限额响应头时用最近一个窗口内发出的请求数估算限额，已有估算值时再按 3/4 收紧；
+      估算的限额 key_rate_limit_ttl 秒后失效，重新学习（上游可能已提高限额）
+    选择 Key 时跳过冷却中或令牌用完的 Key，令牌补充后自动恢复
+
+    只为被限流过或接近限额的 Key 保存状态；暂时不可用的 Key 及其恢复时间单独保存在 _blocked 中，
+    选 Key、blocked_ids 和 next_ready_in 只访问这部分 Key，与 Key 池大小无关
+    """
+
+    # 响应头中的剩余次数低于限额的该比例时才开始按令牌桶调度
+    HEADER_TRACK_RATIO = 0.2
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._limits: Dict[int, _KeyLimit] = {}
+        # 暂时不可用的 Key -> 预计恢复时间（monotonic）
+        self._blocked: Dict[int, float] = {}
+        # 当前窗口和上一个窗口内各 Key 的请求数（所有 Key 共用窗口，换窗口时整体替换）
+        self._window_start = time.monotonic()
+        self._counts: Dict[int, int] = {}
+        self._prev_counts: Dict[int, int] = {}
+        self.rate_limited = 0
+
+    def blocked(self, key_id: int) -> bool:
+        """Key 是否在冷却中或令牌已用完"""
+        ready_at = self._blocked.get(key_id)
+        if ready_at is None:
+            return False
+        if time.monotonic() < ready_at:
+            return True
+        del self._blocked[key_id]
+        return False
+
+    def blocked_ids(self) -> List[int]:
+        now = time.monotonic()
+        for key_id in [key_id for key_id, ready_at in self._blocked.items() if ready_at <= now]:
+            del self._blocked[key_id]
+        return list(self._blocked)
+
+    def _update_blocked(self, key_id: int, limit: _KeyLimit, now: float):
+        """按冷却时间和令牌数重新计算 Key 的恢复时间"""
+        ready_at = limit.cooldown_until
+        if limit.bucket is not None:
+            ready_at = max(ready_at, now + limit.bucket.wait_time(1.0, now))
+        if ready_at > now:
+            self._blocked[key_id] = ready_at
+        else:
+            self._blocked.pop(key_id, None)
+
+    def _count(self, key_id: int, now: float):
+        window = self.settings.key_rate_limit_window
+        elapsed = now - self._window_start
+        if elapsed >= window:
+            self._prev_counts = self._counts if elapsed < 2 * window else {}
+            self._counts = {}
+            self._window_start = now - elapsed % window
+        self._counts[key_id] = self._counts.get(key_id, 0) + 1
+
+    def _recent(self, key_id: int, now: float) -> float:
+        """最近一个窗口内（滑动）的请求数估计"""
+        window = self.settings.key_rate_limit_window
+        overlap = max(1.0 - (now - self._window_start) / window, 0.0)
+        return self._counts.get(key_id, 0) + self._prev_counts.get(key_id, 0) * overlap
+
+    def on_selected(self, key_id: int):
+        """Key 被选中发送请求：计数，有限额时取出一个令牌"""
+        now = time.monotonic()
+        self._count(key_id, now)
+        limit = self._limits.get(key_id)
+        if limit is None or limit.bucket is None:
+            return
+        if self._expired(key_id, limit, now):
+            return
+        limit.bucket.take(1.0, now)
+        if limit.bucket.tokens < 1.0:
+            self._update_blocked(key_id, limit, now)
+
+    def _expired(self, key_id: int, limit: _KeyLimit, now: float) -> bool:
+        """
+        不再需要的状态直接删除：估算的限额超过 key_rate_limit_ttl，
+        或响应头学习的令牌桶已补满（下次接近限额时重新学习）
+        """
+        if now < limit.cooldown_until:
+            return False
+        bucket = limit.bucket
+        if bucket is not None:
+            if limit.from_headers:
+                if bucket.available(now) < bucket.capacity:
+                    return False
+            elif now - limit.learned_at < self.settings.key_rate_limit_ttl:
+                return False
+        del self._limits[key_id]
+        self._blocked.pop(key_id, None)
+        return True
+
+    def observe(self, key_id: int, headers: Optional[Mapping[str, str]]):
+        """从成功响应的限额响应头学习限额"""
+        if not self.settings.key_rate_limit_enabled:
+            return
+        parsed = parse_request_limit(headers)
+        if parsed is None:
+            return
+        limit_value, remaining = parsed
+        if limit_value <= 0:
+            return
+        limit = self._limits.get(key_id)
+        if limit is None:
+            if remaining >= limit_value * self.HEADER_TRACK_RATIO:
+                return
+            limit = self._limits[key_id] = _KeyLimit()
+        now = time.monotonic()
+        rate = limit_value / self.settings.key_rate_limit_window
+        if limit.bucket is None:
+            limit.bucket = TokenBucket(limit_value, rate, remaining)
+        else:
+            limit.bucket.capacity = limit_value
+            limit.bucket.rate = rate
+            limit.bucket.tokens = remaining
+            limit.bucket.updated = now
+        limit.from_headers = True
+        limit.learned_at = now
+        if remaining == 0:
+            # 次数已用完时按 x-ratelimit-reset-requests 冷却
+            reset = parse_retry_after(headers)
+            if reset:
+                limit.cooldown_until = max(limit.cooldown_until, now + reset)
+        self._update_blocked(key_id, limit, now)
+
+    def on_rate_limited(self, key_id: int, retry_after: Optional[float], headers: Optional[Mapping[str, str]] = None):
+        """收到 429：冷却 Key，并学习或收紧限额"""
+        now = time.monotonic()
+        limit = self._limits.get(key_id)
+        if limit is None:
+            limit = self._limits[key_id] = _KeyLimit()
+        limit.limited += 1
+        self.rate_limited += 1
+        cooldown = retry_after if retry_after is not None else self.settings.key_rate_limit_cooldown
+        limit.cooldown_until = max(limit.cooldown_until, now + cooldown)
+        if self.settings.key_rate_limit_enabled:
+            self._learn(key_id, limit, headers, now)
+        self._update_blocked(key_id, limit, now)
+
+    def _learn(self, key_id: int, limit: _KeyLimit, headers: Optional[Mapping[str, str]], now: float):
+        self.observe(key_id, headers)
+        if limit.from_headers and limit.bucket is not None:
+            limit.bucket.tokens = min(limit.bucket.tokens, 0.0)
+            return
+        if limit.bucket is None:
+            # 本次被拒绝的请求不计入限额
+            capacity = max(int(self._recent(key_id, now)) - 1, 1)
+        else:
+            capacity = max(int(limit.bucket.capacity * 0.75), 1)
+        limit.bucket = TokenBucket(capacity, capacity / self.settings.key_rate_limit_window, 0.0)
+        limit.learned_at = now
+
+    def next_ready_in(self) -> Optional[float]:
+        """暂时不可用的 Key 中最早恢复还需要的秒数，没有时返回 None"""
+        blocked = self.blocked_ids()
+        if not blocked:
+            return None
+        return min(self._blocked[key_id] for key_id in blocked) - time.monotonic()
+
+    def reset(self, key_id: int) -> bool:
+        self._blocked.pop(key_id, None)
+        return self._limits.pop(key_id, None) is not None
+
+    def remove(self, key_id: int):
+        self._blocked.pop(key_id, None)
+        self._limits.pop(key_id, None)
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        keys = []
+        for key_id, limit in list(self._limits.items()):
+            if self._expired(key_id, limit, now):
+                continue
+            bucket = limit.bucket
+            keys.append({
+                "key_id": key_id,
+                "cooling_in": round(max(limit.cooldown_until - now, 0.0), 3),
+                "limit": bucket.capacity if bucket else None,
+                "tokens": round(bucket.available(now), 2) if bucket else None,
+                "source": ("headers" if limit.from_headers else "learned") if bucket else None,
+                "rate_limited": limit.limited
+            })
+        return {
+            "enabled": self.settings.key_rate_limit_enabled,
+            "window": self.settings.key_rate_limit_window,
+            "tracked": len(self._limits),
+            "limited": len(self.blocked_ids()),
+            "rate_limited_total": self.rate_limited,
+            "keys": keys
+        }
@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import AsyncGenerator, Optional, Tuple
+
+from config import get_settings
+from passthrough import ChatRequest, RawChatRequest
+
+
+class ResponseCache:
+    """
+    确定性请求（temperature=0）的响应缓存
+    - 键：去掉 stream 后的请求体按 key 排序序列化的 sha256
+    - 内存层：按字节数限制的 LRU，条目带 TTL
+    - 磁盘层（可选）：response_cache_dir 下每个响应一个文件，多个 worker 共享
+    命中缓存的请求不访问上游、不扣费；流式请求命中时把缓存的响应重放为 SSE
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        # 键 -> (过期时间, 响应体)
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes: Optional[int] = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.response_cache_enabled
+
+    @property
+    def disk_dir(self) -> Optional[str]:
+        return self.settings.response_cache_dir or None
+
+    def cacheable(self, request: ChatRequest) -> bool:
+        """只缓存 temperature=0 的请求"""
+        return self.enabled and request.temperature == 0
+
+    @staticmethod
+    def make_key(request: ChatRequest) -> str:
+        if isinstance(request, RawChatRequest):
+            # 透传模式不解析请求体，按原始字节计算（格式不同的等价请求不共享缓存）
+            return hashlib.sha256(request.cache_body()).hexdigest()
+        payload = request.model_dump(exclude_none=True)
+        payload.pop("stream", None)
+        payload.pop("stream_options", None)
+        canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """查询缓存，内存未命中时查询磁盘层并回填内存"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._remove(key)
+
+        if self.disk_dir:
+            found = await asyncio.to_thread(self._read_disk, key)
+            if found is not None:
+                self.disk_hits += 1
+                self._put_memory(key, *found)
+                return found[1]
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, body: bytes):
+        expires_at = time.time() + self.settings.response_cache_ttl
+        self._put_memory(key, expires_at, body)
+        self.stores += 1
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, expires_at, body)
+
+    def record_bypass(self):
+        """请求带 Cache-Control: no-cache，跳过查询缓存"""
+        self.bypassed += 1
+
+    def _put_memory(self, key: str, expires_at: float, body: bytes):
+        if len(body) > self.settings.response_cache_max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (expires_at, body)
+        self._bytes += len(body)
+        while self._bytes > self.settings.response_cache_max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key)
+
+    def _read_disk(self, key: str) -> Optional[Tuple[float, bytes]]:
+        """磁盘文件格式：第一行为过期时间，其余为响应体"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                header, _, body = f.read().partition(b"\n")
+            expires_at = float(header)
+        except (OSError, ValueError):
+            return None
+        if expires_at <= time.time():
+            self._unlink(path)
+            return None
+        return expires_at, body
+
+    def _write_disk(self, key: str, expires_at: float, body: bytes):
+        os.makedirs(self.disk_dir, exist_ok=True)
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.disk_dir) if entry.is_file())
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        data = f"{expires_at}\n".encode() + body
+        try:
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            self._unlink(tmp)
+            return
+        self._disk_bytes += len(data) - replaced
+        if self._disk_bytes > self.settings.response_cache_disk_max_bytes:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """删除过期及最旧的文件，直到磁盘层降到上限的 90%"""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = self.settings.response_cache_disk_max_bytes * 0.9
+        for mtime, size, path in files:
+            if total <= target and mtime + self.settings.response_cache_ttl > now:
+                continue
+            self._unlink(path)
+            total -= size
+            self.evictions += 1
+        self._disk_bytes = total
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clear(self):
+        """清空内存层和磁盘层"""
+        self._entries.clear()
+        self._bytes = 0
+        if self.disk_dir and os.path.isdir(self.disk_dir):
+            for entry in os.scandir(self.disk_dir):
+                if entry.is_file():
+                    self._unlink(entry.path)
+            self._disk_bytes = 0
+
+    @staticmethod
+    async def replay_stream(body: bytes) -> AsyncGenerator[bytes, None]:
+        """把缓存的 chat.completion 响应重放为 chat.completion.chunk 的 SSE 流"""
+        completion = json.loads(body)
+        base = {
+            "id": completion.get("id"),
+            "object": "chat.completion.chunk",
+            "created": completion.get("created"),
+            "model": completion.get("model")
+        }
+        choices = completion.get("choices") or []
+        for choice in choices:
+            delta = {k: v for k, v in (choice.get("message") or {}).items() if v is not None}
+            chunk = {**base, "choices": [{"index": choice.get("index", 0), "delta": delta, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode()
+        final = {**base, "choices": [
+            {"index": choice.get("index", 0), "delta": {}, "finish_reason": choice.get("finish_reason")}
+            for choice in choices
+        ]}
+        if completion.get("usage"):
+            final["usage"] = completion["usage"]
+        yield f"data: {json.dumps(final, ensure_ascii=False)}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.settings.response_cache_max_bytes,
+            "disk_enabled": self.disk_dir is not None,
+            "disk_bytes": self._disk_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "bypassed": self.bypassed,
+            "stores": self.stores,
+            "evictions": self.evictions
+        }
+
+
+response_cache = ResponseCache()
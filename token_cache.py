@@ -0,0 +1,97 @@
+import hashlib
+import time
+from typing import Dict, Optional, Tuple
+
+from config import get_settings
+from database import db
+from models import AccessToken
+
+
+class TokenCache:
+    """
+    访问令牌验证缓存：sha256(token) -> AccessToken，带 TTL
+    无效令牌也会短暂缓存，避免无效请求反复查询数据库
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        # token 哈希 -> (过期时间, AccessToken)
+        self._entries: Dict[str, Tuple[float, AccessToken]] = {}
+        # 无效/已禁用令牌的哈希 -> 过期时间
+        self._negative: Dict[str, float] = {}
+        # token_id -> token 哈希，用于按 ID 失效
+        self._ids: Dict[int, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    async def verify(self, token: str) -> Optional[AccessToken]:
+        """验证访问令牌，命中缓存时不访问数据库"""
+        token_hash = self._hash(token)
+        now = time.monotonic()
+        entry = self._entries.get(token_hash)
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+        if self._negative.get(token_hash, 0.0) > now:
+            self.hits += 1
+            return None
+
+        self.misses += 1
+        access_token = await db.verify_access_token(token)
+        if len(self._entries) + len(self._negative) >= self.settings.token_cache_max_size:
+            self._evict(now)
+        if access_token:
+            self._entries[token_hash] = (now + self.settings.token_cache_ttl, access_token)
+            self._ids[access_token.id] = token_hash
+        else:
+            self._negative[token_hash] = now + self.settings.token_cache_negative_ttl
+        return access_token
+
+    def _evict(self, now: float):
+        """清理过期条目，仍然超出容量时清空缓存"""
+        for token_hash, (expires_at, access_token) in list(self._entries.items()):
+            if expires_at <= now:
+                self._entries.pop(token_hash, None)
+                self._ids.pop(access_token.id, None)
+        for token_hash, expires_at in list(self._negative.items()):
+            if expires_at <= now:
+                self._negative.pop(token_hash, None)
+        if len(self._entries) + len(self._negative) >= self.settings.token_cache_max_size:
+            self.clear()
+
+    def put(self, access_token: AccessToken):
+        """写入新创建的令牌（覆盖之前缓存的无效结果）"""
+        token_hash = self._hash(access_token.token)
+        self._negative.pop(token_hash, None)
+        self._entries[token_hash] = (time.monotonic() + self.settings.token_cache_ttl, access_token)
+        self._ids[access_token.id] = token_hash
+
+    def invalidate(self, token_id: int):
+        """
+        立即失效指定令牌（启用/禁用/删除时调用）
+        被禁用的令牌只有哈希记录，因此同时清空无效令牌缓存
+        """
+        token_hash = self._ids.pop(token_id, None)
+        if token_hash:
+            self._entries.pop(token_hash, None)
+        self._negative.clear()
+
+    def clear(self):
+        self._entries.clear()
+        self._negative.clear()
+        self._ids.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "negative_size": len(self._negative),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+token_cache = TokenCache()
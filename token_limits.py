@@ -0,0 +1,157 @@
+import math
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from metrics import metrics
+from models import AccessToken
+from rate_limit import TokenBucket
+
+# 当前请求所属令牌的限流状态（用于把上游 usage 计入该令牌的 TPM）
+_current_state: ContextVar[Optional["_TokenState"]] = ContextVar("current_token_state", default=None)
+
+
+class TokenLimitExceeded(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(math.ceil(self.retry_after), 1))
+
+
+class _TokenState:
+    __slots__ = ("limits", "rps", "tpm", "concurrency", "in_flight", "rejected")
+
+    def __init__(self):
+        self.limits = (0.0, 0, 0)
+        self.rps: Optional[TokenBucket] = None
+        self.tpm: Optional[TokenBucket] = None
+        self.concurrency = 0
+        self.in_flight = 0
+        self.rejected = 0
+
+    def configure(self, rps_limit: float, concurrency_limit: int, tpm_limit: int):
+        """限流设置变化时重建令牌桶（进行中的请求数保留）"""
+        self.limits = (rps_limit, concurrency_limit, tpm_limit)
+        # 允许 1 秒的突发
+        self.rps = TokenBucket(max(rps_limit, 1.0), rps_limit) if rps_limit > 0 else None
+        self.tpm = TokenBucket(tpm_limit, tpm_limit / 60.0) if tpm_limit > 0 else None
+        self.concurrency = concurrency_limit
+
+
+class TokenLimiter:
+    """
+    按访问令牌限流，状态全部在内存中，请求路径上不访问数据库
+    - rps_limit：每秒请求数（令牌桶，允许 1 秒的突发）
+    - concurrency_limit：进行中的请求数，请求完成（流式响应发送完）后由 TokenLimitMiddleware 释放
+    - tpm_limit：每分钟 token 数，按上游返回的 usage 在请求完成后扣除，额度扣为负数后拒绝新请求直到恢复；
+      缓存命中和合并等待的请求按共享响应中的 usage 同样扣除，重复发送相同请求不能绕过限制
+    限流设置随令牌缓存（token_cache）刷新，多进程部署时每个 worker 各自计数
+    """
+
+    def __init__(self):
+        self._states: Dict[int, _TokenState] = {}
+        self.rejected = 0
+
+    def acquire(self, access_token: AccessToken) -> Optional[_TokenState]:
+        """
+        检查令牌的限流，超过时抛出 TokenLimitExceeded
+        返回的状态需要在请求结束后调用 release（没有设置限流时返回 None）
+        """
+        limits = (access_token.rps_limit, access_token.concurrency_limit, access_token.tpm_limit)
+        state = self._states.get(access_token.id)
+        if state is None:
+            if not any(limits):
+                return None
+            state = self._states[access_token.id] = _TokenState()
+            state.configure(*limits)
+        elif state.limits != limits:
+            if not any(limits):
+                del self._states[access_token.id]
+                return None
+            state.configure(*limits)
+
+        if state.concurrency and state.in_flight >= state.concurrency:
+            self._reject(state, "concurrency")
+            raise TokenLimitExceeded("Too many concurrent requests", 1.0)
+        if state.tpm is not None and state.tpm.available() <= 0:
+            self._reject(state, "tpm")
+            raise TokenLimitExceeded("Token rate limit exceeded", state.tpm.wait_time(1.0))
+        if state.rps is not None and not state.rps.try_take():
+            self._reject(state, "rps")
+            raise TokenLimitExceeded("Request rate limit exceeded", state.rps.wait_time(1.0))
+
+        state.in_flight += 1
+        if state.tpm is not None:
+            _current_state.set(state)
+        return state
+
+    def _reject(self, state: _TokenState, reason: str):
+        state.rejected += 1
+        self.rejected += 1
+        metrics.token_limited.inc(reason)
+
+    @staticmethod
+    def release(state: _TokenState):
+        if state.in_flight > 0:
+            state.in_flight -= 1
+
+    @staticmethod
+    def wants_usage() -> bool:
+        """当前请求的令牌是否需要统计 token 用量"""
+        return _current_state.get() is not None
+
+    @staticmethod
+    def record_usage(usage: Optional[dict]):
+        """把上游返回的 usage 计入当前请求所属令牌的 TPM"""
+        state = _current_state.get()
+        if state is None or state.tpm is None or not usage:
+            return
+        total = usage.get("total_tokens")
+        if not isinstance(total, int):
+            total = sum(v for k, v in usage.items() if k in ("prompt_tokens", "completion_tokens") and isinstance(v, int))
+        if total > 0:
+            state.tpm.take(total)
+
+    def remove(self, token_id: int):
+        self._states.pop(token_id, None)
+
+    def get_stats(self) -> dict:
+        tokens = []
+        for token_id, state in self._states.items():
+            rps_limit, concurrency_limit, tpm_limit = state.limits
+            tokens.append({
+                "token_id": token_id,
+                "rps_limit": rps_limit,
+                "concurrency_limit": concurrency_limit,
+                "tpm_limit": tpm_limit,
+                "in_flight": state.in_flight,
+                "tpm_available": round(state.tpm.available(), 1) if state.tpm else None,
+                "rejected": state.rejected
+            })
+        return {"rejected_total": self.rejected, "tokens": tokens}
+
+
+token_limiter = TokenLimiter()
+
+
+class TokenLimitMiddleware:
+    """ASGI 中间件：请求完成（包括流式响应发送完毕）后释放访问令牌占用的并发名额"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        # request.state 保存在 scope["state"] 中，先创建以便读取 verify_api_key 写入的状态
+        state = scope.setdefault("state", {})
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            token_state = state.get("token_limit")
+            if token_state is not None:
+                token_limiter.release(token_state)
@@ -0,0 +1,297 @@
+import asyncio
+import json
+import random
+import secrets
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from config import get_settings
+from profiler import profiler
+
+# OTLP SpanKind
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Trace:
+    """一次请求的所有 span"""
+
+    __slots__ = ("trace_id", "request_id", "spans", "started")
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        # 客户端传入的 X-Request-ID 为 32 位十六进制时直接作为 trace id
+        if len(request_id) == 32 and all(c in "0123456789abcdef" for c in request_id):
+            self.trace_id = request_id
+        else:
+            self.trace_id = secrets.token_hex(16)
+        self.spans: List["Span"] = []
+        self.started = time.monotonic()
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "error", "_token")
+
+    def __init__(self, trace: Trace, name: str, parent: Optional["Span"], kind: int):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else ""
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+        self._token = None
+        trace.spans.append(self)
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def fail(self, message: str):
+        self.error = message
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and self.error is None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self._token)
+        self.end()
+
+
+class _NoopSpan:
+    """当前请求未被追踪时使用，所有操作为空"""
+
+    __slots__ = ()
+
+    def set(self, key: str, value: Any):
+        pass
+
+    def fail(self, message: str):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Tracer:
+    """
+    请求级追踪
+    - 每个请求一个 trace（TracingMiddleware 创建），span 通过 contextvars 自动关联父子关系
+    - 请求结束后，按 trace_sample_rate 采样，慢于 trace_slow_threshold 的请求总是导出
+    - 以 OTLP/JSON 格式批量写入 trace_export_path（每行一个 ExportTraceServiceRequest），
+      或发送到 trace_export_url（OTLP/HTTP 收集器的 /v1/traces）
+    未开启追踪或当前请求没有 trace 时，span() 返回空操作对象
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._pending: List[Trace] = []
+        self._task: Optional[asyncio.Task] = None
+        self.exported = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.tracing_enabled
+
+    def span(self, name: str, kind: int = SPAN_KIND_INTERNAL):
+        """创建子 span，用作 with 语句（span 在 with 块内为当前 span）"""
+        trace = _current_trace.get()
+        if trace is None:
+            return NOOP_SPAN
+        return Span(trace, name, _current_span.get(), kind)
+
+    def start(self, name: str, kind: int = SPAN_KIND_INTERNAL):
+        """创建子 span 但不设为当前 span，需要手动调用 end()（用于异步生成器）"""
+        return self.span(name, kind)
+
+    def begin(self, request_id: str, name: str) -> Span:
+        """开始一个请求的 trace，返回根 span"""
+        trace = Trace(request_id)
+        _current_trace.set(trace)
+        root = Span(trace, name, None, SPAN_KIND_SERVER)
+        _current_span.set(root)
+        return root
+
+    def finish(self, root: Span):
+        """请求结束：结束根 span，决定是否导出"""
+        root.end()
+        trace = root.trace
+        duration = (root.end_ns - root.start_ns) / 1e9
+        profiler.request_finished(trace.trace_id, root.name, trace.started, time.monotonic(), duration)
+        if not self.enabled:
+            return
+        if duration >= self.settings.trace_slow_threshold or random.random() < self.settings.trace_sample_rate:
+            if len(self._pending) >= 10000:
+                self.dropped += 1
+                return
+            self._pending.append(trace)
+
+    async def start_exporter(self):
+        """启动后台导出任务（由 main.lifespan 调用）"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop_exporter(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(1.0)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+
+    async def flush(self):
+        if not self._pending:
+            return
+        traces, self._pending = self._pending, []
+        payload = self.to_otlp(traces)
+        if self.settings.trace_export_url:
+            # 延迟导入，避免与 upstream 循环依赖
+            from upstream import upstream_client
+            await upstream_client.client.post(self.settings.trace_export_url, json=payload, timeout=10.0)
+        elif self.settings.trace_export_path:
+            line = json.dumps(payload, ensure_ascii=False, separators=(",", ":")) + "\n"
+            await asyncio.to_thread(self._append, self.settings.trace_export_path, line)
+        self.exported += len(traces)
+
+    @staticmethod
+    def _append(path: str, line: str):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    @staticmethod
+    def to_otlp(traces: List[Trace]) -> dict:
+        spans = []
+        for trace in traces:
+            for span in trace.spans:
+                attributes = dict(span.attributes)
+                if not span.parent_id:
+                    attributes["request_id"] = trace.request_id
+                spans.append({
+                    "traceId": trace.trace_id,
+                    "spanId": span.span_id,
+                    "parentSpanId": span.parent_id,
+                    "name": span.name,
+                    "kind": span.kind,
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns or span.start_ns),
+                    "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items()],
+                    "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+                })
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "api-exchange"}}]},
+                "scopeSpans": [{"scope": {"name": "api-exchange"}, "spans": spans}]
+            }]
+        }
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.settings.trace_sample_rate,
+            "slow_threshold": self.settings.trace_slow_threshold,
+            "pending": len(self._pending),
+            "exported": self.exported,
+            "dropped": self.dropped
+        }
+
+
+tracer = Tracer()
+
+
+class TracingMiddleware:
+    """
+    ASGI 中间件：开启追踪或采样分析器时，为 /v1、/admin、/api 下的请求创建 trace
+    使用请求头 X-Request-ID 作为关联 ID（没有时生成），并在响应头中返回；
+    流式响应在最后一块数据发送后才结束 trace
+    """
+
+    PREFIXES = ("/v1/", "/admin/", "/api/")
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not (tracer.enabled or profiler.enabled)
+            or not scope["path"].startswith(self.PREFIXES)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = ""
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:128]
+                break
+        request_id = request_id or secrets.token_hex(16)
+
+        root = tracer.begin(request_id, f"{scope['method']} {scope['path']}")
+        root.set("http.method", scope["method"])
+        root.set("http.target", scope["path"])
+        finished = False
+
+        async def send_wrapper(message):
+            nonlocal finished
+            if message["type"] == "http.response.start":
+                root.set("http.status_code", message["status"])
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False) and not finished:
+                finished = True
+                tracer.finish(root)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            root.fail(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            if not finished:
+                finished = True
+                tracer.finish(root)
@@ -0,0 +1,136 @@
+import httpx
+import importlib.util
+import time
+from typing import Optional
+from contextlib import contextmanager
+
+from config import get_settings
+from metrics import metrics
+
+
+class RequestTimer:
+    """
+    单个上游请求的计时
+    作为 httpx 的 trace 扩展接收 httpcore 事件，记录新建连接耗时和首字节时间（TTFB）
+    """
+
+    __slots__ = ("kind", "started", "connect_started", "sent_at")
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.connect_started: Optional[float] = None
+        self.sent_at: Optional[float] = None
+
+    async def trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.started":
+            self.connect_started = time.perf_counter()
+        elif event_name.endswith("send_request_headers.started"):
+            now = time.perf_counter()
+            if self.connect_started is not None:
+                # 包含 TLS 握手
+                metrics.upstream_connect_seconds.observe(now - self.connect_started, self.kind)
+                self.connect_started = None
+            self.sent_at = now
+        elif event_name.endswith("receive_response_headers.complete") and self.sent_at is not None:
+            metrics.upstream_ttfb_seconds.observe(time.perf_counter() - self.sent_at, self.kind)
+
+    @property
+    def extensions(self) -> dict:
+        return {"trace": self.trace}
+
+    def finish(self):
+        """记录请求总耗时（流式请求为读取完响应体的时间）"""
+        metrics.upstream_request_seconds.observe(time.perf_counter() - self.started, self.kind)
+
+
+class UpstreamClient:
+    """共享的上游 HTTP 客户端（连接池 + keep-alive，可选 HTTP/2）"""
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._in_flight = 0
+        self._total_requests = 0
+        self._peak_in_flight = 0
+
+    @property
+    def http2_enabled(self) -> bool:
+        """HTTP/2 需要安装 h2（pip install httpx[http2]），未安装时回退到 HTTP/1.1"""
+        return self.settings.upstream_http2 and importlib.util.find_spec("h2") is not None
+
+    def _build_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            http2=self.http2_enabled,
+            limits=httpx.Limits(
+                max_connections=self.settings.upstream_max_connections,
+                max_keepalive_connections=self.settings.upstream_max_keepalive_connections,
+                keepalive_expiry=self.settings.upstream_keepalive_expiry
+            ),
+            timeout=httpx.Timeout(
+                self.settings.request_timeout,
+                connect=self.settings.upstream_connect_timeout
+            )
+        )
+
+    async def start(self):
+        """创建长连接客户端（由 main.lifespan 调用）"""
+        if self._client is not None:
+            return
+        self._client = self._build_client()
+
+    async def close(self):
+        """关闭客户端并释放所有连接"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """获取共享客户端，未启动时惰性创建"""
+        if self._client is None:
+            self._client = self._build_client()
+        return self._client
+
+    def stream_timeout(self) -> httpx.Timeout:
+        """流式请求：保留连接超时，不限制读取时间"""
+        return httpx.Timeout(None, connect=self.settings.upstream_connect_timeout)
+
+    @contextmanager
+    def track(self):
+        """统计进行中的上游请求数"""
+        self._in_flight += 1
+        self._total_requests += 1
+        if self._in_flight > self._peak_in_flight:
+            self._peak_in_flight = self._in_flight
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+
+    def get_stats(self) -> dict:
+        """连接池使用情况，用于调整连接池大小"""
+        connections = []
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        if pool is not None:
+            connections = list(pool.connections)
+
+        idle = sum(1 for c in connections if c.is_idle())
+        max_connections = self.settings.upstream_max_connections
+        return {
+            "started": self._client is not None,
+            "http2": self.http2_enabled,
+            "max_connections": max_connections,
+            "max_keepalive_connections": self.settings.upstream_max_keepalive_connections,
+            "keepalive_expiry": self.settings.upstream_keepalive_expiry,
+            "connections": len(connections),
+            "active_connections": len(connections) - idle,
+            "idle_connections": idle,
+            "in_flight_requests": self._in_flight,
+            "peak_in_flight_requests": self._peak_in_flight,
+            "total_requests": self._total_requests,
+            "utilization": round((len(connections) - idle) / max_connections, 4) if max_connections else 0.0
+        }
+
+
+upstream_client = UpstreamClient()
@@ -0,0 +1,157 @@
+import json
+import re
+import time
+from email.utils import parsedate_to_datetime
+from enum import Enum
+from typing import Mapping, Optional, Tuple, Union
+
+
+class ErrorKind(str, Enum):
+    INVALID_KEY = "invalid_key"    # Key 无效或被封禁：标记 invalid，换 Key 重试
+    QUOTA = "quota"                # 额度用完：标记 exhausted，换 Key 重试
+    RATE_LIMITED = "rate_limited"  # 限流：Key 暂时冷却，换 Key 重试
+    SERVER_ERROR = "server_error"  # 上游临时故障（5xx、超时）：计入熔断，换 Key 重试
+    BAD_REQUEST = "bad_request"    # 请求本身的问题（模型不存在、参数错误等）：不影响 Key，不重试
+
+
+# 结构化错误（{"error": {"code": ..., "type": ...}}）中的 code / type
+_INVALID_CODES = {
+    "invalid_api_key", "account_deactivated", "invalid_authentication",
+    "authentication_error", "permission_denied", "organization_deactivated"
+}
+_QUOTA_CODES = {
+    "insufficient_quota", "billing_hard_limit_reached", "quota_exceeded",
+    "billing_not_active", "insufficient_balance"
+}
+_RATE_LIMIT_CODES = {"rate_limit_exceeded", "rate_limit_error", "requests", "tokens"}
+_SERVER_CODES = {"server_error", "overloaded_error", "api_error", "service_unavailable"}
+
+# 没有结构化 code 时，只在 402/403/429 的错误消息中匹配这些明确表示额度用完的短语
+_QUOTA_PHRASES = ("insufficient_quota", "exceeded your current quota", "quota exceeded", "余额不足", "额度已用完", "次数已用完")
+
+# x-ratelimit-reset-* 的时长格式，如 "1s"、"6m0s"、"20ms"
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNIT_SECONDS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class UpstreamError:
+    """一次上游错误响应的分类结果"""
+
+    __slots__ = ("kind", "status_code", "code", "message", "retry_after")
+
+    def __init__(self, kind: ErrorKind, status_code: int, code: str, message: str, retry_after: Optional[float]):
+        self.kind = kind
+        self.status_code = status_code
+        self.code = code
+        self.message = message
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        """是否应该换一个 Key 重试"""
+        return self.kind != ErrorKind.BAD_REQUEST
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """解析 x-ratelimit-reset-* 的时长（"6m0s"）或纯秒数"""
+    value = value.strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _UNIT_SECONDS[unit] for number, unit in parts)
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """
+    从响应头中读取需要等待的秒数
+    优先使用 Retry-After（秒数或 HTTP 日期），其次为 x-ratelimit-reset-requests / -tokens 中较大的一个
+    """
+    if not headers:
+        return None
+    value = headers.get("retry-after")
+    if value:
+        seconds = parse_duration(value)
+        if seconds is not None:
+            return seconds
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            pass
+    resets = [
+        parse_duration(headers[name])
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if headers.get(name)
+    ]
+    resets = [seconds for seconds in resets if seconds is not None]
+    return max(resets) if resets else None
+
+
+def parse_request_limit(headers: Optional[Mapping[str, str]]) -> Optional[Tuple[int, int]]:
+    """读取 x-ratelimit-limit-requests / x-ratelimit-remaining-requests，返回 (limit, remaining)"""
+    if not headers:
+        return None
+    limit = headers.get("x-ratelimit-limit-requests")
+    remaining = headers.get("x-ratelimit-remaining-requests")
+    if not limit or remaining is None:
+        return None
+    try:
+        return int(limit), max(int(remaining), 0)
+    except ValueError:
+        return None
+
+
+def _parse_body(body: Union[str, bytes]) -> tuple:
+    """返回 (code, message)，body 不是 JSON 时 code 为空、message 为原文"""
+    text = body.decode("utf-8", errors="replace") if isinstance(body, bytes) else body
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return "", text[:500]
+    if not isinstance(data, dict):
+        return "", text[:500]
+    error = data.get("error", data)
+    if not isinstance(error, dict):
+        return "", str(error)[:500]
+    code = error.get("code") or error.get("type") or ""
+    return str(code).lower(), str(error.get("message") or text)[:500]
+
+
+def classify(
+    status_code: int,
+    body: Union[str, bytes] = b"",
+    headers: Optional[Mapping[str, str]] = None
+) -> UpstreamError:
+    """
+    根据状态码和结构化错误 JSON 对上游错误分类
+    只有明确的 code 或状态码才会导致 Key 被永久标记，无法判断的错误按临时故障处理
+    """
+    code, message = _parse_body(body)
+    retry_after = parse_retry_after(headers)
+
+    if code in _QUOTA_CODES:
+        kind = ErrorKind.QUOTA
+    elif code in _INVALID_CODES:
+        kind = ErrorKind.INVALID_KEY
+    elif code in _RATE_LIMIT_CODES:
+        kind = ErrorKind.RATE_LIMITED
+    elif code in _SERVER_CODES:
+        kind = ErrorKind.SERVER_ERROR
+    elif status_code == 401:
+        kind = ErrorKind.INVALID_KEY
+    elif status_code in (402, 403, 429) and any(phrase in message.lower() for phrase in _QUOTA_PHRASES):
+        kind = ErrorKind.QUOTA
+    elif status_code == 402:
+        kind = ErrorKind.QUOTA
+    elif status_code == 429:
+        kind = ErrorKind.RATE_LIMITED
+    elif status_code in (403, 408, 409) or status_code >= 500:
+        # 403 可能是 Key 被临时封禁或地区限制，先熔断而不永久标记
+        kind = ErrorKind.SERVER_ERROR
+    else:
+        kind = ErrorKind.BAD_REQUEST
+
+    return UpstreamError(kind, status_code, code, message, retry_after)
@@ -0,0 +1,57 @@
+import httpx
+
+from models import UsageCheckResponse
+from config import get_settings
+from upstream import upstream_client
+
+
+class UsageChecker:
+    """
+    远程余额查询
+    剩余额度 = /dashboard/billing/subscription 的总额度 - /dashboard/billing/usage 的已用额度
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.base_url = self.settings.usage_check_url.rstrip("/")
+
+    async def check(self, key: str) -> UsageCheckResponse:
+        """查询单个 Key 的余额"""
+        headers = {"Authorization": f"Bearer {key}"}
+        client = upstream_client.client
+        try:
+            with upstream_client.track():
+                subscription = await client.get(
+                    f"{self.base_url}/dashboard/billing/subscription",
+                    headers=headers,
+                    timeout=30.0
+                )
+                if subscription.status_code in (401, 403):
+                    return UsageCheckResponse(key=key, valid=False, error=subscription.text)
+                if subscription.status_code != 200:
+                    return UsageCheckResponse(key=key, error=f"HTTP {subscription.status_code}")
+
+                usage = await client.get(
+                    f"{self.base_url}/dashboard/billing/usage",
+                    headers=headers,
+                    timeout=30.0
+                )
+                if usage.status_code != 200:
+                    return UsageCheckResponse(key=key, error=f"HTTP {usage.status_code}")
+
+            total = float(subscription.json().get("hard_limit_usd") or 0)
+            # total_usage 单位为美分
+            used = float(usage.json().get("total_usage") or 0) / 100
+            return UsageCheckResponse(
+                key=key,
+                total=round(total, 6),
+                used=round(used, 6),
+                remaining=round(max(total - used, 0.0), 6)
+            )
+        except httpx.HTTPError as e:
+            return UsageCheckResponse(key=key, error=str(e) or type(e).__name__)
+        except (ValueError, AttributeError) as e:
+            return UsageCheckResponse(key=key, error=f"Invalid usage response: {e}")
+
+
+usage_checker = UsageChecker()
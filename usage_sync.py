@@ -0,0 +1,165 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from models import UsageCheckResponse
+from config import get_settings
+from cluster import cluster
+from database import db
+from key_manager import key_manager
+from usage_checker import usage_checker
+from write_behind import write_behind
+
+logger = logging.getLogger(__name__)
+
+class UsageSyncer:
+    """
+    后台余额同步
+    每 sync_interval 秒同步一次到期的 Key（从未同步、同步过期或同步后被使用过的优先），
+    以 sync_concurrency 的并发查询远程余额，每 sync_batch_size 个结果在一个事务中写入
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._task: Optional[asyncio.Task] = None
+        self._sync_task: Optional[asyncio.Task] = None
+        self.last_run: Optional[dict] = None
+
+    @property
+    def running(self) -> bool:
+        return self._sync_task is not None and not self._sync_task.done()
+
+    async def start(self):
+        """启动定时同步（由 main.lifespan 调用）"""
+        if self.settings.auto_sync_usage and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for task in (self._task, self._sync_task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._sync_task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.settings.sync_interval)
+            if self.running:
+                continue
+            try:
+                # 多进程部署时只由持有租约的一个 worker 执行定时同步
+                if not await cluster.try_lead("usage_sync", self.settings.sync_interval * 2):
+                    continue
+                await self._start_sync(force=False)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+
+    def trigger(self, force: bool = True) -> bool:
+        """手动触发一次后台同步，已有同步在进行时返回 False"""
+        if self.running:
+            return False
+        self._start_sync(force)
+        return True
+
+    def _start_sync(self, force: bool) -> asyncio.Task:
+        self._sync_task = asyncio.create_task(self.sync_due(force=force))
+        self._sync_task.add_done_callback(self._sync_done)
+        return self._sync_task
+
+    def _sync_done(self, task: asyncio.Task):
+        """读取同步任务的异常：写入日志并记录到 last_run，/admin/sync 可以看到失败原因"""
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is None:
+            return
+        logger.error("usage sync failed", exc_info=error)
+        if self.last_run is not None:
+            self.last_run["finished_at"] = datetime.now().isoformat()
+            self.last_run["error"] = f"{type(error).__name__}: {error}"
+
+    async def sync_due(self, force: bool = False) -> dict:
+        """同步到期的 Key，force=True 时同步所有非 invalid 的 Key"""
+        started = datetime.now()
+        stale_before = None if force else started - timedelta(seconds=self.settings.sync_interval)
+        # 先记录本次同步，查询失败时 _sync_done 也能把错误写到这里
+        result = {
+            "started_at": started.isoformat(),
+            "finished_at": None,
+            "total": 0,
+            "synced": 0,
+            "invalid": 0,
+            "errors": 0,
+            "error": None
+        }
+        self.last_run = result
+        keys = await db.get_keys_due_for_sync(stale_before)
+        result["total"] = len(keys)
+
+        semaphore = asyncio.Semaphore(self.settings.sync_concurrency)
+
+        async def check(key: str) -> UsageCheckResponse:
+            async with semaphore:
+                return await usage_checker.check(key)
+
+        batch_size = self.settings.sync_batch_size
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            responses = await asyncio.gather(*(check(key) for _, key in batch))
+            counts = await self._apply([key_id for key_id, _ in batch], responses)
+            for name, count in counts.items():
+                result[name] += count
+
+        result["finished_at"] = datetime.now().isoformat()
+        return result
+
+    async def sync_key(self, key_id: int) -> Optional[UsageCheckResponse]:
+        """立即同步单个 Key"""
+        record = await db.get_key_by_id(key_id)
+        if not record:
+            return None
+        response = await usage_checker.check(record.key)
+        await self._apply([key_id], [response])
+        return response
+
+    async def _apply(self, key_ids: List[int], responses: List[UsageCheckResponse]) -> dict:
+        """批量写入同步结果并刷新内存 Key 池"""
+        now = datetime.now()
+        balances, invalid, attempted = [], [], []
+        for key_id, response in zip(key_ids, responses):
+            if not response.valid:
+                invalid.append((now, key_id))
+            elif response.error is not None or response.remaining is None:
+                attempted.append((now, key_id))
+            else:
+                balances.append((response.remaining, now, key_id))
+
+        # 先写入缓冲中的扣费，避免被同步结果覆盖后重复扣除
+        await write_behind.flush()
+        await db.apply_sync_results(balances, invalid, attempted)
+
+        if not key_manager.shared:
+            for key_id, _ in invalid:
+                key_manager.pool.remove(key_id)
+            for record in await db.get_keys_by_ids([key_id for _, _, key_id in balances]):
+                key_manager.pool.upsert(record)
+
+        return {"synced": len(balances), "invalid": len(invalid), "errors": len(attempted)}
+
+    def get_status(self) -> dict:
+        return {
+            "auto_sync": self.settings.auto_sync_usage,
+            "interval": self.settings.sync_interval,
+            "running": self.running,
+            "last_run": self.last_run
+        }
+
+
+usage_syncer = UsageSyncer()
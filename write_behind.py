@@ -0,0 +1,167 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from config import get_settings
+from database import db
+
+
+class WriteBehindBuffer:
+    """
+    扣费和使用计数的写回缓冲
+    在内存中按 Key / 令牌聚合，达到时间或数量阈值时在单个事务中批量写入数据库
+    写入由后台任务完成：达到数量阈值时只唤醒后台任务，记账的请求不等待数据库写入
+
+    write_behind_mode:
+      - batch: 批量写回，崩溃时最多丢失 write_behind_interval 秒、
+               write_behind_max_pending 次、write_behind_max_amount 额度的记账
+      - sync:  每次立即写入数据库（与旧行为一致，崩溃不丢失记账）
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        # key_id -> [扣费金额, 请求次数, 最后使用时间]
+        self._key_usage: Dict[int, list] = {}
+        # token_id -> [请求次数, 最后使用时间]
+        self._token_usage: Dict[int, list] = {}
+        self._pending = 0
+        self._pending_amount = 0.0
+        self._flush_lock = asyncio.Lock()
+        # 达到数量阈值时唤醒后台任务立即写入
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.flush_count = 0
+        self.flushed_ops = 0
+
+    @property
+    def sync_mode(self) -> bool:
+        return self.settings.write_behind_mode == "sync"
+
+    async def start(self):
+        """启动后台定时刷新任务（由 main.lifespan 调用）"""
+        if not self.sync_mode and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务并写入所有未提交的记账"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def record_deduction(self, key_id: int, amount: float):
+        """记录一次 Key 扣费"""
+        if self.sync_mode:
+            await db.deduct_balance(key_id, amount)
+            return
+
+        entry = self._key_usage.get(key_id)
+        if entry is None:
+            self._key_usage[key_id] = [amount, 1, datetime.now()]
+        else:
+            entry[0] += amount
+            entry[1] += 1
+            entry[2] = datetime.now()
+        self._pending += 1
+        self._pending_amount += amount
+        await self._flush_if_needed()
+
+    async def record_token_use(self, token_id: int):
+        """记录一次访问令牌使用"""
+        if self.sync_mode:
+            await db.apply_usage_batch([], [(1, datetime.now(), token_id)])
+            return
+
+        entry = self._token_usage.get(token_id)
+        if entry is None:
+            self._token_usage[token_id] = [1, datetime.now()]
+        else:
+            entry[0] += 1
+            entry[1] = datetime.now()
+        self._pending += 1
+        await self._flush_if_needed()
+
+    async def _flush_if_needed(self):
+        if (self._pending >= self.settings.write_behind_max_pending
+                or self._pending_amount >= self.settings.write_behind_max_amount):
+            if self._task is not None:
+                self._wakeup.set()
+            else:
+                # 后台任务未启动（如脚本中直接使用）时当场写入，避免缓冲无限增长
+                await self.flush()
+
+    async def flush(self):
+        """在单个事务中写入所有缓冲的记账"""
+        async with self._flush_lock:
+            if not self._key_usage and not self._token_usage:
+                return
+
+            key_usage, self._key_usage = self._key_usage, {}
+            token_usage, self._token_usage = self._token_usage, {}
+            pending, self._pending = self._pending, 0
+            pending_amount, self._pending_amount = self._pending_amount, 0.0
+
+            key_rows: List[tuple] = [
+                (amount, count, last_used, key_id)
+                for key_id, (amount, count, last_used) in key_usage.items()
+            ]
+            token_rows: List[tuple] = [
+                (count, last_used, token_id)
+                for token_id, (count, last_used) in token_usage.items()
+            ]
+
+            try:
+                await db.apply_usage_batch(key_rows, token_rows)
+            except Exception:
+                self._merge_back(key_usage, token_usage, pending, pending_amount)
+                raise
+
+            self.flush_count += 1
+            self.flushed_ops += pending
+
+    def _merge_back(self, key_usage: dict, token_usage: dict, pending: int, pending_amount: float):
+        """写入失败时把数据放回缓冲，等待下次重试"""
+        for key_id, (amount, count, last_used) in key_usage.items():
+            entry = self._key_usage.setdefault(key_id, [0.0, 0, last_used])
+            entry[0] += amount
+            entry[1] += count
+            entry[2] = max(entry[2], last_used)
+        for token_id, (count, last_used) in token_usage.items():
+            entry = self._token_usage.setdefault(token_id, [0, last_used])
+            entry[0] += count
+            entry[1] = max(entry[1], last_used)
+        self._pending += pending
+        self._pending_amount += pending_amount
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.settings.write_behind_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+
+    def get_stats(self) -> dict:
+        """写回缓冲状态"""
+        return {
+            "mode": self.settings.write_behind_mode,
+            "pending_ops": self._pending,
+            "pending_amount": round(self._pending_amount, 4),
+            "pending_keys": len(self._key_usage),
+            "pending_tokens": len(self._token_usage),
+            "flush_count": self.flush_count,
+            "flushed_ops": self.flushed_ops
+        }
+
+
+write_behind = WriteBehindBuffer()